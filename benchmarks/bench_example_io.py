@@ -0,0 +1,290 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Benchmarks of example encoding, TFRecord I/O and parsing.
+
+Synthetic datasets follow the `tf_utils.example_features_template.ExampleFeatures` schema: JPEG
+sized image blobs, PNG sized segmentation masks, file names and int fields, at several sizes.
+Every benchmark reports its throughput and how much one run raises the peak resident memory of the
+process, and the results are written as JSON so runs can be compared:
+
+    python benchmarks/bench_example_io.py --output after.json --baseline before.json
+
+Benchmarks that need TensorFlow are skipped when it cannot be imported.
+"""
+
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolbox_az.general.flags import Flags
+from toolbox_az.tf_utils.example_wire import encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter, iterate_tfrecord
+from toolbox_az.tf_utils.tfrecord_writer import write_sharded_tfrecords
+
+# Dataset sizes: number of records, image bytes and mask bytes per record.
+DATASET_SIZES = {
+    'small': (2000, 16 * 1024, 2 * 1024),
+    'medium': (500, 256 * 1024, 32 * 1024),
+    'large': (50, 2 * 1024 * 1024, 256 * 1024),
+}
+
+FEATURES = ['image/height', 'image/width', 'image/filename']
+
+# Unit of `ru_maxrss` in bytes, it is reported in kilobytes on Linux and in bytes on macOS.
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def generate_dataset(num_records, image_bytes, mask_bytes, seed=0):
+    """
+    Generates feature dicts shaped like the `ExampleFeatures` template schema.
+    :return: A list of feature dicts accepted by `build_example_from_data_dict`.
+    """
+    random_state = np.random.RandomState(seed)
+    dataset = []
+    for index in range(num_records):
+        image = random_state.randint(0, 256, size=image_bytes, dtype=np.uint8).tobytes()
+        mask = random_state.randint(0, 256, size=mask_bytes, dtype=np.uint8).tobytes()
+        dataset.append({
+            'image/encoded': b'\xff\xd8\xff' + image[3:],
+            'image/filename': '{:08d}.jpg'.format(index),
+            'image/format': 'jpeg',
+            'image/height': np.int64(random_state.randint(64, 4096)),
+            'image/width': np.int64(random_state.randint(64, 4096)),
+            'image/segmentation/class/encoded': b'\x89PNG' + mask[4:],
+            'image/segmentation/class/format': 'png',
+        })
+    return dataset
+
+
+def _peak_rss():
+    """
+    :return: The peak resident set size of the process in bytes.
+    """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+def measure_peak_memory(function):
+    """
+    Runs `function` once and measures how much it raises the peak resident set size, which counts
+    mmapped files and native allocations that a Python heap tracer misses. The peak is reset
+    before the run where Linux allows it, elsewhere only a run that exceeds the peak of all
+    earlier runs is seen.
+    :return: The increase of the peak resident set size in bytes.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        pass
+    start_rss = _peak_rss()
+    function()
+    return max(_peak_rss() - start_rss, 0)
+
+
+def measure(function, num_records, num_bytes, repeats):
+    """
+    Runs `function` `repeats` times and measures the best run, then measures its peak memory in a
+    separate run so memory tracking does not slow the timed runs.
+    :return: A dict of the best time, throughput and peak memory increase.
+    """
+    best_seconds = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        best_seconds = min(best_seconds, time.perf_counter() - start_time)
+
+    return {
+        'seconds': best_seconds,
+        'records_per_second': num_records / best_seconds,
+        'mb_per_second': num_bytes / best_seconds / 2 ** 20,
+        'peak_memory_bytes': measure_peak_memory(function),
+    }
+
+
+def _import_tf_utils():
+
+    # TensorFlow is imported lazily by the toolbox modules, so it is probed explicitly.
+    try:
+        importlib.import_module('tensorflow')
+        from toolbox_az.tf_utils import example_utils, tf_utils
+        from toolbox_az.tf_utils.example_features_template import ExampleFeatures
+    except ImportError:
+        return None
+    return example_utils, tf_utils, ExampleFeatures
+
+
+def run_benchmarks(size_names, repeats, work_dir):
+    """
+    Runs all benchmarks on datasets of the given sizes.
+    :return: A list of result dicts.
+    """
+    tf_modules = _import_tf_utils()
+
+    results = []
+    for size_name in size_names:
+        num_records, image_bytes, mask_bytes = DATASET_SIZES[size_name]
+        dataset = generate_dataset(num_records, image_bytes, mask_bytes)
+        serialized = [encode_example_from_data_dict(features_data) for features_data in dataset]
+        num_bytes = sum(len(record) for record in serialized)
+
+        tfrecord_file = os.path.join(work_dir, '{}.tfrecord'.format(size_name))
+        with TFRecordFileWriter(tfrecord_file) as writer:
+            for record in serialized:
+                writer.write(record)
+
+        def write_records():
+            with TFRecordFileWriter(os.path.join(work_dir, 'write.tfrecord')) as writer:
+                for record in serialized:
+                    writer.write(record)
+
+        def write_sharded():
+            write_sharded_tfrecords(dataset, os.path.join(work_dir, 'sharded'), num_shards=4)
+
+        def read_records():
+            for _ in iterate_tfrecord(tfrecord_file):
+                pass
+
+        benchmarks = {
+            'encode_wire': lambda: [encode_example_from_data_dict(features_data)
+                                    for features_data in dataset],
+            'write': write_records,
+            'write_sharded': write_sharded,
+            'read_mmap': read_records,
+        }
+
+        if tf_modules is not None:
+            example_utils, tf_utils, ExampleFeatures = tf_modules
+            parser = example_utils.ExampleParser(ExampleFeatures())
+
+            def to_list():
+                for features_data in dataset:
+                    for data in features_data.values():
+                        example_utils.ExampleFeatures._to_list(data)
+
+            def parse_numpy():
+                for record in iterate_tfrecord(tfrecord_file):
+                    parser.parse_numpy(record, selected_features=FEATURES)
+
+            def parse_dataset():
+                tf_utils.tf.reset_default_graph()
+                dataset_tensors = tf_utils.make_tfrecord_dataset(
+                    tfrecord_file, parser, selected_features=FEATURES, batch_size=64)
+                next_element = tf_utils.tf.data.make_one_shot_iterator(dataset_tensors).get_next()
+                with tf_utils.tf.Session() as session:
+                    try:
+                        while True:
+                            session.run(next_element)
+                    except tf_utils.tf.errors.OutOfRangeError:
+                        pass
+
+            def inspect_session_free():
+                tf_utils.inspect_tfrecord(tfrecord_file, 'image/filename', parser,
+                                          features=FEATURES[:2], session_free=True)
+
+            def inspect_session():
+                tf_utils.tf.reset_default_graph()
+                tf_utils.inspect_tfrecord(tfrecord_file, 'image/filename', parser,
+                                          features=FEATURES[:2])
+
+            benchmarks.update({
+                'to_list': to_list,
+                'encode_protobuf': lambda: [example_utils.build_example_from_data_dict(
+                    features_data) for features_data in dataset],
+                'parse_numpy': parse_numpy,
+                'parse_dataset': parse_dataset,
+                'inspect_tfrecord_session_free': inspect_session_free,
+                'inspect_tfrecord_session': inspect_session,
+            })
+
+        for benchmark_name, function in sorted(benchmarks.items()):
+            result = measure(function, num_records, num_bytes, repeats)
+            result.update({'benchmark': benchmark_name, 'size': size_name,
+                           'num_records': num_records, 'num_bytes': num_bytes})
+            results.append(result)
+            print('{:<32} {:<8} {:>12.1f} records/s {:>10.1f} MB/s {:>10.1f} MB peak'.format(
+                benchmark_name, size_name, result['records_per_second'],
+                result['mb_per_second'], result['peak_memory_bytes'] / 2 ** 20))
+
+    return results
+
+
+def compare_results(results, baseline_results, tolerance):
+    """
+    Compares results to a baseline run.
+    :param tolerance: Relative throughput loss that is reported as a regression.
+    :return: A list of `(benchmark, size, speedup)` tuples of regressed benchmarks.
+    """
+    baseline = {(result['benchmark'], result['size']): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        key = (result['benchmark'], result['size'])
+        if key not in baseline:
+            continue
+        speedup = result['records_per_second'] / baseline[key]['records_per_second']
+        print('{:<32} {:<8} {:>6.2f}x'.format(key[0], key[1], speedup))
+        if speedup < 1.0 - tolerance:
+            regressions.append((key[0], key[1], speedup))
+    return regressions
+
+
+def main():
+
+    args = Flags()
+    args.add_argument('--sizes', nargs='+', default=sorted(DATASET_SIZES),
+                      choices=sorted(DATASET_SIZES), help='Dataset sizes to benchmark.')
+    args.add_argument('--repeats', type=int, default=3, help='Runs per benchmark.')
+    args.add_argument('--output', default=None, help='Path of the JSON results file.')
+    args.add_argument('--baseline', default=None, help='JSON results file to compare to.')
+    args.add_argument('--tolerance', type=float, default=0.1,
+                      help='Relative throughput loss reported as a regression.')
+
+    work_dir = tempfile.mkdtemp(prefix='toolbox_bench_')
+    try:
+        results = run_benchmarks(args.sizes, args.repeats, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)['results']
+        regressions = compare_results(results, baseline_results, args.tolerance)
+        if regressions:
+            print('Regressions: {}'.format(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
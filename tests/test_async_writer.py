@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of `AsyncTFRecordWriter` against a temporary directory.
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from toolbox_az.tf_utils.async_writer import AsyncTFRecordWriter
+from toolbox_az.tf_utils.example_wire import decode_example, encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_io import iterate_tfrecord
+
+
+def _read_ids(tfrecord_file):
+
+    ids = []
+    for example_serialized in iterate_tfrecord(tfrecord_file, check_crc=True):
+        _, values = decode_example(example_serialized, {'id'})['id']
+        ids.append(int(values[0]))
+    return ids
+
+
+class AsyncTFRecordWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_file = os.path.join(self.temp_dir, 'data.tfrecord')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_writes_records_in_order(self):
+        async def write():
+            async with AsyncTFRecordWriter(self.tfrecord_file, max_queue_size=4,
+                                           max_append_bytes=64) as writer:
+                for index in range(100):
+                    await writer.write({'id': index})
+            return writer
+
+        writer = asyncio.run(write())
+        self.assertEqual(writer.num_records, 100)
+        self.assertEqual(_read_ids(self.tfrecord_file), list(range(100)))
+
+    def test_concurrent_first_writes_open_once(self):
+        async def write():
+            writer = AsyncTFRecordWriter(self.tfrecord_file, max_queue_size=4)
+            await asyncio.gather(*(writer.write({'id': index}) for index in range(5)))
+            await asyncio.wait_for(writer.close(), timeout=10)
+            return writer
+
+        writer = asyncio.run(write())
+        self.assertEqual(writer.num_records, 5)
+        self.assertEqual(sorted(_read_ids(self.tfrecord_file)), list(range(5)))
+
+    def test_flush_makes_records_readable(self):
+        async def write():
+            async with AsyncTFRecordWriter(self.tfrecord_file, fsync=True) as writer:
+                for index in range(10):
+                    await writer.write({'id': index})
+                await writer.flush()
+                return _read_ids(self.tfrecord_file)
+
+        self.assertEqual(asyncio.run(write()), list(range(10)))
+
+    def test_periodic_flush(self):
+        async def write():
+            async with AsyncTFRecordWriter(self.tfrecord_file, flush_interval=0.01) as writer:
+                await writer.write({'id': 7})
+                await asyncio.sleep(0.2)
+                return _read_ids(self.tfrecord_file)
+
+        self.assertEqual(asyncio.run(write()), [7])
+
+    def test_backpressure_bounds_the_queue(self):
+        async def write():
+            writer = AsyncTFRecordWriter(self.tfrecord_file, max_queue_size=2)
+            await writer.open()
+            max_queue_size = 0
+            for index in range(50):
+                await writer.write_serialized(encode_example_from_data_dict({'id': index}))
+                max_queue_size = max(max_queue_size, writer._queue.qsize())
+            await writer.close()
+            return max_queue_size
+
+        self.assertLessEqual(asyncio.run(write()), 2)
+        self.assertEqual(_read_ids(self.tfrecord_file), list(range(50)))
+
+    def test_write_after_close_raises(self):
+        async def write():
+            writer = AsyncTFRecordWriter(self.tfrecord_file)
+            await writer.write({'id': 1})
+            await writer.close()
+            await writer.write({'id': 2})
+
+        with self.assertRaises(ValueError):
+            asyncio.run(write())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of `LazyCheckpointTensors`, `inspect_ckpt` and `diff_ckpt`, on checkpoint readers that serve
+NumPy values.
+"""
+
+import math
+import re
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.checkpoint_utils import (LazyCheckpointTensors, _compare_tensors,
+                                                   diff_ckpt)
+from toolbox_az.tf_utils.tf_utils import inspect_ckpt
+
+
+class _DType(object):
+    """
+    The parts of `tf.DType` used by `LazyCheckpointTensors`.
+    """
+
+    def __init__(self, dtype):
+        self.as_numpy_dtype = dtype
+        self.is_numpy_compatible = True
+        self.size = np.dtype(dtype).itemsize
+
+    def __eq__(self, other):
+        return self.as_numpy_dtype == other.as_numpy_dtype
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class _CheckpointReader(object):
+    """
+    Serves NumPy values with the interface of `pywrap_tensorflow.NewCheckpointReader`.
+    """
+
+    def __init__(self, tensors):
+        self.tensors = tensors
+        self.read_names = []
+
+    def get_variable_to_shape_map(self):
+        return {name: list(value.shape) for name, value in self.tensors.items()}
+
+    def get_variable_to_dtype_map(self):
+        return {name: _DType(value.dtype.type) for name, value in self.tensors.items()}
+
+    def get_tensor(self, name):
+        self.read_names.append(name)
+        return self.tensors[name]
+
+
+TENSORS = {
+    'decoder/conv1/kernel': np.zeros(64, dtype=np.float32),
+    'decoder/conv1/bias': np.zeros(16, dtype=np.float32),
+    'encoder/conv1/kernel': np.zeros(32, dtype=np.float64),
+    'global_step': np.array(7, dtype=np.int64),
+}
+
+
+class LazyCheckpointTensorsTest(unittest.TestCase):
+
+    def test_reads_on_access(self):
+        reader = _CheckpointReader(TENSORS)
+        tensors = LazyCheckpointTensors(reader)
+        self.assertEqual(list(tensors), sorted(TENSORS))
+        self.assertEqual(tensors.shapes['decoder/conv1/kernel'], [64])
+        self.assertEqual(tensors.num_bytes('encoder/conv1/kernel'), 256)
+        self.assertEqual(reader.read_names, [])
+
+        self.assertEqual(tensors['global_step'], 7)
+        self.assertEqual(tensors['global_step'], 7)
+        self.assertEqual(reader.read_names, ['global_step'])
+        with self.assertRaises(KeyError):
+            tensors['missing']
+
+    def test_lru_eviction(self):
+        reader = _CheckpointReader(TENSORS)
+        tensors = LazyCheckpointTensors(reader, max_cached_bytes=320)
+        tensors['decoder/conv1/kernel']
+        tensors['decoder/conv1/bias']
+        self.assertEqual(tensors.cached_bytes, 320)
+
+        # Reading the kernel again makes the bias the least recently used value.
+        tensors['decoder/conv1/kernel']
+        tensors['global_step']
+        self.assertEqual(tensors.cached_bytes, 264)
+        tensors['decoder/conv1/kernel']
+        tensors['decoder/conv1/bias']
+        self.assertEqual(reader.read_names, ['decoder/conv1/kernel', 'decoder/conv1/bias',
+                                             'global_step', 'decoder/conv1/bias'])
+
+        # Values larger than the budget are never cached.
+        tensors = LazyCheckpointTensors(reader, max_cached_bytes=100)
+        tensors['decoder/conv1/kernel']
+        self.assertEqual(tensors.cached_bytes, 0)
+
+        tensors = LazyCheckpointTensors(reader, max_cached_bytes=0)
+        tensors['global_step']
+        self.assertEqual(tensors.cached_bytes, 0)
+
+    def test_name_filters(self):
+        reader = _CheckpointReader(TENSORS)
+        name_filters = [
+            ('decoder/*', ['decoder/conv1/bias', 'decoder/conv1/kernel']),
+            (re.compile(r'conv1/kernel$'), ['decoder/conv1/kernel', 'encoder/conv1/kernel']),
+            (['*/bias', re.compile('^global')], ['decoder/conv1/bias', 'global_step']),
+            (lambda name: name.startswith('enc'), ['encoder/conv1/kernel']),
+            ('missing', []),
+        ]
+        for name_filter, expected_names in name_filters:
+            self.assertEqual(list(LazyCheckpointTensors(reader, name_filter=name_filter)),
+                             expected_names, name_filter)
+
+
+class InspectCkptTest(unittest.TestCase):
+
+    def test_lazy(self):
+        reader = _CheckpointReader(TENSORS)
+        name_to_weight = inspect_ckpt(reader, name_filter='decoder/*')
+        self.assertIsInstance(name_to_weight, LazyCheckpointTensors)
+        self.assertEqual(list(name_to_weight), ['decoder/conv1/bias', 'decoder/conv1/kernel'])
+        self.assertEqual(reader.read_names, [])
+
+    def test_not_lazy(self):
+        reader = _CheckpointReader(TENSORS)
+        name_to_shape, name_to_weight = inspect_ckpt(reader, get_name_to_shape=True,
+                                                     name_filter='*/kernel', lazy=False)
+        self.assertIsInstance(name_to_weight, dict)
+        self.assertEqual(sorted(reader.read_names), ['decoder/conv1/kernel',
+                                                     'encoder/conv1/kernel'])
+        np.testing.assert_array_equal(name_to_weight['encoder/conv1/kernel'],
+                                      TENSORS['encoder/conv1/kernel'])
+        self.assertEqual(name_to_shape, {'decoder/conv1/kernel': [64],
+                                         'encoder/conv1/kernel': [32]})
+
+    def test_shapes_only(self):
+        reader = _CheckpointReader(TENSORS)
+        self.assertEqual(inspect_ckpt(reader, get_name_to_weight=False, get_name_to_shape=True,
+                                      name_filter='global_step'), {'global_step': []})
+        self.assertEqual(reader.read_names, [])
+
+
+class CompareTensorsTest(unittest.TestCase):
+
+    def test_equal_tensors(self):
+        stats = _compare_tensors(np.arange(10, dtype=np.float32),
+                                 np.arange(10, dtype=np.float32), chunk_size=3)
+        self.assertEqual(stats['max_abs_diff'], 0.0)
+        self.assertEqual(stats['relative_l2_diff'], 0.0)
+        self.assertAlmostEqual(stats['cosine_distance'], 0.0)
+        self.assertEqual(stats['num_nan'], 0)
+
+    def test_max_abs_diff_over_chunks(self):
+        stats = _compare_tensors(np.array([1.0, 2.0, 3.0, 4.0]), np.array([1.0, 2.0, 3.0, 1.5]),
+                                 chunk_size=2)
+        self.assertEqual(stats['max_abs_diff'], 2.5)
+        self.assertEqual(stats['num_nan'], 0)
+
+    def test_nan_is_not_hidden(self):
+        for chunk_size in (1, 2, 8):
+            stats = _compare_tensors(np.array([np.nan, 1.0]), np.array([5.0, 1.0]), chunk_size)
+            self.assertTrue(math.isnan(stats['max_abs_diff']), chunk_size)
+            self.assertTrue(math.isnan(stats['relative_l2_diff']), chunk_size)
+            self.assertTrue(math.isnan(stats['cosine_distance']), chunk_size)
+            self.assertEqual(stats['num_nan'], 1)
+
+    def test_nan_in_both_tensors_is_counted_once(self):
+        stats = _compare_tensors(np.array([np.nan, np.nan, 0.0]), np.array([np.nan, 1.0, 0.0]),
+                                 chunk_size=2)
+        self.assertEqual(stats['num_nan'], 2)
+
+    def test_non_numeric_tensors(self):
+        self.assertEqual(_compare_tensors(np.array([b'a']), np.array([b'a']), 4), {'equal': True})
+        self.assertEqual(_compare_tensors(np.array([b'a']), np.array([b'b']), 4),
+                         {'equal': False})
+
+    def test_complex_tensors(self):
+        value_a = np.array([1 + 1j, 2 - 3j], dtype=np.complex64)
+        stats = _compare_tensors(value_a, value_a, chunk_size=1)
+        self.assertEqual((stats['max_abs_diff'], stats['relative_l2_diff']), (0.0, 0.0))
+        self.assertAlmostEqual(stats['cosine_distance'], 0.0)
+
+        # Tensors that differ only in their imaginary part are not equal.
+        stats = _compare_tensors(value_a, np.array([1 - 1j, 2 - 3j]), chunk_size=1)
+        self.assertAlmostEqual(stats['max_abs_diff'], 2.0)
+        self.assertAlmostEqual(stats['relative_l2_diff'], 2.0 / np.sqrt(15.0))
+        self.assertAlmostEqual(stats['cosine_distance'], 2.0 / 15.0)
+
+        stats = _compare_tensors(np.array([1j, 1.0]), np.array([0.0, 1.0]), chunk_size=4)
+        self.assertEqual(stats['max_abs_diff'], 1.0)
+
+    def test_complex_nan(self):
+        stats = _compare_tensors(np.array([complex(0, np.nan)]), np.array([0j]), chunk_size=1)
+        self.assertEqual(stats['num_nan'], 1)
+        self.assertTrue(math.isnan(stats['relative_l2_diff']))
+
+
+class DiffCkptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader_a = _CheckpointReader({
+            'kept': np.arange(6, dtype=np.float32),
+            'changed': np.zeros(4, dtype=np.float32),
+            'removed': np.ones(2, dtype=np.float32),
+            'reshaped': np.zeros((2, 3), dtype=np.float32),
+            'step': np.array(1, dtype=np.int32),
+        })
+        self.reader_b = _CheckpointReader({
+            'kept': np.arange(6, dtype=np.float32),
+            'changed': np.array([0.0, 0.0, 0.0, 3.0], dtype=np.float32),
+            'added': np.ones(2, dtype=np.float32),
+            'reshaped': np.zeros((3, 2), dtype=np.float32),
+            'step': np.array(1, dtype=np.int64),
+        })
+
+    def test_diff(self):
+        diff = diff_ckpt(self.reader_a, self.reader_b, chunk_size=3)
+        self.assertEqual(diff['added'], ['added'])
+        self.assertEqual(diff['removed'], ['removed'])
+        self.assertEqual(diff['changed_type'], ['step'])
+        self.assertEqual(diff['reshaped'], {'reshaped': ([2, 3], [3, 2])})
+
+        self.assertEqual(sorted(diff['tensors']), ['changed', 'kept', 'step'])
+        self.assertEqual(diff['tensors']['kept']['max_abs_diff'], 0.0)
+        self.assertEqual(diff['tensors']['changed']['max_abs_diff'], 3.0)
+        self.assertEqual(diff['tensors']['changed']['relative_l2_diff'], float('inf'))
+        self.assertEqual(diff['tensors']['step']['max_abs_diff'], 0.0)
+
+        # Reshaped tensors are not read.
+        self.assertNotIn('reshaped', self.reader_a.read_names + self.reader_b.read_names)
+
+    def test_threads_match_calling_thread(self):
+        diff = diff_ckpt(self.reader_a, self.reader_b, chunk_size=3)
+        self.assertEqual(diff_ckpt(self.reader_a, self.reader_b, num_threads=3, chunk_size=3),
+                         diff)
+
+    def test_name_filter(self):
+        diff = diff_ckpt(self.reader_a, self.reader_b, name_filter=['k*', 'added'])
+        self.assertEqual((diff['added'], diff['removed']), (['added'], []))
+        self.assertEqual(list(diff['tensors']), ['kept'])
+
+
+if __name__ == '__main__':
+    unittest.main()
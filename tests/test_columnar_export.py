@@ -0,0 +1,135 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the columnar export of `columnar_export`. Features of post parsing processes need no
+parse config, so most tests export them and run without TensorFlow.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.columnar_export import (MANIFEST_FILE, BytesColumn,
+                                                 export_tfrecord_to_columns, load_columns)
+from toolbox_az.tf_utils.example_utils import ExampleParser, ParseConfigFeatures
+from toolbox_az.tf_utils.example_wire import encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+class _RecordCounter(object):
+    """
+    A post parsing process whose value is made by a function of the number of parsed records.
+    """
+
+    def __init__(self, feature_name, make_value):
+        self.feature_name = feature_name
+        self.make_value = make_value
+        self.num_records = 0
+
+    def __call__(self, features):
+        features[self.feature_name] = self.make_value(self.num_records)
+        self.num_records += 1
+
+
+class _CounterFeatures(object):
+
+    def __init__(self, **make_values):
+        self.features_map = {feature_name: {} for feature_name in make_values}
+        self.post_parsing_process = {feature_name: _RecordCounter(feature_name, make_value)
+                                     for feature_name, make_value in make_values.items()}
+
+
+class ColumnarExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.temp_dir, 'columns')
+        self.tfrecord_files = [os.path.join(self.temp_dir, '{}.tfrecord'.format(index))
+                               for index in range(2)]
+        for tfrecord_file, ids in zip(self.tfrecord_files, [range(3), range(3, 5)]):
+            with TFRecordFileWriter(tfrecord_file) as writer:
+                for record_id in ids:
+                    writer.write(encode_example_from_data_dict({
+                        'id': np.int64(record_id),
+                        'ids': np.arange(record_id, dtype=np.int64)}))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+class ColumnarExportTest(ColumnarExportTestCase):
+
+    def test_fixed_and_bytes_columns(self):
+        parser = ExampleParser(_CounterFeatures(
+            square=lambda index: np.full((2, 3), index, dtype=np.float32),
+            scalar=lambda index: np.int64(index),
+            name=lambda index: 'record {}'.format(index).encode('utf-8'),
+            names=lambda index: np.array([b'a' * index, b'b'], dtype=object)))
+        manifest = export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir)
+        self.assertEqual(manifest['num_records'], 5)
+
+        columns = load_columns(self.output_dir)
+        self.assertEqual(sorted(columns), ['name', 'names', 'scalar', 'square'])
+        self.assertEqual(columns['square'].shape, (5, 2, 3))
+        np.testing.assert_array_equal(columns['square'][:, 0, 0], np.arange(5))
+        np.testing.assert_array_equal(columns['scalar'], np.arange(5))
+
+        self.assertIsInstance(columns['name'], BytesColumn)
+        self.assertEqual(columns['name'][4], b'record 4')
+        self.assertEqual(columns['names'][3], [b'aaa', b'b'])
+        np.testing.assert_array_equal(columns['names'].lengths, [2] * 5)
+
+    def test_single_feature_name(self):
+        parser = ExampleParser(_CounterFeatures(
+            scalar=lambda index: np.int64(index), other=lambda index: np.int64(-index)))
+        manifest = export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir,
+                                              selected_features='scalar')
+        self.assertEqual(list(manifest['columns']), ['scalar'])
+        np.testing.assert_array_equal(load_columns(self.output_dir)['scalar'], np.arange(5))
+
+    def test_changed_shape_fails_without_manifest(self):
+        parser = ExampleParser(_CounterFeatures(
+            grows=lambda index: np.zeros(1 + index // 3, dtype=np.float32)))
+        with self.assertRaisesRegex(ValueError, r"'grows' of record 3 has shape \[2\]"):
+            export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, MANIFEST_FILE)))
+
+    def test_changed_bytes_shape_fails(self):
+        parser = ExampleParser(_CounterFeatures(
+            names=lambda index: [b'a'] * (1 + index // 3)))
+        with self.assertRaisesRegex(ValueError, r"'names' of record 3 has shape \[2\]"):
+            export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir)
+
+        parser = ExampleParser(_CounterFeatures(
+            name=lambda index: b'a' if index < 2 else [b'a', b'b']))
+        with self.assertRaisesRegex(ValueError, r"'name' of record 2 has shape \[2\]"):
+            export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class ParsedColumnsTest(ColumnarExportTestCase):
+
+    def test_parsed_and_ragged_columns(self):
+        features = _CounterFeatures()
+        features.features_map.update({
+            'id': ParseConfigFeatures.int64_feature(),
+            'ids': ParseConfigFeatures.int64_feature(variable_len=True),
+        })
+        parser = ExampleParser(features)
+        export_tfrecord_to_columns(self.tfrecord_files, parser, self.output_dir)
+
+        columns = load_columns(self.output_dir)
+        np.testing.assert_array_equal(columns['id'], np.arange(5))
+        np.testing.assert_array_equal(columns['ids'].lengths, np.arange(5))
+        np.testing.assert_array_equal(columns['ids'][4], np.arange(4))
+
+
+if __name__ == '__main__':
+    unittest.main()
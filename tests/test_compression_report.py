@@ -0,0 +1,89 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the codec comparison of `compression_report` on small uncompressed, GZIP and ZLIB
+fixtures.
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from toolbox_az.tf_utils.compression_report import (compression_report,
+                                                    format_compression_report, sample_records)
+from toolbox_az.tf_utils.tfrecord_io import (GZIP_COMPRESSION, NO_COMPRESSION, ZLIB_COMPRESSION,
+                                             TFRecordFileWriter, frame_record)
+
+RECORDS = [('record {:03d} '.format(index) * (index % 7 + 1)).encode('utf-8')
+           for index in range(50)]
+
+CODECS = ((NO_COMPRESSION, None), (ZLIB_COMPRESSION, 6), (GZIP_COMPRESSION, 9))
+
+
+class CompressionReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_files = {}
+        for compression_type in (NO_COMPRESSION, ZLIB_COMPRESSION, GZIP_COMPRESSION):
+            tfrecord_file = os.path.join(self.temp_dir, 'data-{}.tfrecord'.format(
+                compression_type or 'none'))
+            with TFRecordFileWriter(tfrecord_file, compression_type=compression_type) as writer:
+                for record in RECORDS:
+                    writer.write(record)
+            self.tfrecord_files[compression_type] = tfrecord_file
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_reported_sizes(self):
+        framed_records = b''.join(frame_record(record) for record in RECORDS)
+        with open(self.tfrecord_files[NO_COMPRESSION], 'rb') as tfrecord_file:
+            self.assertEqual(tfrecord_file.read(), framed_records)
+
+        expected_sizes = {
+            NO_COMPRESSION: len(framed_records),
+            ZLIB_COMPRESSION: len(zlib.compress(framed_records, 6)),
+            GZIP_COMPRESSION: len(gzip.compress(framed_records, compresslevel=9, mtime=0)),
+        }
+
+        # The sample is the same whatever the compression of the fixture.
+        for compression_type, tfrecord_file in self.tfrecord_files.items():
+            report = compression_report(tfrecord_file, codecs=CODECS, repeats=1,
+                                        compression_type=compression_type)
+            self.assertEqual([codec['compression_type'] for codec in report],
+                             [codec_type for codec_type, _ in CODECS])
+            for codec in report:
+                self.assertEqual(codec['num_records'], len(RECORDS))
+                self.assertEqual(codec['uncompressed_bytes'], len(framed_records))
+                self.assertEqual(codec['compressed_bytes'],
+                                 expected_sizes[codec['compression_type']])
+                self.assertAlmostEqual(codec['ratio'],
+                                       len(framed_records) / codec['compressed_bytes'])
+                self.assertGreater(codec['decode_mb_per_s'], 0)
+
+            self.assertEqual(report[0]['ratio'], 1.0)
+            self.assertIsNone(report[0]['encode_mb_per_s'])
+            self.assertGreater(report[1]['ratio'], 1.0)
+
+        self.assertEqual(len(format_compression_report(report).splitlines()), len(CODECS) + 1)
+
+    def test_sample(self):
+        sample = sample_records(self.tfrecord_files[GZIP_COMPRESSION], num_records=10,
+                                compression_type=GZIP_COMPRESSION)
+        self.assertEqual(len(sample), 10)
+        # The sample keeps the file order.
+        self.assertEqual(sample, [record for record in RECORDS if record in sample])
+        self.assertEqual(sample, sample_records(self.tfrecord_files[NO_COMPRESSION],
+                                                num_records=10))
+
+        report = compression_report(self.tfrecord_files[NO_COMPRESSION], num_records=10,
+                                    codecs=CODECS[:1], repeats=1)
+        self.assertEqual(report[0]['uncompressed_bytes'],
+                         sum(len(frame_record(record)) for record in sample))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the CRC32-C implementations of `tfrecord_io` against the table based reference.
+"""
+
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils import tfrecord_io
+from toolbox_az.tf_utils.tfrecord_io import (_CRC32C_MAX_LANE_LENGTH, _CRC32C_NUMPY_MIN_LENGTH,
+                                             _crc32c_fallback, _crc32c_numpy, _crc32c_python)
+
+# Lengths around the lane and vectorization thresholds, including non-multiples of them.
+LENGTHS = sorted({0, 1, 2, 3, 4, 5, 31, 32, 33, 255, 256, 257, 1000,
+                  _CRC32C_NUMPY_MIN_LENGTH - 1, _CRC32C_NUMPY_MIN_LENGTH,
+                  _CRC32C_NUMPY_MIN_LENGTH + 1, _CRC32C_MAX_LANE_LENGTH ** 2 + 7, 100003})
+
+
+class Crc32cTest(unittest.TestCase):
+
+    def test_known_vector(self):
+        for crc32c in (_crc32c_python, _crc32c_numpy, _crc32c_fallback, tfrecord_io.crc32c):
+            self.assertEqual(crc32c(b'123456789'), 0xE3069283, crc32c)
+
+    def test_empty_input(self):
+        for crc32c in (_crc32c_python, _crc32c_numpy, _crc32c_fallback):
+            self.assertEqual(crc32c(b''), 0, crc32c)
+
+    def test_vectorized_matches_reference(self):
+        random_state = np.random.RandomState(0)
+        for length in LENGTHS:
+            for _ in range(3):
+                data = random_state.randint(0, 256, size=length, dtype=np.uint8).tobytes()
+                expected = _crc32c_python(data)
+                self.assertEqual(_crc32c_numpy(data), expected, length)
+                self.assertEqual(_crc32c_fallback(data), expected, length)
+
+    def test_vectorized_matches_reference_on_zeros_and_ones(self):
+        for length in LENGTHS:
+            for fill in (b'\x00', b'\xff'):
+                data = fill * length
+                self.assertEqual(_crc32c_numpy(data), _crc32c_python(data), (length, fill))
+
+    def test_accepts_memoryviews(self):
+        data = bytes(range(256)) * 20
+        self.assertEqual(_crc32c_numpy(memoryview(data)[3:]), _crc32c_python(data[3:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
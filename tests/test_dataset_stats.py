@@ -0,0 +1,121 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the one-pass statistics of `dataset_stats`. Reading the schema of an `ExampleFeatures`
+needs TensorFlow, the statistics themselves are tested on schema kinds without it.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.dataset_stats import (BYTES_KIND, FLOAT_KIND, INT64_KIND, _ShardStats,
+                                               dataset_stats)
+from toolbox_az.tf_utils.example_utils import ParseConfigFeatures
+from toolbox_az.tf_utils.example_wire import (encode_bytes_feature, encode_example,
+                                              encode_example_from_data_dict)
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+SCHEMA_KINDS = {'height': INT64_KIND, 'score': FLOAT_KIND, 'label': BYTES_KIND,
+                'missing': INT64_KIND}
+
+
+def _record(index):
+
+    return encode_example_from_data_dict({
+        'height': np.int64(10 * index),
+        'score': np.array([index, -index], dtype=np.float32),
+        'label': 'even' if index % 2 == 0 else 'odd',
+        'image/encoded': 'image {}'.format(index % 3),
+    })
+
+
+def _shard_stats(records, duplicate_feature='image/encoded', max_distinct_values=100):
+
+    shard_stats = _ShardStats(SCHEMA_KINDS, duplicate_feature, max_top_k_length=8,
+                              max_distinct_values=max_distinct_values)
+    for record in records:
+        shard_stats.update(record)
+    return shard_stats
+
+
+class ShardStatsTest(unittest.TestCase):
+
+    def test_feature_statistics(self):
+        summary = _shard_stats([_record(index) for index in range(6)]).summary(top_k=1)
+        self.assertEqual(summary['num_records'], 6)
+
+        height = summary['features']['height']
+        self.assertEqual((height['min'], height['max'], height['mean']), (0, 50, 25.0))
+        self.assertEqual(height['value_counts'], {1: 6})
+
+        score = summary['features']['score']
+        self.assertEqual((score['min'], score['max'], score['mean']), (-5.0, 5.0, 0.0))
+        self.assertEqual(score['num_values'], 12)
+
+        label = summary['features']['label']
+        self.assertEqual(label['length']['min'], 3)
+        self.assertEqual(label['length']['max'], 4)
+        self.assertEqual(label['top_values'], [(b'even', 3)])
+
+        missing = summary['features']['missing']
+        self.assertEqual((missing['num_present'], missing['presence_rate']), (0, 0.0))
+
+        self.assertEqual(summary['duplicates'], {
+            'feature': 'image/encoded', 'num_hashed': 6, 'num_unique': 3, 'num_duplicates': 3,
+            'num_duplicate_groups': 3})
+
+    def test_merge_matches_single_pass(self):
+        records = [_record(index) for index in range(7)]
+        merged = _shard_stats(records[:3])
+        merged.merge(_shard_stats(records[3:]))
+        self.assertEqual(merged.summary(top_k=2), _shard_stats(records).summary(top_k=2))
+
+    def test_split_values_do_not_collide(self):
+        records = [encode_example({'image/encoded': encode_bytes_feature(values)})
+                   for values in ([b'ab', b'c'], [b'a', b'bc'], [b'abc'], [b'abc', b''])]
+        duplicates = _shard_stats(records).summary(top_k=1)['duplicates']
+        self.assertEqual((duplicates['num_unique'], duplicates['num_duplicates']), (4, 0))
+
+    def test_many_distinct_values_are_not_counted(self):
+        records = [encode_example_from_data_dict({'label': str(index)}) for index in range(5)]
+        summary = _shard_stats(records, max_distinct_values=3).summary(top_k=1)
+        self.assertIsNone(summary['features']['label']['top_values'])
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class DatasetStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for shard_index in range(3):
+            with TFRecordFileWriter(os.path.join(
+                    self.temp_dir, 'data-{}.tfrecord'.format(shard_index))) as writer:
+                for index in range(shard_index * 4, shard_index * 4 + 4):
+                    writer.write(_record(index))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_workers_match_calling_process(self):
+        class Features(object):
+            features_map = {'height': ParseConfigFeatures.int64_feature(),
+                            'label': ParseConfigFeatures.string_feature()}
+
+        pattern = os.path.join(self.temp_dir, 'data-*.tfrecord')
+        stats = dataset_stats(pattern, Features(), num_workers=0)
+        self.assertEqual((stats['num_shards'], stats['num_records']), (3, 12))
+        self.assertEqual(stats['features']['height']['max'], 110)
+        self.assertEqual(stats['duplicates']['num_unique'], 3)
+        self.assertEqual(dataset_stats(pattern, Features(), num_workers=2), stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
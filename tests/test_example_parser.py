@@ -0,0 +1,202 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the compiled parse plans of `ExampleParser` and of the batched and NumPy parsing that
+use them.
+"""
+
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_utils import (DICT_LAYOUT, LIST_LAYOUT, ExampleParser,
+                                               ParseConfigFeatures, _feature_values_to_numpy)
+from toolbox_az.tf_utils.example_wire import (encode_bytes_feature, encode_example,
+                                              encode_float_feature, encode_int64_feature)
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+class _Features(object):
+
+    def __init__(self):
+        # Parse configs are only passed through by the plans, so any value will do.
+        self.features_map = {'a': 'config_a', 'b': 'config_b', 'c': 'config_c'}
+        self.post_parsing_process = {}
+
+
+class ParsePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ExampleParser(_Features())
+
+    def test_dict_plan_follows_selection_order(self):
+        first = self.parser.get_plan(['a', 'b', 'c'], return_as_dict=True)
+        second = self.parser.get_plan(['c', 'a', 'b'], return_as_dict=True)
+
+        self.assertEqual(first.layout, DICT_LAYOUT)
+        self.assertEqual(first.output_features, ('a', 'b', 'c'))
+        self.assertEqual(second.output_features, ('c', 'a', 'b'))
+
+    def test_list_plan_keeps_duplicates(self):
+        plan = self.parser.get_plan(['b', 'a', 'b'])
+        self.assertEqual(plan.layout, LIST_LAYOUT)
+        self.assertEqual(plan.output_features, ('b', 'a', 'b'))
+        self.assertEqual(dict(plan.features_to_parse), {'a': 'config_a', 'b': 'config_b'})
+
+    def test_cache(self):
+        self.parser.get_plan(['a', 'b'], return_as_dict=True)
+        self.parser.get_plan(('a', 'b'), return_as_dict=True)
+        self.parser.get_plan(['b', 'a'], return_as_dict=True)
+        self.parser.get_plan(['a', 'b'])
+
+        cache_info = self.parser.plan_cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses, cache_info.currsize), (1, 3, 3))
+
+        self.parser.clear_plan_cache()
+        self.assertEqual(self.parser.plan_cache_info().currsize, 0)
+
+    def test_cache_eviction(self):
+        parser = ExampleParser(_Features(), plan_cache_size=2)
+        for selected_features in ('a', 'b', 'c', 'a'):
+            parser.get_plan(selected_features)
+
+        cache_info = parser.plan_cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses, cache_info.currsize), (0, 4, 2))
+
+
+class _BatchFeatures(object):
+
+    def __init__(self):
+        self.features_map = {
+            'id': ParseConfigFeatures.int64_feature(),
+            'score': ParseConfigFeatures.float32_feature(array_shape=[2]),
+            'ids': ParseConfigFeatures.int64_feature(variable_len=True),
+            'names': ParseConfigFeatures.string_feature(variable_len=True),
+            'batch_size': {'id': ParseConfigFeatures.int64_feature()},
+        }
+        self.post_parsing_process = {'batch_size': self.set_batch_size}
+
+    @staticmethod
+    def set_batch_size(features):
+        features['batch_size'] = tf.shape(features['id'])[0]
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class ParseBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self.parser = ExampleParser(_BatchFeatures())
+        self.batch = tf.constant([encode_example({
+            'id': encode_int64_feature(index),
+            'score': encode_float_feature([index, -index]),
+            'ids': encode_int64_feature(np.arange(index)),
+            'names': encode_bytes_feature([b'name'] * index),
+        }) for index in range(3)])
+
+    def _evaluate(self, tensors):
+
+        with tf.Session() as session:
+            return session.run(tensors)
+
+    def test_single_layout(self):
+        np.testing.assert_array_equal(self._evaluate(self.parser.parse_batch(self.batch, 'id')),
+                                      [0, 1, 2])
+
+    def test_dict_layout(self):
+        features = self._evaluate(self.parser.parse_batch(
+            self.batch, ['score', 'id', 'batch_size'], return_as_dict=True))
+        self.assertEqual(list(features), ['score', 'id', 'batch_size'])
+        np.testing.assert_array_equal(features['score'], [[0, 0], [1, -1], [2, -2]])
+        np.testing.assert_array_equal(features['id'], [0, 1, 2])
+        self.assertEqual(features['batch_size'], 3)
+
+    def test_list_layout(self):
+        score, ids = self._evaluate(self.parser.parse_batch(self.batch, ['score', 'ids']))
+        self.assertEqual(score.shape, (3, 2))
+        self.assertIsInstance(ids, tf.SparseTensorValue)
+        np.testing.assert_array_equal(ids.dense_shape, [3, 2])
+        np.testing.assert_array_equal(ids.values, [0, 0, 1])
+
+    def test_varlen_as_dense(self):
+        ids, names = self._evaluate(self.parser.parse_batch(
+            self.batch, ['ids', 'names'], varlen_as_dense=True))
+        np.testing.assert_array_equal(ids, [[0, 0], [0, 0], [0, 1]])
+        self.assertEqual(names.tolist(), [[b'', b''], [b'name', b''], [b'name', b'name']])
+
+
+class _DefaultFeatures(object):
+
+    def __init__(self):
+        self.features_map = {
+            'id': ParseConfigFeatures.int64_feature(),
+            'score': ParseConfigFeatures.float32_feature(array_shape=[2]),
+            'label': tf.FixedLenFeature([], tf.string, default_value='none'),
+            'counts': tf.FixedLenFeature([3], tf.int64, default_value=-1),
+            'pair': tf.FixedLenFeature([2], tf.float32, default_value=[0.5, 1.5]),
+            'ids': ParseConfigFeatures.int64_feature(variable_len=True),
+        }
+        self.post_parsing_process = {}
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class ParseNumpyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ExampleParser(_DefaultFeatures())
+        self.example_serialized = encode_example({
+            'id': encode_int64_feature(7),
+            'score': encode_float_feature([0.25, -1.0]),
+        })
+
+    def test_present_values(self):
+        features = self.parser.parse_numpy(self.example_serialized, ['id', 'score'],
+                                           return_as_dict=True)
+        self.assertIsInstance(features['id'], np.int64)
+        self.assertEqual(features['id'], 7)
+        np.testing.assert_array_equal(features['score'], np.array([0.25, -1.0], np.float32))
+
+    def test_default_values(self):
+        label, counts, pair, ids = self.parser.parse_numpy(
+            self.example_serialized, ['label', 'counts', 'pair', 'ids'])
+        self.assertEqual(label, b'none')
+        np.testing.assert_array_equal(counts, [-1, -1, -1])
+        self.assertEqual(counts.dtype, np.int64)
+        np.testing.assert_array_equal(pair, np.array([0.5, 1.5], np.float32))
+        self.assertEqual((ids.dtype, ids.shape), (np.int64, (0,)))
+
+    def test_defaults_match_graph_parsing(self):
+        selected_features = ['label', 'counts', 'pair']
+        tf.reset_default_graph()
+        tensors = self.parser.parse(tf.constant(self.example_serialized), selected_features)
+        with tf.Session() as session:
+            expected = session.run(tensors)
+        for value, expected_value in zip(
+                self.parser.parse_numpy(self.example_serialized, selected_features), expected):
+            np.testing.assert_array_equal(value, expected_value)
+
+    def test_missing_required_feature(self):
+        example_serialized = encode_example({'score': encode_float_feature([0.0, 0.0])})
+        with self.assertRaisesRegex(ValueError, 'Feature id is required'):
+            self.parser.parse_numpy(example_serialized, 'id')
+
+        # An empty list is missing too.
+        example_serialized = encode_example({'id': encode_int64_feature([])})
+        with self.assertRaisesRegex(ValueError, 'Feature id is required'):
+            self.parser.parse_numpy(example_serialized, 'id')
+
+    def test_fixed_shape_mismatch(self):
+        example_serialized = encode_example({'score': encode_float_feature([1.0, 2.0, 3.0])})
+        with self.assertRaisesRegex(ValueError, r'score has 3 values, expected shape \[2\]'):
+            self.parser.parse_numpy(example_serialized, 'score')
+
+        with self.assertRaisesRegex(ValueError, r'pair has 3 values, expected shape \[2\]'):
+            _feature_values_to_numpy('pair', None, tf.FixedLenFeature(
+                [2], tf.float32, default_value=[1.0, 2.0, 3.0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the direct wire encoder and decoder of `example_wire`. The decoder is tested against the
+encoded data and hand built wire messages, and both are cross-checked against protobuf
+serialization of `tf.train.Example` when TensorFlow is installed.
+"""
+
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_wire import (decode_example, encode_example_from_data_dict,
+                                              encode_varint)
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+FEATURES_DATA = {
+    'int/scalar': np.int64(7),
+    'int/negative': np.array([-1, -2 ** 63, 2 ** 63 - 1, 0, 300], dtype=np.int64),
+    'int/python': -42,
+    'int/empty': np.zeros(0, dtype=np.int64),
+    'float/scalar': np.float32(0.25),
+    'float/list': np.array([1.5, -2.0, 1e-30, np.inf], dtype=np.float32),
+    'float/python': -3.5,
+    'float/empty': np.zeros(0, dtype=np.float32),
+    'bytes/scalar': b'value',
+    'bytes/nul': b'terminated\x00',
+    'bytes/empty': b'',
+    'bytes/str': 'unicode א',
+    'bytes/raw': np.frombuffer(b'\x00\x01\x02\x00', dtype=np.uint8),
+}
+
+# Keys where one is a prefix of another. Protobuf implementations do not agree on their order.
+PREFIX_FEATURES_DATA = {
+    'k10': np.int64(10),
+    'k1': np.int64(1),
+    'k': b'k',
+    'k2': np.float32(2.0),
+    'k1/a': b'a',
+    'é': b'non ascii',
+}
+
+
+def _to_tf_feature(data):
+
+    if isinstance(data, str):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[data.encode('utf-8')]))
+    if isinstance(data, bytes):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[data]))
+    if isinstance(data, np.ndarray) and data.dtype == np.uint8:
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[data.tobytes()]))
+    if isinstance(data, float):
+        return tf.train.Feature(float_list=tf.train.FloatList(value=[data]))
+    if isinstance(data, (int, np.int64)) or data.dtype == np.int64:
+        return tf.train.Feature(int64_list=tf.train.Int64List(
+            value=np.atleast_1d(data).tolist()))
+    return tf.train.Feature(float_list=tf.train.FloatList(value=np.atleast_1d(data).tolist()))
+
+
+def _to_tf_example(features_data):
+
+    return tf.train.Example(features=tf.train.Features(feature={
+        feature_name: _to_tf_feature(data) for feature_name, data in features_data.items()}))
+
+
+def _field(number, wire_type, payload):
+    """
+    Encodes a field by hand, so unpacked lists and unusual field orders can be built.
+    """
+    key = encode_varint((number << 3) | wire_type)
+    if wire_type == 2:
+        return key + encode_varint(len(payload)) + payload
+    return key + payload
+
+
+class MapOrderTest(unittest.TestCase):
+
+    def test_prefix_sharing_keys_are_byte_sorted(self):
+        example_serialized = encode_example_from_data_dict(PREFIX_FEATURES_DATA)
+        expected_keys = sorted(PREFIX_FEATURES_DATA, key=lambda key: key.encode('utf-8'))
+        self.assertEqual(expected_keys, ['k', 'k1', 'k1/a', 'k10', 'k2', 'é'])
+
+        # The decoder returns the features in their order on the wire.
+        self.assertEqual(list(decode_example(example_serialized)), expected_keys)
+
+    def test_prefix_sharing_keys_bytes(self):
+        features = [
+            (b'k', _field(1, 2, _field(1, 2, b'k'))),
+            (b'k1', _field(3, 2, _field(1, 2, encode_varint(1)))),
+            (b'k10', _field(3, 2, _field(1, 2, encode_varint(10)))),
+            (b'k2', _field(2, 2, _field(1, 2, np.float32(2.0).tobytes()))),
+        ]
+        expected = _field(1, 2, b''.join(
+            _field(1, 2, _field(1, 2, key) + _field(2, 2, feature)) for key, feature in features))
+
+        features_data = {key: PREFIX_FEATURES_DATA[key] for key in ['k2', 'k10', 'k1', 'k']}
+        self.assertEqual(encode_example_from_data_dict(features_data), expected)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class EncoderTest(unittest.TestCase):
+
+    def test_matches_protobuf_serialization(self):
+        # No key of `FEATURES_DATA` is a prefix of another, so every protobuf implementation
+        # writes the map in byte-sorted key order.
+        expected = _to_tf_example(FEATURES_DATA).SerializeToString(deterministic=True)
+        self.assertEqual(encode_example_from_data_dict(FEATURES_DATA), expected)
+
+    def test_parses_with_protobuf(self):
+        # Protobuf implementations do not agree on the position of an empty key, only the parsed
+        # Example is compared.
+        features_data = dict(FEATURES_DATA, **{'': b'empty key'})
+        example = tf.train.Example.FromString(encode_example_from_data_dict(features_data))
+        self.assertEqual(example, _to_tf_example(features_data))
+
+    def test_prefix_sharing_keys_parse_with_protobuf(self):
+        example = tf.train.Example.FromString(
+            encode_example_from_data_dict(PREFIX_FEATURES_DATA))
+        self.assertEqual(example, _to_tf_example(PREFIX_FEATURES_DATA))
+
+    def test_produce_example_is_protobuf_serialization(self):
+        from toolbox_az.tf_utils.example_utils import ExampleProducer
+
+        producer = ExampleProducer()
+        producer.add_int_feature([5, -5], 'k1')
+        producer.add_float_feature(0.5, 'k10')
+        producer.add_bytes_feature(b'nul\x00', 'a/bytes')
+        producer.add_int_feature([], 'd/empty')
+
+        expected = tf.train.Example(features=tf.train.Features(feature=producer.features))
+        self.assertEqual(producer.produce_example(), expected.SerializeToString())
+        self.assertEqual(tf.train.Example.FromString(producer.produce_example()), expected)
+
+
+def _expected_feature(data):
+    """
+    :return: The `(kind, values)` that `decode_example` returns for an encoded data value, with
+    the values as a list.
+    """
+    if isinstance(data, str):
+        return 'bytes_list', [data.encode('utf-8')]
+    if isinstance(data, bytes):
+        return 'bytes_list', [data]
+    if isinstance(data, np.ndarray) and data.dtype == np.uint8:
+        return 'bytes_list', [data.tobytes()]
+    if isinstance(data, (int, np.int64)) or \
+            (isinstance(data, np.ndarray) and data.dtype == np.int64):
+        return 'int64_list', np.atleast_1d(data).tolist()
+    return 'float_list', np.atleast_1d(np.float32(data)).tolist()
+
+
+def _decoded_lists(decoded):
+
+    return {feature_name: (kind, [bytes(value) for value in values] if kind == 'bytes_list'
+                           else values.tolist())
+            for feature_name, (kind, values) in decoded.items()}
+
+
+def _hand_built_example(features):
+    """
+    Encodes an Example of `(key, feature)` pairs, with features encoded by `_field`.
+    """
+    return _field(1, 2, b''.join(_field(1, 2, _field(1, 2, key) + _field(2, 2, feature))
+                                 for key, feature in features))
+
+
+# Hand built Examples and the features they decode to.
+_UNPACKED_LISTS = (
+    _hand_built_example([
+        (b'ints', _field(3, 2, b''.join(_field(1, 0, encode_varint(value))
+                                       for value in [3, -4, 2 ** 40]))),
+        (b'floats', _field(2, 2, b''.join(_field(1, 5, np.float32(value).tobytes())
+                                         for value in [0.5, -1.25]))),
+    ]),
+    {'ints': ('int64_list', [3, -4, 2 ** 40]), 'floats': ('float_list', [0.5, -1.25])},
+)
+
+_MIXED_PACKED_AND_UNPACKED = (
+    _hand_built_example([
+        (b'ints', _field(3, 2, _field(1, 2, encode_varint(1) + encode_varint(2)) +
+                         _field(1, 0, encode_varint(3)))),
+    ]),
+    {'ints': ('int64_list', [1, 2, 3])},
+)
+
+_VALUE_BEFORE_KEY_AND_UNKNOWN_FIELDS = (
+    _field(1, 2, _field(1, 2, _field(2, 2, _field(1, 2, _field(1, 2, b'abc'))) +
+                        _field(1, 2, b'key'))) + _field(9, 2, b'unknown'),
+    {'key': ('bytes_list', [b'abc'])},
+)
+
+
+class DecoderTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        decoded = _decoded_lists(decode_example(encode_example_from_data_dict(FEATURES_DATA)))
+        self.assertEqual(decoded, {feature_name: _expected_feature(data)
+                                   for feature_name, data in FEATURES_DATA.items()})
+
+    def test_selected_keys(self):
+        example_serialized = encode_example_from_data_dict(FEATURES_DATA)
+        selected_keys = ['int/negative', 'bytes/nul', 'missing']
+        self.assertEqual(_decoded_lists(decode_example(example_serialized, selected_keys)), {
+            'int/negative': _expected_feature(FEATURES_DATA['int/negative']),
+            'bytes/nul': _expected_feature(FEATURES_DATA['bytes/nul'])})
+        self.assertEqual(decode_example(example_serialized, ['missing']), {})
+        self.assertEqual(decode_example(example_serialized, []), {})
+
+    def test_memoryview_input(self):
+        example_serialized = encode_example_from_data_dict(FEATURES_DATA)
+        self.assertEqual(_decoded_lists(decode_example(memoryview(example_serialized))),
+                         _decoded_lists(decode_example(example_serialized)))
+
+    def test_many_int64_values(self):
+        values = np.random.RandomState(0).randint(-2 ** 62, 2 ** 62, size=1000, dtype=np.int64)
+        example_serialized = encode_example_from_data_dict({'ints': values})
+        kind, decoded_values = decode_example(example_serialized)['ints']
+        self.assertEqual(kind, 'int64_list')
+        self.assertEqual(decoded_values.dtype, np.int64)
+        np.testing.assert_array_equal(decoded_values, values)
+
+    def test_unpacked_lists(self):
+        example_serialized, expected = _UNPACKED_LISTS
+        self.assertEqual(_decoded_lists(decode_example(example_serialized)), expected)
+
+    def test_mixed_packed_and_unpacked_values(self):
+        example_serialized, expected = _MIXED_PACKED_AND_UNPACKED
+        self.assertEqual(_decoded_lists(decode_example(example_serialized)), expected)
+
+    def test_value_before_key_and_unknown_fields(self):
+        example_serialized, expected = _VALUE_BEFORE_KEY_AND_UNKNOWN_FIELDS
+        self.assertEqual(_decoded_lists(decode_example(example_serialized)), expected)
+        self.assertEqual(decode_example(example_serialized, ['other']), {})
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class ProtobufDecoderTest(unittest.TestCase):
+
+    def _assert_decodes_like_protobuf(self, example_serialized, selected_keys=None):
+        example = tf.train.Example.FromString(example_serialized)
+        decoded = decode_example(example_serialized, selected_keys)
+
+        expected_names = set(example.features.feature)
+        if selected_keys is not None:
+            expected_names &= set(selected_keys)
+        self.assertEqual(set(decoded), expected_names)
+
+        for feature_name, (kind, values) in decoded.items():
+            feature = example.features.feature[feature_name]
+            self.assertEqual(kind, feature.WhichOneof('kind'), feature_name)
+            if kind == 'bytes_list':
+                self.assertEqual([bytes(value) for value in values],
+                                 list(feature.bytes_list.value), feature_name)
+            elif kind == 'float_list':
+                np.testing.assert_array_equal(
+                    values, np.array(feature.float_list.value, dtype=np.float32))
+            elif kind == 'int64_list':
+                self.assertEqual(values.dtype, np.int64)
+                self.assertEqual(values.tolist(), list(feature.int64_list.value), feature_name)
+
+    def test_protobuf_serialization(self):
+        self._assert_decodes_like_protobuf(
+            _to_tf_example(FEATURES_DATA).SerializeToString(deterministic=True))
+        self._assert_decodes_like_protobuf(
+            _to_tf_example(FEATURES_DATA).SerializeToString(deterministic=True),
+            selected_keys=['int/negative', 'bytes/nul', 'missing'])
+
+    def test_hand_built_examples(self):
+        for example_serialized, _ in (_UNPACKED_LISTS, _MIXED_PACKED_AND_UNPACKED,
+                                      _VALUE_BEFORE_KEY_AND_UNKNOWN_FIELDS):
+            self._assert_decodes_like_protobuf(example_serialized)
+
+
+if __name__ == '__main__':
+    unittest.main()
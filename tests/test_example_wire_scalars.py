@@ -0,0 +1,50 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests that the scalar fast paths of the `example_wire` encoders match the array paths.
+"""
+
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_wire import encode_float_feature, encode_int64_feature
+
+
+def _join(chunks):
+
+    return b''.join(bytes(chunk) for chunk in chunks)
+
+
+class ScalarEncodingTest(unittest.TestCase):
+
+    def test_int64_scalars(self):
+        for value in [0, 1, 127, 128, 300, -1, -2 ** 63, 2 ** 63 - 1, np.int64(-5),
+                      np.int32(7), np.uint8(200), True]:
+            self.assertEqual(_join(encode_int64_feature(value)),
+                             _join(encode_int64_feature(np.array([value], dtype=np.int64))),
+                             value)
+
+    def test_float_scalars(self):
+        for value in [0.0, -0.0, 1.5, -3.25, 1e30, float('inf'), 3, np.float32(0.1),
+                      np.float64(0.1), np.int64(4)]:
+            self.assertEqual(_join(encode_float_feature(value)),
+                             _join(encode_float_feature(np.array([value], dtype=np.float32))),
+                             value)
+
+    def test_float_scalars_out_of_float32_range(self):
+        # Finite doubles above the float32 maximum are stored as inf, like the array path.
+        with np.errstate(over='ignore'):
+            for value in [1e39, -1e39, np.float64(1e39), 2 ** 200]:
+                self.assertEqual(
+                    _join(encode_float_feature(value)),
+                    _join(encode_float_feature(np.array([value], dtype=np.float32))), value)
+                self.assertEqual(_join(encode_float_feature(value)),
+                                 _join(encode_float_feature(np.copysign(np.inf, value))))
+
+    def test_float_nan_scalar(self):
+        self.assertEqual(_join(encode_float_feature(float('nan'))),
+                         _join(encode_float_feature(np.array([np.nan], dtype=np.float32))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of config file format detection and caching, and of frozen flags in `flags`.
+"""
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from toolbox_az.general import flags
+from toolbox_az.general.flags import (JSON_FORMAT, PICKLE_FORMAT, YAML_FORMAT, Flags,
+                                      FrozenFlags, MyArguments, detect_config_format,
+                                      install_frozen_flags, process_dict)
+
+CONFIG = {'learning_rate': 0.5, 'name': 'model'}
+
+
+class ConfigFormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        flags._parsed_config_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        flags._parsed_config_cache.clear()
+
+    def _write(self, file_name, data):
+        path = os.path.join(self.temp_dir, file_name)
+        with open(path, 'wb') as config_file:
+            config_file.write(data)
+        return path
+
+    def test_detects_format_from_extension(self):
+        self.assertEqual(detect_config_format('a.json', b''), JSON_FORMAT)
+        self.assertEqual(detect_config_format('a.YML', b''), YAML_FORMAT)
+        self.assertEqual(detect_config_format('a.yaml', b''), YAML_FORMAT)
+        self.assertEqual(detect_config_format('a.pkl', b''), PICKLE_FORMAT)
+        self.assertEqual(detect_config_format('a.pickle', b''), PICKLE_FORMAT)
+
+    def test_detects_format_from_content(self):
+        self.assertEqual(detect_config_format('a', pickle.dumps(CONFIG, protocol=2)),
+                         PICKLE_FORMAT)
+        self.assertEqual(detect_config_format('a.cfg', b'  {"a": 1}'), JSON_FORMAT)
+        self.assertEqual(detect_config_format('a.cfg', b'a: 1'), YAML_FORMAT)
+
+    def test_parses_every_format(self):
+        paths = [
+            self._write('config.json', json.dumps(CONFIG).encode('utf-8')),
+            self._write('config.yaml', b'learning_rate: 0.5\nname: model\n'),
+            self._write('config.pkl', pickle.dumps(CONFIG)),
+            self._write('config_json', json.dumps(CONFIG).encode('utf-8')),
+            self._write('config_yaml', b'learning_rate: 0.5\nname: model\n'),
+        ]
+        paths.extend(self._write('c{}.cfg'.format(protocol), pickle.dumps(CONFIG, protocol))
+                     for protocol in range(pickle.HIGHEST_PROTOCOL + 1))
+        for path in paths:
+            self.assertEqual(process_dict(path), CONFIG, path)
+
+    def test_text_args_file_is_not_a_dict(self):
+        self.assertIsNone(process_dict(self._write('args.txt', b'--learning_rate\n0.5\n')))
+        self.assertIsNone(process_dict(self._write('args', b'--name\nmodel\n')))
+
+    def test_old_protocol_pickle_is_read_as_arguments(self):
+        path = self._write('c0.cfg', pickle.dumps(CONFIG, protocol=0))
+        arguments = MyArguments()
+        arguments.add_argument('--learning_rate', type=float, default=0.1)
+        arguments.add_argument('--name', default='default')
+        arguments.parse_args(['@' + path])
+        self.assertEqual(arguments.learning_rate, 0.5)
+        self.assertEqual(arguments.name, 'model')
+
+    def test_memory_cache_is_invalidated_on_change(self):
+        path = self._write('config.json', json.dumps(CONFIG).encode('utf-8'))
+        self.assertEqual(process_dict(path), CONFIG)
+
+        # The returned dict is a copy, callers cannot change the cached config.
+        process_dict(path)['name'] = 'changed'
+        self.assertEqual(process_dict(path), CONFIG)
+
+        changed_config = dict(CONFIG, name='other_model')
+        self._write('config.json', json.dumps(changed_config).encode('utf-8'))
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(process_dict(path), changed_config)
+
+    def test_disk_cache_is_used_and_invalidated(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        path = self._write('config.yaml', b'learning_rate: 0.5\nname: model\n')
+        self.assertEqual(process_dict(path, cache_dir=cache_dir), CONFIG)
+        cache_files = os.listdir(cache_dir)
+        self.assertEqual(len(cache_files), 1)
+
+        # A new process only has the disk cache, which is read instead of the config file.
+        flags._parsed_config_cache.clear()
+        cached_config = dict(CONFIG, name='from_cache')
+        with open(os.path.join(cache_dir, cache_files[0]), 'w') as cache_file:
+            json.dump(cached_config, cache_file)
+        self.assertEqual(process_dict(path, cache_dir=cache_dir), cached_config)
+
+        # A changed config file has a new cache key, the stale entry is ignored.
+        flags._parsed_config_cache.clear()
+        self._write('config.yaml', b'learning_rate: 0.25\nname: model\n')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(process_dict(path, cache_dir=cache_dir),
+                         dict(CONFIG, learning_rate=0.25))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_disk_cache_is_not_unpickled(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        path = self._write('config.json', json.dumps(CONFIG).encode('utf-8'))
+        process_dict(path, cache_dir=cache_dir)
+        cache_file_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+
+        # A pickle planted in the shared cache is not loaded, the config file is read instead.
+        flags._parsed_config_cache.clear()
+        with open(cache_file_path, 'wb') as cache_file:
+            pickle.dump(dict(CONFIG, name='planted'), cache_file)
+        self.assertEqual(process_dict(path, cache_dir=cache_dir), CONFIG)
+
+    def test_dict_json_cannot_represent_is_cached_in_memory_only(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        config = {'shape': (3, 4), 1: 'one'}
+        path = self._write('config.pkl', pickle.dumps(config))
+        self.assertEqual(process_dict(path, cache_dir=cache_dir), config)
+        self.assertFalse(os.path.exists(cache_dir))
+        self.assertEqual(process_dict(path, cache_dir=cache_dir), config)
+
+    def test_cached_dict_is_deep_copied(self):
+        config = {'layers': [1, 2], 'optimizer': {'name': 'adam'}}
+        path = self._write('config.json', json.dumps(config).encode('utf-8'))
+        parsed_dict = process_dict(path)
+        parsed_dict['layers'].append(3)
+        parsed_dict['optimizer']['name'] = 'sgd'
+        self.assertEqual(process_dict(path), config)
+
+
+class FrozenFlagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.arguments = MyArguments()
+        self.arguments.add_argument('--learning_rate', type=float, default=0.1)
+        self.arguments.add_argument('--layers', type=int, nargs='+', default=[1, 2])
+        self.arguments.add_argument('--options', type=json.loads, default={'a': [1, {'b': 2}]})
+        self.arguments.parse_args(['--learning_rate', '0.5', '--layers', '3', '4', '5'])
+
+    def tearDown(self):
+        Flags.instance = None
+
+    def test_values(self):
+        frozen_flags = self.arguments.freeze()
+        self.assertIsInstance(frozen_flags, FrozenFlags)
+        self.assertEqual(frozen_flags.learning_rate, 0.5)
+        self.assertEqual(frozen_flags.layers, [3, 4, 5])
+        self.assertEqual(frozen_flags.options, {'a': [1, {'b': 2}]})
+        self.assertEqual(frozen_flags.options['a'][1]['b'], 2)
+        self.assertEqual(frozen_flags.get_argument_dict(), {
+            'learning_rate': 0.5, 'layers': [3, 4, 5], 'options': {'a': [1, {'b': 2}]}})
+
+        # The snapshot holds copies, changing the parsed arguments does not change it.
+        self.arguments.layers.append(6)
+        self.assertEqual(frozen_flags.layers, [3, 4, 5])
+
+    def test_hashable_with_list_values(self):
+        frozen_flags = self.arguments.freeze()
+        cache = {frozen_flags: 'value'}
+        self.assertEqual(cache[self.arguments.freeze()], 'value')
+
+        self.arguments.parse_args(['--layers', '6'])
+        self.assertNotIn(self.arguments.freeze(), cache)
+
+    def test_read_only(self):
+        frozen_flags = self.arguments.freeze()
+        with self.assertRaises(AttributeError):
+            frozen_flags.learning_rate = 1.0
+        with self.assertRaises(AttributeError):
+            del frozen_flags.layers
+        with self.assertRaises(AttributeError):
+            frozen_flags.new_argument = 1
+
+    def test_pickle(self):
+        frozen_flags = self.arguments.freeze()
+        unpickled_flags = pickle.loads(pickle.dumps(frozen_flags))
+        self.assertEqual(unpickled_flags, frozen_flags)
+        self.assertEqual(hash(unpickled_flags), hash(frozen_flags))
+        self.assertIs(type(unpickled_flags), type(frozen_flags))
+        self.assertEqual(unpickled_flags.options['a'], [1, {'b': 2}])
+        self.assertEqual(unpickled_flags.layers, [3, 4, 5])
+
+    def test_install_frozen_flags(self):
+        frozen_flags = self.arguments.freeze()
+        install_frozen_flags(frozen_flags)
+        self.assertIs(Flags(), frozen_flags)
+        self.assertEqual(Flags().layers, [3, 4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
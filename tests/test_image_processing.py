@@ -0,0 +1,115 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of NumPy decoding and caching of `ImageDecoder`.
+"""
+
+import io
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.image_processing import DecodedImageCache, ImageDecoder
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def _encode_png(image):
+
+    stream = io.BytesIO()
+    Image.fromarray(image).save(stream, format='PNG')
+    return stream.getvalue()
+
+
+@unittest.skipIf(Image is None, 'PIL is not installed.')
+class ImageDecoderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.image = rng.randint(0, 256, size=(8, 6, 3), dtype=np.uint8)
+        self.mask = rng.randint(0, 256, size=(8, 6, 3), dtype=np.uint8)
+        self.features = {
+            'image/encoded': _encode_png(self.image),
+            'mask/encoded': _encode_png(self.mask),
+            'image/format': b'png',
+            'image/filename': b'0001.png',
+        }
+
+    def _decoder(self, encoded_feature, output_feature, cache, **kwargs):
+
+        return ImageDecoder(encoded_feature, 'image/format', output_feature, cache=cache,
+                            cache_key_feature='image/filename', **kwargs)
+
+    def test_decodes_and_caches(self):
+        cache = DecodedImageCache(2 ** 20)
+        decoder = self._decoder('image/encoded', 'image/decoded', cache)
+        for _ in range(2):
+            decoder(self.features)
+            np.testing.assert_array_equal(self.features['image/decoded'], self.image)
+
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+
+    def test_decoders_of_other_features_share_a_cache(self):
+        cache = DecodedImageCache(2 ** 20)
+        self._decoder('image/encoded', 'image/decoded', cache)(self.features)
+        self._decoder('mask/encoded', 'mask/decoded', cache)(self.features)
+
+        np.testing.assert_array_equal(self.features['image/decoded'], self.image)
+        np.testing.assert_array_equal(self.features['mask/decoded'], self.mask)
+        self.assertEqual(len(cache), 2)
+
+    def test_decoders_with_other_options_share_a_cache(self):
+        cache = DecodedImageCache(2 ** 20)
+        self._decoder('image/encoded', 'image/decoded', cache)(self.features)
+        self._decoder('image/encoded', 'image/resized', cache, resize=(4, 3))(self.features)
+        self._decoder('image/encoded', 'image/gray', cache, channels=1)(self.features)
+
+        self.assertEqual(self.features['image/decoded'].shape, (8, 6, 3))
+        self.assertEqual(self.features['image/resized'].shape, (4, 3, 3))
+        self.assertEqual(self.features['image/gray'].shape, (8, 6, 1))
+        self.assertEqual(len(cache), 3)
+
+    def test_images_without_a_key_are_not_cached(self):
+        cache = DecodedImageCache(2 ** 20)
+        decoder = self._decoder('image/encoded', 'image/decoded', cache)
+        other_features = dict(self.features, **{'image/encoded': self.features['mask/encoded']})
+        for features in (self.features, other_features):
+            features['image/filename'] = b''
+            decoder(features)
+        np.testing.assert_array_equal(self.features['image/decoded'], self.image)
+        np.testing.assert_array_equal(other_features['image/decoded'], self.mask)
+
+        batch_features = {
+            'image/encoded': [self.features['image/encoded'], self.features['mask/encoded']],
+            'image/format': b'png',
+            'image/filename': [b'', b''],
+        }
+        decoder(batch_features)
+        np.testing.assert_array_equal(batch_features['image/decoded'],
+                                      np.stack([self.image, self.mask]))
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+    def test_spilled_images_keep_their_keys(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            # Images are spilled as soon as they are cached.
+            cache = DecodedImageCache(0, spill_dir=spill_dir)
+            image_decoder = self._decoder('image/encoded', 'image/decoded', cache)
+            mask_decoder = self._decoder('mask/encoded', 'mask/decoded', cache)
+            for _ in range(2):
+                image_decoder(self.features)
+                mask_decoder(self.features)
+
+            np.testing.assert_array_equal(self.features['image/decoded'], self.image)
+            np.testing.assert_array_equal(self.features['mask/decoded'], self.mask)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+        finally:
+            shutil.rmtree(spill_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the pipeline instrumentation of `instrumentation` and of its callbacks in `tf_utils`.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_wire import decode_example, encode_example_from_data_dict
+from toolbox_az.tf_utils.instrumentation import LatencyHistogram, PipelineStats
+from toolbox_az.tf_utils.tf_utils import (_StepConsumers, inspect_tfrecord,
+                                          process_features_from_tfrecord,
+                                          run_queue_runner_session)
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+# Ratio of the upper bounds of consecutive histogram buckets.
+BUCKET_RATIO = 2 ** (1 / LatencyHistogram.BUCKETS_PER_OCTAVE)
+
+
+class _ValueParser(object):
+    """
+    Decodes an int64 'value' feature like `ExampleParser.parse_numpy` does for a scalar feature.
+    """
+
+    def parse_numpy(self, example_serialized, selected_features=None, return_as_dict=False):
+        values = {feature_name: values[0] for feature_name, (_, values) in
+                  decode_example(example_serialized, selected_features).items()}
+        return values if return_as_dict else list(values.values())
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), 0.0)
+        self.assertEqual(histogram.to_dict(), {'count': 0})
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        durations = [0.001 * (index + 1) for index in range(100)]
+        for seconds in durations:
+            histogram.add(seconds)
+
+        for percent in (50, 90, 99):
+            exact = durations[percent - 1]
+            self.assertGreaterEqual(histogram.percentile(percent), exact)
+            self.assertLessEqual(histogram.percentile(percent), exact * BUCKET_RATIO)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+        summary = histogram.to_dict()
+        self.assertEqual((summary['count'], summary['min'], summary['max']), (100, 0.001, 0.1))
+        self.assertAlmostEqual(summary['mean'], 0.0505)
+
+    def test_durations_below_the_first_bucket(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.0)
+        histogram.add(1e-7)
+        self.assertEqual(histogram.percentile(100), 1e-7)
+
+
+class PipelineStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_counters(self):
+        stats = PipelineStats()
+        stats.on_records(3, 300)
+        stats.on_records(2, 0)
+        stats.on_session_run(0.5)
+        stats.on_parse(0.001)
+        stats.on_parse(0.002)
+        stats.on_consume(0.25)
+        for depth in (1, 3, 2):
+            stats.on_queue_depth(depth)
+
+        summary = stats.summary()
+        self.assertEqual((summary['num_records'], summary['num_bytes']), (5, 300))
+        self.assertGreater(summary['records_per_second'], 0)
+        self.assertEqual(summary['session_run_latency']['count'], 1)
+        self.assertEqual(summary['parse_latency']['count'], 2)
+        self.assertEqual(summary['consume_latency']['max'], 0.25)
+        self.assertEqual((summary['mean_queue_depth'], summary['max_queue_depth']), (2.0, 3))
+
+        stats.reset()
+        summary = stats.summary()
+        self.assertEqual((summary['num_records'], summary['max_queue_depth']), (0, 0))
+        self.assertEqual(summary['parse_latency'], {'count': 0})
+
+    def test_periodic_json_lines_report(self):
+        json_file = os.path.join(self.temp_dir, 'stats.jsonl')
+        stats = PipelineStats(report_interval=0, log_level=None, json_file=json_file)
+        stats.on_records(1, 10)
+        stats.on_parse(0.001)
+
+        # Queue depth updates report too, a consumer-bound pipeline reads no new records.
+        stats.on_queue_depth(4)
+
+        with open(json_file) as json_stream:
+            reports = [json.loads(line) for line in json_stream]
+        self.assertEqual(len(reports), 3)
+        self.assertEqual([report['num_records'] for report in reports], [1, 1, 1])
+        self.assertEqual(reports[-1]['max_queue_depth'], 4)
+
+    def test_report_interval(self):
+        json_file = os.path.join(self.temp_dir, 'stats.jsonl')
+        stats = PipelineStats(report_interval=3600, log_level=None, json_file=json_file)
+        stats.on_records(1, 10)
+        stats.on_queue_depth(1)
+        self.assertFalse(os.path.exists(json_file))
+
+    def test_logged_report(self):
+        stats = PipelineStats(log_level=logging.WARNING)
+        stats.on_records(2, 20)
+        with self.assertLogs(level='WARNING') as logs:
+            summary = stats.report()
+        self.assertEqual(summary['num_records'], 2)
+        self.assertIn('"num_records": 2', logs.output[0])
+
+
+class CallbackWiringTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_file = os.path.join(self.temp_dir, 'data.tfrecord')
+        self.records = [encode_example_from_data_dict({'value': np.int64(index)})
+                        for index in range(5)]
+        with TFRecordFileWriter(self.tfrecord_file) as writer:
+            for record in self.records:
+                writer.write(record)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_session_free_iterator(self):
+        stats = PipelineStats()
+        features = process_features_from_tfrecord(
+            self.tfrecord_file, _ValueParser(), return_as_dict=True, shuffle=False, num_epochs=1,
+            session_free=True, callback=stats)
+        self.assertEqual([values['value'] for values in features], list(range(5)))
+
+        summary = stats.summary()
+        self.assertEqual(summary['num_records'], 5)
+        self.assertEqual(summary['num_bytes'], sum(len(record) for record in self.records))
+        self.assertEqual(summary['parse_latency']['count'], 5)
+
+    def test_session_free_inspection(self):
+        stats = PipelineStats()
+        values = inspect_tfrecord(self.tfrecord_file, 'value', _ValueParser(), session_free=True,
+                                  callback=stats)
+        self.assertEqual(sorted(values), list(range(5)))
+        self.assertEqual(stats.summary()['consume_latency']['count'], 5)
+
+    def test_step_consumers(self):
+        stats = PipelineStats()
+        release = threading.Event()
+        consumers = _StepConsumers(lambda values: release.wait(), num_threads=1,
+                                   max_pending_steps=3, on_error=self.fail, callback=stats)
+        for values in range(3):
+            consumers.submit(values)
+        self.assertEqual(stats.summary()['max_queue_depth'], 3)
+
+        release.set()
+        consumers.shutdown()
+        self.assertEqual(consumers.num_pending, 0)
+
+    @unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+    def test_queue_runner_session(self):
+        tf.reset_default_graph()
+        step = tf.train.limit_epochs(tf.constant([1, 2]), num_epochs=6)
+
+        stats = PipelineStats()
+        run_queue_runner_session(step, lambda values: None, num_consumer_threads=1,
+                                 callback=stats, batched_records=True)
+        summary = stats.summary()
+        self.assertEqual(summary['num_records'], 12)
+        self.assertEqual(summary['num_bytes'], 0)
+        self.assertEqual(summary['session_run_latency']['count'], 6)
+        self.assertEqual(summary['consume_latency']['count'], 6)
+        self.assertGreaterEqual(summary['max_queue_depth'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Import-time regression tests. Every import runs in a fresh interpreter, so modules loaded by
+other tests do not hide eager imports.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _loaded_modules_after(import_statement, modules):
+    """
+    Runs `import_statement` in a new interpreter.
+    :return: The subset of `modules` that is in `sys.modules` after the import.
+    """
+    code = '\n'.join([
+        'import sys',
+        import_statement,
+        'print(" ".join(name for name in {!r} if name in sys.modules))'.format(modules),
+    ])
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=REPOSITORY_ROOT)
+    return output.decode('utf-8').split()
+
+
+class LazyImportsTest(unittest.TestCase):
+
+    def test_general_does_not_import_heavy_modules(self):
+        self.assertEqual(
+            _loaded_modules_after('import toolbox_az.general', ['tensorflow', 'numpy', 'yaml']),
+            [])
+
+    def test_flags_does_not_import_heavy_modules(self):
+        self.assertEqual(
+            _loaded_modules_after('from toolbox_az.general import Flags',
+                                  ['tensorflow', 'numpy', 'yaml']),
+            [])
+
+    def test_tf_utils_modules_do_not_import_tensorflow(self):
+        for module in ['example_features_template', 'example_utils', 'tf_utils',
+                       'tfrecord_writer', 'tensor_store']:
+            self.assertEqual(
+                _loaded_modules_after('import toolbox_az.tf_utils.{}'.format(module),
+                                      ['tensorflow']),
+                [], module)
+
+    def test_flags_names_are_exported(self):
+        self.assertEqual(
+            _loaded_modules_after('from toolbox_az.general import *\n'
+                                  'assert Flags and MyArguments and process_dict',
+                                  []),
+            [])
+
+    def test_general_version(self):
+        self.assertEqual(
+            _loaded_modules_after('import toolbox_az.general\n'
+                                  'assert toolbox_az.general.__version__ == "0.1"',
+                                  []),
+            [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the order and the resumption of `ShuffledRecordIterator`.
+"""
+
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from toolbox_az.tf_utils.record_iterator import ShuffledRecordIterator
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+# Number of records of every shard, including shards without records.
+SHARD_SIZES = (7, 0, 13, 1, 0, 9)
+
+
+class ShuffledRecordIteratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = []
+        for shard_index, shard_size in enumerate(SHARD_SIZES):
+            shard_file = os.path.join(self.temp_dir, 'data.tfrecord-{:05d}'.format(shard_index))
+            with TFRecordFileWriter(shard_file) as writer:
+                for record_index in range(shard_size):
+                    record = '{}-{}'.format(shard_index, record_index).encode('utf-8')
+                    writer.write(record)
+                    self.records.append(record)
+        self.pattern = os.path.join(self.temp_dir, 'data.tfrecord-*')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _iterator(self, **kwargs):
+        kwargs.setdefault('shuffle_buffer_size', 5)
+        kwargs.setdefault('seed', 3)
+        return ShuffledRecordIterator(self.pattern, check_crc=True, **kwargs)
+
+    def _assert_resumes(self, num_read, num_total=None, **kwargs):
+        """
+        Reads `num_read` records, saves the state, and checks that a fresh iterator restored from
+        the pickled state returns the same remaining records as an uninterrupted iterator.
+        """
+        with self._iterator(**kwargs) as records:
+            expected = list(itertools.islice(records, num_total))
+
+        with self._iterator(**kwargs) as records:
+            head = list(itertools.islice(records, num_read))
+            state = pickle.loads(pickle.dumps(records.get_state()))
+
+        # The restored iterator gets another seed, which the state overrides.
+        kwargs['seed'] = 12345
+        with self._iterator(**kwargs) as records:
+            records.set_state(state)
+            self.assertEqual(records.num_records, num_read)
+            remaining = list(itertools.islice(
+                records, None if num_total is None else num_total - num_read))
+
+        self.assertEqual(head + remaining, expected)
+
+    def test_single_epoch_in_order(self):
+        with self._iterator(shuffle_buffer_size=None) as records:
+            self.assertEqual(list(records), self.records)
+
+    def test_shuffled_epochs_are_permutations(self):
+        with self._iterator(num_epochs=2) as records:
+            read_records = list(records)
+            self.assertEqual(records.epoch, 2)
+
+        num_records = len(self.records)
+        self.assertEqual(sorted(read_records[:num_records]), sorted(self.records))
+        self.assertEqual(sorted(read_records[num_records:]), sorted(self.records))
+        self.assertNotEqual(read_records[:num_records], self.records)
+        self.assertNotEqual(read_records[:num_records], read_records[num_records:])
+
+    def test_same_seed_same_order(self):
+        with self._iterator(num_epochs=3) as records:
+            first = list(records)
+        with self._iterator(num_epochs=3) as records:
+            self.assertEqual(list(records), first)
+
+    def test_resume_mid_buffer(self):
+        # Before and right after the buffer is first filled, and while it is drained at the end of
+        # the epoch.
+        for num_read in (0, 1, 4, 5, 6, len(self.records) - 3, len(self.records)):
+            self._assert_resumes(num_read)
+
+    def test_resume_mid_epoch(self):
+        num_records = len(self.records)
+        for num_read in (10, num_records - 1, num_records + 1, 2 * num_records + 7):
+            self._assert_resumes(num_read, num_epochs=3)
+
+    def test_resume_without_shuffling(self):
+        for num_read in (0, 7, 8, 21):
+            self._assert_resumes(num_read, shuffle_buffer_size=None, num_epochs=2)
+
+    def test_resume_repeating_forever(self):
+        num_records = len(self.records)
+        for num_read in (3, num_records, 3 * num_records + 2):
+            self._assert_resumes(num_read, num_total=5 * num_records, num_epochs=None)
+
+    def test_resume_with_buffer_larger_than_dataset(self):
+        self._assert_resumes(12, shuffle_buffer_size=1000, num_epochs=2)
+
+    def test_state_of_other_files_is_rejected(self):
+        with self._iterator() as records:
+            next(records)
+            state = records.get_state()
+
+        with self.assertRaises(ValueError):
+            self._iterator(shuffle_buffer_size=6).set_state(state)
+
+        with TFRecordFileWriter(os.path.join(self.temp_dir, 'data.tfrecord-00000')) as writer:
+            writer.write(b'changed')
+        with self.assertRaises(ValueError):
+            self._iterator().set_state(state)
+
+    def test_shards_without_records(self):
+        for shard_index in range(len(SHARD_SIZES)):
+            with TFRecordFileWriter(os.path.join(
+                    self.temp_dir, 'data.tfrecord-{:05d}'.format(shard_index))):
+                pass
+
+        for num_epochs in (1, None):
+            with self._iterator(num_epochs=num_epochs) as records:
+                self.assertEqual(list(records), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Round trip tests of the memory-mappable tensor store of `tensor_store`.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.tensor_store import (export_ckpt_to_tensor_store, load_tensor_store,
+                                              read_tensor_store_header)
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+class _DType(object):
+
+    def __init__(self, dtype):
+        self.as_numpy_dtype = dtype
+
+
+class _CheckpointReader(object):
+    """
+    Serves NumPy values with the interface of `pywrap_tensorflow.NewCheckpointReader`.
+    """
+
+    def __init__(self, tensors):
+        self.tensors = tensors
+
+    def get_variable_to_shape_map(self):
+        return {name: list(value.shape) for name, value in self.tensors.items()}
+
+    def get_variable_to_dtype_map(self):
+        return {name: _DType(value.dtype.type) for name, value in self.tensors.items()}
+
+    def get_tensor(self, name):
+        return self.tensors[name]
+
+
+TENSORS = {
+    'dense/kernel': np.arange(12, dtype=np.float32).reshape(3, 4),
+    'dense/bias': np.array([0.5, -1.5, 2.0], dtype=np.float64),
+    'global_step': np.array(42, dtype=np.int64),
+    'mask': np.array([True, False, True]),
+    'empty': np.zeros((0, 5), dtype=np.float16),
+    'names': np.array([b'a', b'b'], dtype=object),
+    'complex': np.array([1 + 2j, -3j], dtype=np.complex64),
+    'transposed': np.arange(6, dtype=np.int16).reshape(2, 3).T,
+}
+
+
+class TensorStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store_file = os.path.join(self.temp_dir, 'model.tstore')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        skipped_names = export_ckpt_to_tensor_store(_CheckpointReader(TENSORS), self.store_file,
+                                                    alignment=32)
+        self.assertEqual(skipped_names, ['names'])
+
+        header, data_start = read_tensor_store_header(self.store_file)
+        self.assertEqual(data_start % 32, 0)
+        self.assertTrue(all(entry['offset'] % 32 == 0 for entry in header['tensors']))
+
+        tensors = load_tensor_store(self.store_file)
+        self.assertEqual(sorted(tensors), sorted(set(TENSORS) - {'names'}))
+        for name, value in tensors.items():
+            self.assertEqual(value.dtype, TENSORS[name].dtype, name)
+            np.testing.assert_array_equal(value, TENSORS[name], name)
+
+        # Loaded tensors view the read-only map.
+        self.assertFalse(tensors['dense/kernel'].flags.writeable)
+
+    def test_missing_keys(self):
+        export_ckpt_to_tensor_store(_CheckpointReader(TENSORS), self.store_file,
+                                    name_filter='dense/*')
+        tensors = load_tensor_store(self.store_file)
+        self.assertEqual(sorted(tensors), ['dense/bias', 'dense/kernel'])
+        with self.assertRaises(KeyError):
+            tensors['global_step']
+
+        self.assertEqual(list(load_tensor_store(self.store_file, name_filter='dense/b*')),
+                         ['dense/bias'])
+        self.assertEqual(load_tensor_store(self.store_file, name_filter='missing'), {})
+
+    def test_only_empty_tensors(self):
+        export_ckpt_to_tensor_store(_CheckpointReader({'empty': TENSORS['empty']}),
+                                    self.store_file)
+        self.assertEqual(load_tensor_store(self.store_file)['empty'].shape, (0, 5))
+
+    def test_failed_export_leaves_no_file(self):
+        class FailingReader(_CheckpointReader):
+            def get_tensor(self, name):
+                if name == 'global_step':
+                    raise RuntimeError('Unreadable tensor.')
+                return super(FailingReader, self).get_tensor(name)
+
+        with self.assertRaisesRegex(RuntimeError, 'Unreadable tensor'):
+            export_ckpt_to_tensor_store(FailingReader(TENSORS), self.store_file)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_not_a_store_file(self):
+        with open(self.store_file, 'wb') as store:
+            store.write(b'not a tensor store')
+        with self.assertRaises(IOError):
+            load_tensor_store(self.store_file)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class CheckpointTensorStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_checkpoint_round_trip(self):
+        tf.reset_default_graph()
+        kernel = tf.Variable(TENSORS['dense/kernel'], name='dense/kernel')
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            ckpt_file = tf.train.Saver([kernel]).save(
+                session, os.path.join(self.temp_dir, 'model.ckpt'))
+
+        store_file = os.path.join(self.temp_dir, 'model.tstore')
+        export_ckpt_to_tensor_store(ckpt_file, store_file)
+        np.testing.assert_array_equal(load_tensor_store(store_file)['dense/kernel'],
+                                      TENSORS['dense/kernel'])
+
+
+if __name__ == '__main__':
+    unittest.main()
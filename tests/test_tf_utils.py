@@ -0,0 +1,334 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the session free helpers of `tf_utils`.
+"""
+
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_utils import ExampleParser, ParseConfigFeatures
+from toolbox_az.tf_utils.example_wire import decode_example, encode_example_from_data_dict
+from toolbox_az.tf_utils.tf_utils import (_batch_size, _StepConsumers, _unbatch_values,
+                                          inspect_tfrecord, iter_inspect_tfrecords,
+                                          make_tfrecord_dataset, process_features_from_tfrecord,
+                                          run_queue_runner_session)
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+SparseValue = collections.namedtuple('SparseValue', ['indices', 'values', 'dense_shape'])
+
+
+class _IdValueFeatures(object):
+
+    def __init__(self):
+        self.features_map = {'id': ParseConfigFeatures.string_feature(),
+                             'value': ParseConfigFeatures.int64_feature()}
+        self.post_parsing_process = {}
+
+
+class _WireParser(object):
+    """
+    Decodes a bytes 'id' and an int64 'value' feature like `ExampleParser.parse_numpy` does for
+    scalar features.
+    """
+
+    def parse_numpy(self, example_serialized, selected_features=None, return_as_dict=False):
+        if isinstance(selected_features, str):
+            return self.parse_numpy(example_serialized, [selected_features],
+                                    return_as_dict=True)[selected_features]
+
+        features = {}
+        for feature_name, (kind, values) in decode_example(example_serialized,
+                                                           selected_features).items():
+            features[feature_name] = values[0].tobytes() if kind == 'bytes_list' else values[0]
+        return features
+
+
+def _record_id(shard_index, index):
+    return '{}/{:05d}'.format(shard_index, index).encode('utf-8')
+
+
+def _write_shard(tfrecord_file, shard_index, num_records):
+
+    with TFRecordFileWriter(tfrecord_file) as writer:
+        for index in range(num_records):
+            writer.write(encode_example_from_data_dict({
+                'id': _record_id(shard_index, index), 'value': np.int64(index)}))
+
+
+class BatchSizeTest(unittest.TestCase):
+
+    def test_arrays(self):
+        self.assertEqual(_batch_size(np.zeros((8, 3, 2))), 8)
+        self.assertEqual(_batch_size(np.zeros(5, dtype=object)), 5)
+        self.assertEqual(_batch_size(np.float32(1.0)), 1)
+        self.assertEqual(_batch_size(b'scalar'), 1)
+
+    def test_nested_values(self):
+        self.assertEqual(_batch_size({'image': np.zeros((4, 2)), 'label': np.zeros(4)}), 4)
+        self.assertEqual(_batch_size([np.zeros((6, 2)), np.zeros(6)]), 6)
+        self.assertEqual(_batch_size(([np.zeros(3)],)), 3)
+        self.assertEqual(_batch_size({}), 0)
+
+    def test_sparse_values(self):
+        sparse_value = SparseValue(indices=np.zeros((2, 2)), values=np.zeros(2),
+                                   dense_shape=np.array([7, 5]))
+        self.assertEqual(_batch_size(sparse_value), 7)
+        self.assertEqual(_batch_size({'varlen': sparse_value}), 7)
+
+    def test_unbatched_steps(self):
+        steps_values = _unbatch_values({'image': np.zeros((3, 4, 2)), 'label': np.zeros((3, 4))})
+        self.assertEqual(len(steps_values), 3)
+        self.assertEqual([_batch_size(values) for values in steps_values], [4, 4, 4])
+
+
+
+class StepConsumersTest(unittest.TestCase):
+
+    def test_backpressure(self):
+        release = threading.Event()
+        consumed = []
+
+        def process_values(values):
+            release.wait()
+            consumed.append(values)
+
+        consumers = _StepConsumers(process_values, num_threads=1, max_pending_steps=2,
+                                   on_error=self.fail)
+        consumers.submit(0)
+        consumers.submit(1)
+
+        # A third step waits until one of the pending steps is consumed.
+        submitter = threading.Thread(target=consumers.submit, args=(2,))
+        submitter.start()
+        submitter.join(timeout=0.2)
+        self.assertTrue(submitter.is_alive())
+
+        release.set()
+        submitter.join(timeout=5)
+        self.assertFalse(submitter.is_alive())
+        consumers.shutdown()
+        self.assertEqual(consumed, [0, 1, 2])
+
+    def test_consumer_error_drops_remaining_steps(self):
+        errors = []
+        consumed = []
+
+        def process_values(values):
+            if values == 1:
+                raise RuntimeError('consumer failed')
+            consumed.append(values)
+
+        consumers = _StepConsumers(process_values, num_threads=1, max_pending_steps=1,
+                                   on_error=errors.append)
+        for values in range(4):
+            consumers.submit(values)
+        consumers.shutdown()
+
+        self.assertEqual(consumed, [0])
+        self.assertEqual([str(error) for error in errors], ['consumer failed'])
+        self.assertEqual(str(consumers.error), 'consumer failed')
+
+    def test_ordered_consumption_needs_a_single_thread(self):
+        with self.assertRaises(ValueError):
+            run_queue_runner_session([], print, num_consumer_threads=2)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class RunQueueRunnerSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self.step = tf.train.limit_epochs(tf.constant(1), num_epochs=20)
+
+    def test_consumer_error_is_raised(self):
+        consumed = []
+
+        def process_values(values):
+            if len(consumed) == 3:
+                raise RuntimeError('consumer failed')
+            consumed.append(values)
+
+        with self.assertRaisesRegex(RuntimeError, 'consumer failed'):
+            run_queue_runner_session(self.step, process_values, num_consumer_threads=1)
+        self.assertEqual(len(consumed), 3)
+
+    def test_consumer_error_on_the_last_step_is_raised(self):
+        consumed = []
+
+        def process_values(values):
+            if len(consumed) == 19:
+                raise RuntimeError('consumer failed')
+            consumed.append(values)
+
+        # The input is exhausted before the last pending steps are consumed.
+        with self.assertRaisesRegex(RuntimeError, 'consumer failed'):
+            run_queue_runner_session(self.step, process_values, num_consumer_threads=1,
+                                     max_pending_steps=8)
+        self.assertEqual(len(consumed), 19)
+
+    def test_unordered_consumers(self):
+        consumed = []
+        run_queue_runner_session(self.step, consumed.append, num_consumer_threads=4,
+                                 ordered=False, max_pending_steps=2)
+        self.assertEqual(consumed, [1] * 20)
+
+
+class SessionFreeEpochsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_file = os.path.join(self.temp_dir, 'data.tfrecord')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _features(self, **kwargs):
+
+        return process_features_from_tfrecord(self.tfrecord_file, _WireParser(),
+                                              return_as_dict=True, shuffle=False,
+                                              session_free=True, **kwargs)
+
+    def test_endless_epochs_of_an_empty_file_stop(self):
+        _write_shard(self.tfrecord_file, 0, num_records=0)
+        self.assertEqual(list(self._features(num_epochs=None)), [])
+
+    def test_endless_epochs_repeat(self):
+        _write_shard(self.tfrecord_file, 0, num_records=3)
+        features = self._features(num_epochs=None)
+        self.assertEqual([next(features)['value'] for _ in range(7)], [0, 1, 2, 0, 1, 2, 0])
+
+    def test_num_epochs(self):
+        _write_shard(self.tfrecord_file, 0, num_records=2)
+        self.assertEqual([features['value'] for features in self._features(num_epochs=2)],
+                         [0, 1, 0, 1])
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class MakeTFRecordDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for shard_index in range(3):
+            _write_shard(os.path.join(self.temp_dir, 'data-{}.tfrecord'.format(shard_index)),
+                         shard_index, num_records=5)
+        self.pattern = os.path.join(self.temp_dir, 'data-*.tfrecord')
+        self.parser = ExampleParser(_IdValueFeatures())
+        tf.reset_default_graph()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _evaluate(self, dataset):
+
+        next_element = tf.data.make_one_shot_iterator(dataset).get_next()
+        elements = []
+        with tf.Session() as session:
+            try:
+                while True:
+                    elements.append(session.run(next_element))
+            except tf.errors.OutOfRangeError:
+                pass
+        return elements
+
+    def test_default_arguments(self):
+        elements = self._evaluate(make_tfrecord_dataset(self.pattern, self.parser,
+                                                        return_as_dict=True))
+        self.assertEqual(sorted(element['id'] for element in elements),
+                         sorted(_record_id(shard_index, index) for shard_index in range(3)
+                                for index in range(5)))
+
+    def test_batches_and_epochs(self):
+        batches = self._evaluate(make_tfrecord_dataset(
+            self.pattern, self.parser, selected_features=['value', 'id'], batch_size=4,
+            num_epochs=2, cycle_length=1))
+        self.assertEqual([len(values) for values, _ in batches], [4] * 7 + [2])
+        self.assertEqual(list(batches[0][0]), [0, 1, 2, 3])
+
+    def test_shuffle_is_seeded(self):
+        def evaluate_values():
+            tf.reset_default_graph()
+            return self._evaluate(make_tfrecord_dataset(
+                self.pattern, self.parser, selected_features='value', shuffle_buffer_size=8,
+                seed=3))
+
+        values = evaluate_values()
+        self.assertEqual(sorted(values), sorted(list(range(5)) * 3))
+        self.assertEqual(evaluate_values(), values)
+
+
+class InspectTFRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_files = [os.path.join(self.temp_dir, 'data-{}.tfrecord'.format(index))
+                               for index in range(3)]
+        for shard_index, tfrecord_file in enumerate(self.tfrecord_files):
+            _write_shard(tfrecord_file, shard_index, num_records=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_all_records(self):
+        records = dict(iter_inspect_tfrecords(os.path.join(self.temp_dir, 'data-*.tfrecord'),
+                                              'id', _WireParser(), num_workers=2))
+        self.assertEqual(sorted(records), sorted(_record_id(shard_index, index)
+                                                 for shard_index in range(3)
+                                                 for index in range(5)))
+        self.assertEqual(records[_record_id(2, 4)], {'id': _record_id(2, 4), 'value': 4})
+
+    def test_stops_workers_once_selected_ids_are_found(self):
+        # A shard much larger than the results queue keeps its worker busy until it is stopped.
+        large_file = os.path.join(self.temp_dir, 'large.tfrecord')
+        _write_shard(large_file, 9, num_records=20000)
+        selected_ids = [_record_id(0, 1), _record_id(9, 2)]
+
+        records = dict(iter_inspect_tfrecords([large_file] + self.tfrecord_files, 'id',
+                                              _WireParser(), features=['value'],
+                                              selected_ids=selected_ids, max_queue_size=2))
+        self.assertEqual(records, {_record_id(0, 1): {'id': _record_id(0, 1), 'value': 1},
+                                   _record_id(9, 2): {'id': _record_id(9, 2), 'value': 2}})
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_closing_the_generator_stops_workers(self):
+        large_file = os.path.join(self.temp_dir, 'large.tfrecord')
+        _write_shard(large_file, 9, num_records=20000)
+
+        records = iter_inspect_tfrecords([large_file], 'id', _WireParser(), max_queue_size=2)
+        next(records)
+        records.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_worker_errors_are_raised(self):
+        with open(self.tfrecord_files[1], 'r+b') as tfrecord_file:
+            tfrecord_file.truncate(10)
+        with self.assertRaisesRegex(IOError, 'Truncated record'):
+            list(iter_inspect_tfrecords(self.tfrecord_files, 'id', _WireParser()))
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_literal_file_name_with_glob_characters(self):
+        # The pattern 'data[1].tfrecord' matches 'data1.tfrecord', but not the file itself.
+        literal_file = os.path.join(self.temp_dir, 'data[1].tfrecord')
+        _write_shard(literal_file, 7, num_records=2)
+        _write_shard(os.path.join(self.temp_dir, 'data1.tfrecord'), 8, num_records=2)
+
+        records = inspect_tfrecord(literal_file, 'id', _WireParser(), session_free=True)
+        self.assertEqual(sorted(records), [_record_id(7, 0), _record_id(7, 1)])
+
+        records = inspect_tfrecord([literal_file], 'id', _WireParser(), num_workers=1)
+        self.assertEqual(sorted(records), [_record_id(7, 0), _record_id(7, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
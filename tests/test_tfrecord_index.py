@@ -0,0 +1,170 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the sidecar offset index `TFRecordIndex`.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from toolbox_az.tf_utils.example_wire import decode_example, encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_index import TFRecordIndex
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+NUM_RECORDS = 10
+
+
+class _IdParser(object):
+    """
+    Decodes a bytes or int64 ID feature like `ExampleParser.parse_numpy` does for a scalar
+    feature.
+    """
+
+    def parse_numpy(self, example_serialized, selected_features):
+        kind, values = decode_example(example_serialized,
+                                      {selected_features})[selected_features]
+        return values[0].tobytes() if kind == 'bytes_list' else values[0]
+
+
+class _CreateFile(object):
+    """
+    Creates a file when unpickled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return open, (self.path, 'w')
+
+
+def _record_id(index):
+    return '{:04d}.jpg'.format(index).encode('utf-8')
+
+
+class TFRecordIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_file = os.path.join(self.temp_dir, 'data.tfrecord')
+        self.records = [encode_example_from_data_dict({'id': _record_id(index), 'value': index})
+                        for index in range(NUM_RECORDS)]
+        with TFRecordFileWriter(self.tfrecord_file) as writer:
+            for record in self.records:
+                writer.write(record)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _build(self, **kwargs):
+        return TFRecordIndex.load_or_build(self.tfrecord_file, id_feature='id',
+                                           parser=_IdParser(), **kwargs)
+
+    def test_read_records(self):
+        index = self._build()
+        self.assertEqual(len(index), NUM_RECORDS)
+        self.assertTrue(os.path.exists(TFRecordIndex.index_path(self.tfrecord_file)))
+        self.assertEqual([(ordinal, bytes(record)) for ordinal, record in
+                          index.read_records([3, 0, -1], check_crc=True)],
+                         [(3, self.records[3]), (0, self.records[0]), (-1, self.records[-1])])
+
+    def test_read_ids_skips_missing_ids(self):
+        index = self._build()
+        self.assertEqual([(record_id, bytes(record)) for record_id, record in
+                          index.read_ids([_record_id(5), b'missing.jpg', _record_id(2)])],
+                         [(_record_id(5), self.records[5]), (_record_id(2), self.records[2])])
+        self.assertEqual(list(index.read_ids([b'missing.jpg'])), [])
+
+    def test_read_ids_without_id_feature_raises(self):
+        index = TFRecordIndex.load_or_build(self.tfrecord_file)
+        with self.assertRaises(ValueError):
+            list(index.read_ids([_record_id(0)]))
+
+    def test_loads_saved_index(self):
+        self._build()
+        index = TFRecordIndex.load(self.tfrecord_file)
+        self.assertIsNotNone(index)
+        self.assertEqual(index.id_feature, 'id')
+        self.assertEqual(len(index), NUM_RECORDS)
+
+    def test_stale_on_size_change(self):
+        self._build()
+        with TFRecordFileWriter(self.tfrecord_file) as writer:
+            for record in self.records[:NUM_RECORDS // 2]:
+                writer.write(record)
+
+        self.assertIsNone(TFRecordIndex.load(self.tfrecord_file))
+        self.assertEqual(len(self._build()), NUM_RECORDS // 2)
+
+    def test_stale_on_mtime_change(self):
+        index = self._build()
+        os.utime(self.tfrecord_file, ns=(index.file_mtime_ns, index.file_mtime_ns + 10 ** 9))
+
+        self.assertTrue(index.is_stale())
+        self.assertIsNone(TFRecordIndex.load(self.tfrecord_file))
+
+    def test_stale_when_file_is_removed(self):
+        index = self._build()
+        os.remove(self.tfrecord_file)
+        self.assertTrue(index.is_stale())
+
+    def test_rebuilds_for_another_id_feature(self):
+        TFRecordIndex.load_or_build(self.tfrecord_file)
+        self.assertEqual(self._build().id_feature, 'id')
+
+    def test_unsaved_index_is_used_from_memory(self):
+        index_file = os.path.join(self.temp_dir, 'missing_dir', 'data.tfrecord.idx')
+        with self.assertLogs(level='WARNING'):
+            index = self._build(index_file=index_file)
+
+        self.assertFalse(os.path.exists(os.path.dirname(index_file)))
+        self.assertEqual(len(index), NUM_RECORDS)
+        self.assertEqual([bytes(record) for _, record in index.read_ids([_record_id(7)])],
+                         [self.records[7]])
+
+    def test_corrupted_index_is_rebuilt(self):
+        with open(TFRecordIndex.index_path(self.tfrecord_file), 'wb') as index_stream:
+            index_stream.write(b'not an index')
+
+        self.assertIsNone(TFRecordIndex.load(self.tfrecord_file))
+        self.assertEqual(len(self._build()), NUM_RECORDS)
+
+    def test_pickled_index_is_not_loaded(self):
+        marker_file = os.path.join(self.temp_dir, 'unpickled')
+        with open(TFRecordIndex.index_path(self.tfrecord_file), 'wb') as index_stream:
+            pickle.dump({'version': TFRecordIndex.VERSION, 'offsets': _CreateFile(marker_file)},
+                        index_stream)
+
+        self.assertIsNone(TFRecordIndex.load(self.tfrecord_file))
+        self.assertFalse(os.path.exists(marker_file))
+        self.assertEqual(len(self._build()), NUM_RECORDS)
+        self.assertIsNotNone(TFRecordIndex.load(self.tfrecord_file))
+
+    def test_saved_ids_round_trip(self):
+        records = [encode_example_from_data_dict({'id': record_id, 'value': index})
+                   for index, record_id in enumerate([b'a\x00', b'a', b'', b'\xff\x00\x00'])]
+        with TFRecordFileWriter(self.tfrecord_file) as writer:
+            for record in records:
+                writer.write(record)
+
+        for id_feature, ids in [('id', [b'a\x00', b'a', b'', b'\xff\x00\x00']),
+                                ('value', [0, 1, 2, 3])]:
+            built_index = TFRecordIndex.load_or_build(self.tfrecord_file, id_feature=id_feature,
+                                                      parser=_IdParser())
+            index = TFRecordIndex.load(self.tfrecord_file)
+            self.assertEqual(index.id_to_offset, built_index.id_to_offset)
+            self.assertEqual(list(index.offsets), list(built_index.offsets))
+            self.assertEqual([bytes(record) for _, record in index.read_ids(ids)], records)
+
+    def test_empty_file(self):
+        with TFRecordFileWriter(self.tfrecord_file):
+            pass
+        self._build()
+        index = TFRecordIndex.load(self.tfrecord_file)
+        self.assertEqual((len(index), index.id_feature, index.id_to_offset), (0, 'id', {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
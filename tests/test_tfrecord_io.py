@@ -0,0 +1,174 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Tests of the TFRecord framing, reading and writing of `tfrecord_io` against TensorFlow's own
+TFRecord files.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from toolbox_az.tf_utils.tfrecord_io import (COMPRESSION_TYPES, NO_COMPRESSION,
+                                             TFRecordFileReader, TFRecordFileWriter,
+                                             TFRecordStreamReader, iterate_tfrecord)
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+def _make_records(num_records=50, seed=0):
+
+    rng = random.Random(seed)
+    # Includes an empty record and records longer than the stream reader buffer.
+    return [b''] + [bytes(rng.getrandbits(8) for _ in range(rng.choice([1, 7, 100, 5000])))
+                    for _ in range(num_records - 1)]
+
+
+class TFRecordIOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tfrecord_file = os.path.join(self.temp_dir, 'data.tfrecord')
+        self.records = _make_records()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, records=None, compression_type=None):
+
+        with TFRecordFileWriter(self.tfrecord_file, compression_type=compression_type) as writer:
+            for record in self.records if records is None else records:
+                writer.write(record)
+        return writer
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class TensorFlowCompatibilityTest(TFRecordIOTestCase):
+
+    def _write_with_tf(self, compression_type=NO_COMPRESSION):
+
+        options = tf.io.TFRecordOptions(compression_type=compression_type)
+        with tf.io.TFRecordWriter(self.tfrecord_file, options) as writer:
+            for record in self.records:
+                writer.write(record)
+
+    def _read_with_tf(self, compression_type=NO_COMPRESSION):
+
+        options = tf.io.TFRecordOptions(compression_type=compression_type)
+        return list(tf.compat.v1.io.tf_record_iterator(self.tfrecord_file, options))
+
+    def test_reads_tensorflow_files(self):
+        self._write_with_tf()
+        with TFRecordFileReader(self.tfrecord_file, check_crc=True) as reader:
+            self.assertEqual([bytes(record) for record in reader], self.records)
+
+    def test_reads_compressed_tensorflow_files(self):
+        for compression_type in COMPRESSION_TYPES:
+            self._write_with_tf(compression_type)
+            self.assertEqual([bytes(record) for record in iterate_tfrecord(
+                self.tfrecord_file, check_crc=True, compression_type=compression_type,
+                buffer_size=1000)], self.records, compression_type)
+
+    def test_writes_tensorflow_files(self):
+        self._write_with_tf()
+        with open(self.tfrecord_file, 'rb') as tfrecord_stream:
+            expected = tfrecord_stream.read()
+
+        self._write()
+        with open(self.tfrecord_file, 'rb') as tfrecord_stream:
+            self.assertEqual(tfrecord_stream.read(), expected)
+
+    def test_tensorflow_reads_compressed_files(self):
+        for compression_type in COMPRESSION_TYPES:
+            self._write(compression_type=compression_type)
+            self.assertEqual(self._read_with_tf(compression_type), self.records, compression_type)
+
+
+class TFRecordFileReaderTest(TFRecordIOTestCase):
+
+    def _truncate(self, length):
+
+        with open(self.tfrecord_file, 'r+b') as tfrecord_stream:
+            tfrecord_stream.truncate(length)
+
+    def _corrupt(self, offset):
+
+        with open(self.tfrecord_file, 'r+b') as tfrecord_stream:
+            tfrecord_stream.seek(offset)
+            value = tfrecord_stream.read(1)
+            tfrecord_stream.seek(offset)
+            tfrecord_stream.write(bytes([value[0] ^ 0x01]))
+
+    def test_round_trip(self):
+        writer = self._write()
+        self.assertEqual(writer.num_records, len(self.records))
+        self.assertEqual(writer.num_bytes, os.path.getsize(self.tfrecord_file))
+
+        with TFRecordFileReader(self.tfrecord_file, check_crc=True) as reader:
+            self.assertEqual([bytes(record) for record in reader], self.records)
+
+    def test_offsets(self):
+        self._write()
+        with TFRecordFileReader(self.tfrecord_file) as reader:
+            offsets = list(reader.iter_offsets())
+            self.assertEqual(offsets, [offset for offset, _ in
+                                       reader.iter_records(with_offsets=True)])
+            self.assertEqual(bytes(reader.read_at(offsets[5])[0]), self.records[5])
+            self.assertEqual(reader.next_offset(offsets[-1]), reader.size)
+            self.assertEqual([bytes(record) for record in reader.iter_records(offsets[-2])],
+                             self.records[-2:])
+
+    def test_empty_file(self):
+        self._write(records=[])
+        with TFRecordFileReader(self.tfrecord_file, check_crc=True) as reader:
+            self.assertEqual(list(reader), [])
+
+    def test_truncated_trailing_record(self):
+        self._write()
+        file_size = os.path.getsize(self.tfrecord_file)
+
+        # Truncated in the footer, the data and the header of the last record.
+        last_record_size = 16 + len(self.records[-1])
+        for length in (file_size - 1, file_size - 6, file_size - last_record_size + 5):
+            self._write()
+            self._truncate(length)
+
+            with TFRecordFileReader(self.tfrecord_file) as reader:
+                records = []
+                with self.assertRaises(IOError):
+                    for record in reader:
+                        records.append(bytes(record))
+            self.assertEqual(records, self.records[:-1], length)
+
+            with self.assertRaises(IOError):
+                list(TFRecordStreamReader(self.tfrecord_file, buffer_size=100))
+
+    def test_flipped_byte(self):
+        with TFRecordFileReader(self._write().tfrecord_file) as reader:
+            record_offset = list(reader.iter_offsets())[1]
+
+        # Offsets in the record of its length, length checksum, data and data checksum.
+        data_crc_offset = 12 + len(self.records[1])
+        for offset in (0, 8, 12, data_crc_offset):
+            self._write()
+            self._corrupt(record_offset + offset)
+
+            with TFRecordFileReader(self.tfrecord_file, check_crc=True) as reader:
+                with self.assertRaises(IOError):
+                    list(reader)
+            with self.assertRaises(IOError):
+                list(TFRecordStreamReader(self.tfrecord_file, check_crc=True))
+
+            # Without checking checksums a record with an intact length is read as is.
+            if offset != 0:
+                with TFRecordFileReader(self.tfrecord_file) as reader:
+                    records = [bytes(record) for record in reader]
+                self.assertEqual(len(records), len(self.records))
+                self.assertEqual(records[1] == self.records[1], offset != 12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Round trip tests of `tfrecord_writer.write_sharded_tfrecords`, read back with `iterate_tfrecord`.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from toolbox_az.tf_utils.example_wire import decode_example
+from toolbox_az.tf_utils.tfrecord_io import GZIP_COMPRESSION, iterate_tfrecord
+from toolbox_az.tf_utils.tfrecord_writer import shard_name, write_sharded_tfrecords
+
+
+def _features_dicts(num_records):
+
+    return ({'id': np.int64(index), 'name': 'record {}'.format(index)}
+            for index in range(num_records))
+
+
+def _read_ids(path, compression_type=None):
+
+    return [int(decode_example(record)['id'][1][0])
+            for record in iterate_tfrecord(path, compression_type=compression_type)]
+
+
+class WriteShardedTFRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_prefix = os.path.join(self.temp_dir, 'data.tfrecord')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _assert_manifest(self, manifest, expected_ids, compression_type=None):
+
+        self.assertEqual([_read_ids(shard['path'], compression_type)
+                          for shard in manifest['shards']], expected_ids)
+        self.assertEqual([shard['num_records'] for shard in manifest['shards']],
+                         [len(ids) for ids in expected_ids])
+        self.assertEqual(manifest['num_records'], sum(len(ids) for ids in expected_ids))
+        for shard in manifest['shards']:
+            self.assertEqual(shard['num_bytes'], os.path.getsize(shard['path']))
+        self.assertEqual(manifest['num_bytes'],
+                         sum(shard['num_bytes'] for shard in manifest['shards']))
+
+    def test_fixed_number_of_shards_is_round_robin(self):
+        manifest = write_sharded_tfrecords(_features_dicts(10), self.output_prefix, num_shards=3,
+                                           num_workers=0, chunk_size=4)
+        self.assertEqual([shard['path'] for shard in manifest['shards']],
+                         [shard_name(self.output_prefix, index, 3) for index in range(3)])
+        self._assert_manifest(manifest, [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+
+    def test_worker_processes_keep_input_order(self):
+        manifest = write_sharded_tfrecords(_features_dicts(100), self.output_prefix,
+                                           num_workers=2, chunk_size=7, max_in_flight_chunks=3)
+        self._assert_manifest(manifest, [list(range(100))])
+
+    def test_rotate_by_record_count(self):
+        manifest = write_sharded_tfrecords(_features_dicts(10), self.output_prefix,
+                                           max_records_per_shard=4, num_workers=0)
+        self.assertEqual([shard['path'] for shard in manifest['shards']],
+                         [shard_name(self.output_prefix, index, 3) for index in range(3)])
+        self._assert_manifest(manifest, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         sorted(os.path.basename(shard['path'])
+                                for shard in manifest['shards']))
+
+    def test_rotate_by_byte_size(self):
+        manifest = write_sharded_tfrecords(_features_dicts(20), self.output_prefix,
+                                           max_bytes_per_shard=100, num_workers=0)
+        expected_ids = [_read_ids(shard['path']) for shard in manifest['shards']]
+        self.assertGreater(len(expected_ids), 1)
+        self.assertEqual(sum(expected_ids, []), list(range(20)))
+        self._assert_manifest(manifest, expected_ids)
+
+    def test_compressed_shards_and_manifest_file(self):
+        manifest_file = os.path.join(self.temp_dir, 'manifest.json')
+        manifest = write_sharded_tfrecords(_features_dicts(9), self.output_prefix, num_shards=2,
+                                           compression_type=GZIP_COMPRESSION, num_workers=0,
+                                           manifest_file=manifest_file)
+        self._assert_manifest(manifest, [[0, 2, 4, 6, 8], [1, 3, 5, 7]], GZIP_COMPRESSION)
+        self.assertEqual(manifest['compression_type'], GZIP_COMPRESSION)
+        with open(manifest_file) as manifest_stream:
+            self.assertEqual(json.load(manifest_stream), manifest)
+
+    def test_empty_input(self):
+        manifest = write_sharded_tfrecords([], self.output_prefix, num_shards=2, num_workers=0)
+        self._assert_manifest(manifest, [[], []])
+
+    def test_num_shards_cannot_be_combined_with_rotation(self):
+        with self.assertRaises(ValueError):
+            write_sharded_tfrecords(_features_dicts(1), self.output_prefix, num_shards=2,
+                                    max_records_per_shard=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,31 +21,178 @@ arguments.
 
 """
 
-import json
-import pickle
+import copy
+import hashlib
+import os
 import sys
-import yaml
 
 
 from argparse import ArgumentParser, Namespace
 
+from toolbox_az.general.lazy_import import LazyModule
 
-def process_dict(dict_path):
+# Parsing modules are imported when a config file is parsed.
+json = LazyModule('json')
+pickle = LazyModule('pickle')
+yaml = LazyModule('yaml')
+
+PICKLE_FORMAT = 'pickle'
+YAML_FORMAT = 'yaml'
+JSON_FORMAT = 'json'
+
+_EXTENSION_TO_FORMAT = {
+    '.pkl': PICKLE_FORMAT,
+    '.pickle': PICKLE_FORMAT,
+    '.p': PICKLE_FORMAT,
+    '.yaml': YAML_FORMAT,
+    '.yml': YAML_FORMAT,
+    '.json': JSON_FORMAT,
+}
+
+# Environment variable of a directory where parsed configuration files are cached.
+CONFIG_CACHE_DIR_ENV = 'TOOLBOX_CONFIG_CACHE_DIR'
+
+# Parsed configuration files of this process, keyed by path, modification time and size.
+_parsed_config_cache = {}
+
+
+def _yaml_loader():
+
+    return getattr(yaml, 'CFullLoader', None) or getattr(yaml, 'FullLoader', yaml.Loader)
+
+
+def detect_config_format(file_path, data):
+    """
+    Detects the serialization format of a configuration file from its extension, or from its
+    first bytes if the extension is unknown.
+    :param file_path: A string of a file path.
+    :param data: The file content as bytes.
+    :return: One of `PICKLE_FORMAT`, `JSON_FORMAT` or `YAML_FORMAT`. Unknown text files are
+    reported as YAML, which is a superset of JSON.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in _EXTENSION_TO_FORMAT:
+        return _EXTENSION_TO_FORMAT[extension]
+
+    # Pickle protocols 2 and above start with the PROTO opcode.
+    if data[:1] == b'\x80':
+        return PICKLE_FORMAT
+
+    if data.lstrip()[:1] in (b'{', b'['):
+        return JSON_FORMAT
+
+    return YAML_FORMAT
+
+
+def _parse_pickle(data):
+    try:
+        return pickle.loads(data)
+    except (ValueError, TypeError, EOFError, KeyError, IndexError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return None
+
+
+def _parse_json(data):
+    try:
+        return json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+
+
+def _parse_yaml(data):
+    try:
+        parsed_dict = yaml.load(data, Loader=_yaml_loader())
+    except (ValueError, TypeError, yaml.YAMLError):
+        return None
+    return parsed_dict if isinstance(parsed_dict, dict) else None
+
+
+_FORMAT_PARSERS = {
+    PICKLE_FORMAT: _parse_pickle,
+    JSON_FORMAT: _parse_json,
+    YAML_FORMAT: _parse_yaml,
+}
+
+
+def _parse_config_data(file_path, data):
+    """
+    Parses configuration file content with the parser of its detected format. JSON-looking
+    content without a JSON extension falls back to YAML. Content of an unknown extension that
+    fails to parse as text falls back to pickle, since protocol 0 and 1 pickles have no marker.
     """
-    Parse a dictionary from dictionary serialization of pickle, yaml or json.
+    config_format = detect_config_format(file_path, data)
+    parsed_dict = _FORMAT_PARSERS[config_format](data)
+
+    has_known_extension = os.path.splitext(file_path)[1].lower() in _EXTENSION_TO_FORMAT
+    if parsed_dict is None and config_format == JSON_FORMAT and not has_known_extension:
+        parsed_dict = _parse_yaml(data)
+
+    if parsed_dict is None and config_format != PICKLE_FORMAT and not has_known_extension:
+        parsed_dict = _parse_pickle(data)
+
+    return parsed_dict
+
+
+def _disk_cache_path(cache_dir, cache_key):
+
+    key_hash = hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'config-{}.json'.format(key_hash))
+
+
+def _to_cache_json(parsed_dict):
+    """
+    :return: The JSON serialization of a parsed dict, or None if it does not parse back to an equal
+    dict, e.g. with tuples, non-string keys or values JSON has no type for.
+    """
+    try:
+        data = json.dumps(parsed_dict)
+    except (TypeError, ValueError):
+        return None
+    return data if json.loads(data) == parsed_dict else None
+
+
+def process_dict(dict_path, cache_dir=None):
+    """
+    Parse a dictionary from dictionary serialization of pickle, yaml or json. The format is
+    detected from the file extension or its first bytes and the file is read once. Parsed files
+    are cached by path, modification time and size, in memory and optionally on disk. The disk
+    cache is shared, so it is stored as JSON, which loading cannot run code from, and dicts that
+    JSON cannot represent are only cached in memory.
     :param dict_path: Path to serialized dictionary file which is with either pickle,
     yaml, or json.
-    :return: Parsed label to name dictionary.
+    :param cache_dir: Optional directory to cache parsed files in, shared between processes.
+    Defaults to the `TOOLBOX_CONFIG_CACHE_DIR` environment variable.
+    :return: Parsed label to name dictionary, or None if the file is not a dictionary file.
+    Every call returns a new copy, callers can change it without changing the cached dict.
     """
+    stat = os.stat(dict_path)
+    cache_key = (os.path.abspath(dict_path), stat.st_mtime_ns, stat.st_size)
 
-    parsed_dict = try_pickle_parse(dict_path)
-    if not parsed_dict:
-        parsed_dict = try_yml_parse(dict_path)
+    if cache_key in _parsed_config_cache:
+        return copy.deepcopy(_parsed_config_cache[cache_key])
 
-    if not parsed_dict:
-        parsed_dict = try_json_parse(dict_path)
+    cache_dir = cache_dir or os.environ.get(CONFIG_CACHE_DIR_ENV)
+    disk_cache_path = _disk_cache_path(cache_dir, cache_key) if cache_dir else None
 
-    return parsed_dict
+    parsed_dict = None
+    if disk_cache_path and os.path.exists(disk_cache_path):
+        with open(disk_cache_path, 'rb') as cache_file:
+            parsed_dict = _parse_json(cache_file.read())
+
+    if parsed_dict is None:
+        with open(dict_path, 'rb') as dict_file:
+            parsed_dict = _parse_config_data(dict_path, dict_file.read())
+
+        cache_json = _to_cache_json(parsed_dict) if disk_cache_path else None
+        if cache_json is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = '{}.tmp{}'.format(disk_cache_path, os.getpid())
+            with open(temp_path, 'w') as cache_file:
+                cache_file.write(cache_json)
+            os.replace(temp_path, disk_cache_path)
+
+    _parsed_config_cache[cache_key] = parsed_dict
+    return copy.deepcopy(parsed_dict)
 
 
 def try_pickle_parse(file_path):
@@ -54,12 +201,8 @@ def try_pickle_parse(file_path):
     :param file_path: A string of a file path to parse.
     :return: A dict of the parsed file content if the file is a pickle file, otherwise None.
     """
-    try:
-        with open(file_path, 'rb') as pickle_file:
-            parsed_dict = pickle.load(pickle_file)
-    except (ValueError, TypeError, pickle.UnpicklingError):
-        return None
-    return parsed_dict
+    with open(file_path, 'rb') as pickle_file:
+        return _parse_pickle(pickle_file.read())
 
 
 def try_json_parse(file_path):
@@ -68,12 +211,8 @@ def try_json_parse(file_path):
     :param file_path: A string of a file path to parse.
     :return: A dict of the parsed file content if the file is a Jason file, otherwise None.
     """
-    try:
-        with open(file_path, 'r') as json_file:
-            parsed_dict = json.loads(json_file)
-    except (ValueError, TypeError):
-        return None
-    return parsed_dict
+    with open(file_path, 'rb') as json_file:
+        return _parse_json(json_file.read())
 
 
 def try_yml_parse(file_path):
@@ -82,19 +221,13 @@ def try_yml_parse(file_path):
     :param file_path: A string of a file path to parse.
     :return: A dict of the parsed file content if the file is a yaml file, otherwise None.
     """
-    try:
-        with open(file_path, 'rb') as yaml_file:
-            parsed_dict = yaml.load(yaml_file)
-            if not isinstance(parsed_dict, dict):
-                return None
-    except (ValueError, TypeError, yaml.scanner.ScannerError):
-        return None
-    return parsed_dict
+    with open(file_path, 'rb') as yaml_file:
+        return _parse_yaml(yaml_file.read())
 
 
 class MyArguments(ArgumentParser):
 
-    def __init__(self, fromfile_prefix_chars=None):
+    def __init__(self, fromfile_prefix_chars=None, config_cache_dir=None):
         """
         Initializes extended argument parser. Initializes the `fromfile_prefix_chars` parameter to
         be the '@' character by default or user defining characters. To pass an argument file add a
@@ -103,6 +236,8 @@ class MyArguments(ArgumentParser):
 
         :param fromfile_prefix_chars: A List or a Tuple of special characters that are used to
         indicate an argument file parameter. Default is [@].
+        :param config_cache_dir: Optional directory to cache parsed dict-like argument files in,
+        see `process_dict`.
         """
         if fromfile_prefix_chars is None:
             fromfile_prefix_chars = ["@"]
@@ -113,6 +248,7 @@ class MyArguments(ArgumentParser):
         self.is_jupyter_notebook = any(["jupyter" in arg.lower() for arg in sys.argv[1:]])
 
         self.fromfile_prefix_chars = fromfile_prefix_chars
+        self.config_cache_dir = config_cache_dir
 
         # Initializes arguments dictionary.
         self.config_files_data = {}
@@ -187,7 +323,8 @@ class MyArguments(ArgumentParser):
             # argument strings from the file to the argument strings list of the command line.
             else:
                 config_file_path = arg_string[1:]
-                config_file_args = process_dict(dict_path=config_file_path)
+                config_file_args = process_dict(dict_path=config_file_path,
+                                                cache_dir=self.config_cache_dir)
 
                 if config_file_args:
                     self.config_files_data.update(config_file_args)
@@ -247,10 +384,9 @@ class MyArguments(ArgumentParser):
         config_files_args = [arg for arg in args if arg[0] in self.fromfile_prefix_chars]
         other_args = [arg for arg in args if arg[0] not in self.fromfile_prefix_chars]
 
-        # Parse the config files arguments and update the dict args so that arguments values are
-        # updated in the order of their appearance.
-        for config_file in config_files_args:
-            ArgumentParser.parse_args(self, args=[config_file])
+        # Read the config files once, in the order of their appearance. Dict-like files update the
+        # dict args, the arguments of text files are parsed before the command line arguments.
+        config_files_arg_strings = self._read_args_from_files(config_files_args)
 
         # Process the default arguments that override the default arguments values (that are
         # defined upon arguments declaration). These are the config files arguments, override by
@@ -258,7 +394,8 @@ class MyArguments(ArgumentParser):
         default_namespace = self.process_default_namespace(namespace_or_dict_args)
 
         # The new default arguments override by command line arguments.
-        self.args = ArgumentParser.parse_args(self, args=other_args, namespace=default_namespace)
+        self.args = ArgumentParser.parse_args(self, args=config_files_arg_strings + other_args,
+                                              namespace=default_namespace)
 
         return self.args
 
@@ -272,6 +409,112 @@ class MyArguments(ArgumentParser):
 
         return self.args.__dict__
 
+    def freeze(self):
+        """
+        Returns an immutable snapshot of the parsed arguments. Each argument is stored in a slot,
+        so reading it is a plain attribute lookup, and the snapshot pickles to the argument names
+        and values only. The values are copies of the parsed values and keep their types, e.g.
+        dict values stay subscriptable. The snapshot is hashable, its hash is computed from
+        immutable copies of the values, so the values should not be changed. Use
+        `install_frozen_flags` to make it the `Flags` singleton of worker processes.
+        :return: A `FrozenFlags` instance.
+        """
+        arguments = self.get_argument_dict()
+        names = tuple(sorted(arguments))
+        return _rebuild_frozen_flags(names, tuple(copy.deepcopy(arguments[name])
+                                                  for name in names))
+
+
+def _freeze_value(value):
+    """
+    Returns a hashable equivalent of an argument value: lists become tuples, sets become
+    frozensets and dicts become frozensets of their items, recursively. Only used as a hash key,
+    the argument values themselves are not changed.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_value(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze_value(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, _freeze_value(item)) for key, item in value.items())
+    return value
+
+
+class FrozenFlags(object):
+    """
+    Base class of immutable argument snapshots returned by `MyArguments.freeze`. A subclass with
+    the argument names as `__slots__` is created for every set of names.
+    """
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Frozen flags are read-only, cannot set {!r}.'.format(name))
+
+    def __delattr__(self, name):
+        raise AttributeError('Frozen flags are read-only, cannot delete {!r}.'.format(name))
+
+    def __reduce__(self):
+        return _rebuild_frozen_flags, (self.__slots__, self._values())
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenFlags) and self.__slots__ == other.__slots__ and \
+            self._values() == other._values()
+
+    def __hash__(self):
+        return hash((self.__slots__, tuple(_freeze_value(value) for value in self._values())))
+
+    def __repr__(self):
+        return '{}({})'.format(FrozenFlags.__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+    def _values(self):
+
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def get_argument_dict(self):
+        """
+        Returns the arguments as dict.
+        :return: Dict of the arguments.
+        """
+        return dict(zip(self.__slots__, self._values()))
+
+
+# `FrozenFlags` subclasses by their tuple of argument names.
+_frozen_flags_classes = {}
+
+
+def _rebuild_frozen_flags(names, values):
+    """
+    Creates a `FrozenFlags` instance of the given argument names and values. Also used to unpickle
+    frozen flags.
+    """
+    frozen_flags_class = _frozen_flags_classes.get(names)
+    if frozen_flags_class is None:
+        invalid_names = [name for name in names if not name.isidentifier()]
+        if invalid_names:
+            raise ValueError('Cannot freeze arguments whose names are not identifiers: {}'.format(
+                invalid_names))
+
+        frozen_flags_class = type(FrozenFlags.__name__, (FrozenFlags,), {'__slots__': names})
+        _frozen_flags_classes[names] = frozen_flags_class
+
+    frozen_flags = frozen_flags_class.__new__(frozen_flags_class)
+    for name, value in zip(names, values):
+        object.__setattr__(frozen_flags, name, value)
+    return frozen_flags
+
+
+def install_frozen_flags(frozen_flags):
+    """
+    Sets frozen flags as the `Flags` singleton, so `Flags()` returns them without parsing the
+    command line. Meant as the initializer of worker processes, for example:
+                        executor = ProcessPoolExecutor(initializer=install_frozen_flags,
+                                                       initargs=(Flags().freeze(),))
+    :param frozen_flags: A `FrozenFlags` instance returned by `MyArguments.freeze`.
+    """
+    Flags.instance = frozen_flags
+
 
 class SingletonDecorator:
     """
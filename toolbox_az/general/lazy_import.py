@@ -0,0 +1,46 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Deferred module imports.
+
+A `LazyModule` stands in for a module and imports it on the first attribute access, so heavy
+dependencies such as TensorFlow are only loaded by the code paths that use them.
+
+Example:
+                        tf = LazyModule('tensorflow')
+                        # ... TensorFlow is not imported yet ...
+                        features = tf.parse_single_example(serialized, features_map)
+"""
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    A proxy of the module `name` that imports it on first attribute access.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: The absolute name of the module to import, e.g. 'tensorflow.python.ops'.
+        """
+        super(LazyModule, self).__init__(name)
+
+    def _load(self):
+
+        module = importlib.import_module(self.__name__)
+        # Copy the module attributes so later lookups do not go through `__getattr__`.
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, name):
+        """
+        Called for attributes that were not copied from the module yet, imports the module.
+        """
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.__name__)
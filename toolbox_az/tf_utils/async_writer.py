@@ -0,0 +1,228 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+An asyncio TFRecord writer.
+
+`AsyncTFRecordWriter.write` serializes a feature dict on an executor and puts the framed record
+on a bounded queue, waiting while the queue is full, so producers are slowed down to the write
+rate. A single writer task drains the queue, joins the queued records into large appends and
+writes them on a dedicated I/O thread, so the event loop never blocks on serialization or disk.
+The file can be flushed, and optionally synced to disk, periodically and on demand.
+
+Example:
+                        async with AsyncTFRecordWriter(path, flush_interval=5.0) as writer:
+                            async for features_dict in produce_features():
+                                await writer.write(features_dict)
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from toolbox_az.tf_utils.example_wire import encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter, frame_record
+
+
+def _serialize_features(features_dict):
+
+    return frame_record(encode_example_from_data_dict(features_dict))
+
+
+class AsyncTFRecordWriter(object):
+    """
+    Writes feature dicts to a TFRecord file from coroutines, with backpressure.
+    """
+
+    def __init__(self, tfrecord_file, compression_type=None, compression_level=6,
+                 max_queue_size=1024, max_append_bytes=2 ** 22, flush_interval=None, fsync=False,
+                 executor=None):
+        """
+        :param tfrecord_file: Path of the file to write.
+        :param compression_type: One of `tfrecord_io.COMPRESSION_TYPES`, None for no compression.
+        :param compression_level: Compression level between 0 and 9.
+        :param max_queue_size: Maximal number of serialized records waiting to be written.
+        `write` waits while the queue is full.
+        :param max_append_bytes: Queued records are joined into appends of up to this many bytes.
+        :param flush_interval: If given, flush the file when this many seconds passed since the
+        last flush and records were written since.
+        :param fsync: If True, every flush, periodic or requested, and closing also sync the file
+        to disk.
+        :param executor: Executor feature dicts are serialized on, None for the default executor
+        of the event loop.
+        """
+        self.tfrecord_file = tfrecord_file
+        self.compression_type = compression_type
+        self.compression_level = compression_level
+        self.max_queue_size = max_queue_size
+        self.max_append_bytes = max_append_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.executor = executor
+
+        # Number of records and of uncompressed bytes written to the file so far.
+        self.num_records = 0
+        self.num_bytes = 0
+
+        self._writer = None
+        self._queue = None
+        self._task = None
+        self._io_executor = None
+        self._open_lock = None
+        self._error = None
+        self._closed = False
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """
+        Opens the file and starts the writer task. Called by `write` if needed.
+        """
+        if self._closed:
+            raise ValueError('Writer of {} is closed.'.format(self.tfrecord_file))
+        if self._task is not None:
+            return
+
+        # Concurrent first writes wait for a single open, the lock is created before any await.
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+
+        async with self._open_lock:
+            if self._task is not None:
+                return
+
+            loop = asyncio.get_running_loop()
+            io_executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                self._writer = await loop.run_in_executor(
+                    io_executor, TFRecordFileWriter, self.tfrecord_file, self.compression_type,
+                    self.compression_level)
+            except BaseException:
+                io_executor.shutdown(wait=False)
+                raise
+            self._io_executor = io_executor
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._task = loop.create_task(self._run())
+
+    def _check_error(self):
+
+        if self._error is not None:
+            raise IOError('Writing {} failed.'.format(self.tfrecord_file)) from self._error
+
+    async def write(self, features_dict):
+        """
+        Serializes a feature dict on the executor and queues it for writing. Waits while the queue
+        is full. Serialization errors are raised here, write errors by the next call.
+        :param features_dict: A dict of feature name to data, as accepted by
+        `build_example_from_data_dict`.
+        """
+        await self.open()
+        self._check_error()
+
+        loop = asyncio.get_running_loop()
+        framed_record = await loop.run_in_executor(self.executor, _serialize_features,
+                                                   features_dict)
+        await self._queue.put(framed_record)
+
+    async def write_serialized(self, example_serialized):
+        """
+        Queues an already serialized Example for writing. Waits while the queue is full.
+        :param example_serialized: A serialized Example as bytes.
+        """
+        await self.open()
+        self._check_error()
+        await self._queue.put(frame_record(example_serialized))
+
+    async def flush(self):
+        """
+        Waits until all queued records are written and flushed, and synced if `fsync` is set.
+        """
+        if self._task is None:
+            return
+        self._check_error()
+
+        flushed = asyncio.get_running_loop().create_future()
+        await self._queue.put(flushed)
+        await flushed
+
+    async def close(self):
+        """
+        Writes the queued records, flushes and closes the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is None:
+            return
+
+        await self._queue.put(None)
+        await self._task
+        self._io_executor.shutdown(wait=True)
+        self._check_error()
+
+    async def _run(self):
+        """
+        The writer task. Queue items are framed records, futures requesting a flush, or None to
+        close the file.
+        """
+        loop = asyncio.get_running_loop()
+        last_flush_time = time.monotonic()
+        unflushed = False
+
+        while True:
+            timeout = None
+            if self.flush_interval is not None and unflushed:
+                timeout = max(0.0, last_flush_time + self.flush_interval - time.monotonic())
+
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = False
+
+            # Join the records that are already queued into a single append.
+            records = []
+            num_bytes = 0
+            while isinstance(item, bytes):
+                records.append(item)
+                num_bytes += len(item)
+                if num_bytes >= self.max_append_bytes or self._queue.empty():
+                    item = False
+                    break
+                item = self._queue.get_nowait()
+
+            try:
+                if records and self._error is None:
+                    await loop.run_in_executor(self._io_executor, self._writer.write_framed,
+                                               b''.join(records), len(records))
+                    self.num_records = self._writer.num_records
+                    self.num_bytes = self._writer.num_bytes
+                    unflushed = True
+
+                flush_due = self.flush_interval is not None and unflushed and \
+                    time.monotonic() - last_flush_time >= self.flush_interval
+                if self._error is None and (flush_due or item is None or
+                                            isinstance(item, asyncio.Future)):
+                    await loop.run_in_executor(
+                        self._io_executor, self._writer.sync if self.fsync else self._writer.flush)
+                    last_flush_time = time.monotonic()
+                    unflushed = False
+            except Exception as error:
+                # Keep draining the queue so waiting producers are released, the error is
+                # raised by their next call.
+                self._error = error
+
+            if isinstance(item, asyncio.Future):
+                if self._error is None:
+                    item.set_result(None)
+                else:
+                    item.set_exception(IOError('Writing {} failed.'.format(self.tfrecord_file)))
+
+            if item is None:
+                try:
+                    await loop.run_in_executor(self._io_executor, self._writer.close)
+                except Exception as error:
+                    self._error = self._error or error
+                return
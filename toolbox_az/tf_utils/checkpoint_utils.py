@@ -0,0 +1,265 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Memory-bounded access to TensorFlow checkpoints.
+
+`LazyCheckpointTensors` is a read-only mapping of variable name to value. Names, shapes and dtypes
+are available right away, a tensor is read from the checkpoint only when it is accessed, and the
+values kept in memory are optionally capped by an LRU byte budget.
+
+`diff_ckpt` compares two checkpoints tensor by tensor on top of it.
+
+Example:
+                        weights = LazyCheckpointTensors(ckpt_file, name_filter='decoder/*',
+                                                        max_cached_bytes=2 ** 30)
+                        print(weights.shapes)
+                        kernel = weights['decoder/conv1/kernel']
+"""
+
+import fnmatch
+import re
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from toolbox_az.general.lazy_import import LazyModule
+
+np = LazyModule('numpy')
+
+
+def compile_name_filter(name_filter):
+    """
+    Compiles a variable name filter to a predicate.
+    :param name_filter: None to accept all names, a glob pattern string, a compiled regular
+    expression (matched with `search`), a list of glob patterns and regular expressions accepting
+    names that match any of them, or a predicate function.
+    :return: A function of a name returning True for accepted names.
+    """
+    if name_filter is None:
+        return lambda name: True
+
+    if callable(name_filter) and not isinstance(name_filter, re.Pattern):
+        return name_filter
+
+    if isinstance(name_filter, (str, re.Pattern)):
+        name_filter = [name_filter]
+
+    patterns = [re.compile(fnmatch.translate(pattern)) if isinstance(pattern, str) else pattern
+                for pattern in name_filter]
+
+    return lambda name: any(pattern.search(name) for pattern in patterns)
+
+
+class LazyCheckpointTensors(Mapping):
+    """
+    A read-only mapping of checkpoint variable names to NumPy values, read on access.
+    """
+
+    def __init__(self, ckpt_file_or_reader, name_filter=None, max_cached_bytes=None):
+        """
+        :param ckpt_file_or_reader: A checkpoint path or a reader returned by
+        `pywrap_tensorflow.NewCheckpointReader`.
+        :param name_filter: Restricts the variables of the mapping, see `compile_name_filter`.
+        :param max_cached_bytes: Maximal number of bytes of tensor values kept in memory. Least
+        recently used values are dropped first. None keeps every value that was read, 0 keeps
+        none.
+        """
+        if isinstance(ckpt_file_or_reader, str):
+            # Imported here so name filters can be used without TensorFlow.
+            from tensorflow.python import pywrap_tensorflow
+            self.reader = pywrap_tensorflow.NewCheckpointReader(ckpt_file_or_reader)
+        else:
+            self.reader = ckpt_file_or_reader
+
+        accept_name = compile_name_filter(name_filter)
+        var_to_shape_map = self.reader.get_variable_to_shape_map()
+        var_to_dtype_map = self.reader.get_variable_to_dtype_map()
+
+        self.shapes = {name: shape for name, shape in sorted(var_to_shape_map.items())
+                       if accept_name(name)}
+        self.dtypes = {name: var_to_dtype_map[name] for name in self.shapes}
+
+        self.max_cached_bytes = max_cached_bytes
+        self.cached_bytes = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Checkpoint readers are not thread safe.
+        self._reader_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def __contains__(self, name):
+        return name in self.shapes
+
+    def __getitem__(self, name):
+        if name not in self.shapes:
+            raise KeyError(name)
+
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return self._cache[name]
+
+        with self._reader_lock:
+            value = self.reader.get_tensor(name)
+        self._cache_value(name, value)
+        return value
+
+    def __repr__(self):
+        return '{}({} variables, {} bytes cached)'.format(
+            self.__class__.__name__, len(self), self.cached_bytes)
+
+    def _cache_value(self, name, value):
+
+        nbytes = getattr(value, 'nbytes', 0)
+        if self.max_cached_bytes is not None and nbytes > self.max_cached_bytes:
+            return
+
+        with self._lock:
+            if name in self._cache:
+                return
+            self._cache[name] = value
+            self.cached_bytes += nbytes
+
+            if self.max_cached_bytes is not None:
+                while self.cached_bytes > self.max_cached_bytes:
+                    _, evicted_value = self._cache.popitem(last=False)
+                    self.cached_bytes -= getattr(evicted_value, 'nbytes', 0)
+
+    def num_bytes(self, name):
+        """
+        :return: The size in bytes of the value of `name`, without reading it. String tensors
+        are reported as 0.
+        """
+        shape = self.shapes[name]
+        dtype = self.dtypes[name]
+        if dtype.is_numpy_compatible and dtype.as_numpy_dtype is not object:
+            num_elements = 1
+            for dim in shape:
+                num_elements *= dim
+            return num_elements * dtype.size
+        return 0
+
+    def clear_cache(self):
+        """
+        Drops all values held in memory.
+        """
+        with self._lock:
+            self._cache.clear()
+            self.cached_bytes = 0
+
+
+def _compare_tensors(value_a, value_b, chunk_size):
+    """
+    Computes difference statistics of two tensors of the same shape, in chunks of `chunk_size`
+    elements so that float64 temporaries stay small. Complex tensors are compared as complex128,
+    differences by their magnitude and the cosine by the real part of the inner product.
+    :return: A dict with `max_abs_diff`, `relative_l2_diff` (`|a - b| / |a|`),
+    `cosine_distance` (`1 - cos(a, b)`) and `num_nan`, the number of elements that are NaN in
+    either tensor, or with `equal` only for non-numeric tensors. NaNs propagate to the
+    statistics, so a diverged tensor never looks identical.
+    """
+    value_a = np.asarray(value_a).reshape(-1)
+    value_b = np.asarray(value_b).reshape(-1)
+
+    if value_a.dtype.kind not in 'biufc' or value_b.dtype.kind not in 'biufc':
+        return {'equal': bool(np.array_equal(value_a, value_b))}
+
+    # Casting complex values to float64 would drop their imaginary part.
+    if value_a.dtype.kind == 'c' or value_b.dtype.kind == 'c':
+        compute_dtype = np.complex128
+    else:
+        compute_dtype = np.float64
+
+    max_abs_diff = 0.0
+    num_nan = 0
+    diff_square_sum = 0.0
+    a_square_sum = 0.0
+    b_square_sum = 0.0
+    dot_product = 0.0
+    for start in range(0, value_a.size, chunk_size):
+        chunk_a = value_a[start:start + chunk_size].astype(compute_dtype)
+        chunk_b = value_b[start:start + chunk_size].astype(compute_dtype)
+        diff = chunk_a - chunk_b
+
+        # `np.maximum` propagates NaN, the builtin `max` would drop it.
+        max_abs_diff = float(np.maximum(max_abs_diff, np.max(np.abs(diff))))
+        num_nan += int(np.count_nonzero(np.isnan(chunk_a) | np.isnan(chunk_b)))
+        # `np.vdot` conjugates its first argument, so squared norms of complex values are real.
+        diff_square_sum += float(np.vdot(diff, diff).real)
+        a_square_sum += float(np.vdot(chunk_a, chunk_a).real)
+        b_square_sum += float(np.vdot(chunk_b, chunk_b).real)
+        dot_product += float(np.vdot(chunk_a, chunk_b).real)
+
+    diff_norm = np.sqrt(diff_square_sum)
+    a_norm = np.sqrt(a_square_sum)
+    b_norm = np.sqrt(b_square_sum)
+
+    if a_norm > 0:
+        relative_l2_diff = diff_norm / a_norm
+    else:
+        relative_l2_diff = 0.0 if diff_norm == 0 else float('inf')
+
+    if a_norm > 0 and b_norm > 0:
+        cosine_distance = 1.0 - dot_product / (a_norm * b_norm)
+    else:
+        cosine_distance = 0.0 if a_norm == b_norm else 1.0
+
+    # NaN norms fail the comparisons above, the statistics of tensors with NaNs are NaN.
+    if num_nan:
+        relative_l2_diff = cosine_distance = float('nan')
+
+    return {
+        'max_abs_diff': max_abs_diff,
+        'relative_l2_diff': float(relative_l2_diff),
+        'cosine_distance': float(cosine_distance),
+        'num_nan': num_nan,
+    }
+
+
+def diff_ckpt(ckpt_a, ckpt_b, name_filter=None, num_threads=0, chunk_size=2 ** 22):
+    """
+    Compares two checkpoints tensor by tensor. Tensors are read one pair at a time and are not
+    kept, so peak memory stays near the size of the largest tensor pair per thread.
+    :param ckpt_a: The reference checkpoint path.
+    :param ckpt_b: The compared checkpoint path.
+    :param name_filter: Restricts the compared variables, see `compile_name_filter`.
+    :param num_threads: Number of threads comparing tensors concurrently, 0 compares in the
+    calling thread. Checkpoint reads are serialized, the comparisons run in parallel.
+    :param chunk_size: Number of elements compared at once.
+    :return: A dict with the sorted lists `added` (only in `ckpt_b`) and `removed` (only in
+    `ckpt_a`), `changed_type`, a dict of name to `(shape_a, shape_b)` of `reshaped` variables, and
+    `tensors`, a dict of name to difference statistics as returned by `_compare_tensors` for the
+    variables found in both checkpoints with the same shape.
+    """
+    tensors_a = LazyCheckpointTensors(ckpt_a, name_filter=name_filter, max_cached_bytes=0)
+    tensors_b = LazyCheckpointTensors(ckpt_b, name_filter=name_filter, max_cached_bytes=0)
+
+    common_names = [name for name in tensors_a if name in tensors_b]
+    reshaped = {name: (tensors_a.shapes[name], tensors_b.shapes[name]) for name in common_names
+                if list(tensors_a.shapes[name]) != list(tensors_b.shapes[name])}
+    changed_type = sorted(name for name in common_names
+                          if tensors_a.dtypes[name] != tensors_b.dtypes[name])
+
+    compared_names = [name for name in common_names if name not in reshaped]
+
+    def compare(name):
+        return name, _compare_tensors(tensors_a[name], tensors_b[name], chunk_size)
+
+    if num_threads:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            compared_tensors = dict(executor.map(compare, compared_names))
+    else:
+        compared_tensors = dict(compare(name) for name in compared_names)
+
+    return {
+        'added': sorted(name for name in tensors_b if name not in tensors_a),
+        'removed': sorted(name for name in tensors_a if name not in tensors_b),
+        'changed_type': changed_type,
+        'reshaped': reshaped,
+        'tensors': compared_tensors,
+    }
@@ -0,0 +1,383 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Columnar NumPy export of TFRecord datasets.
+
+`export_tfrecord_to_columns` parses selected features of every record with
+`ExampleParser.parse_numpy` and writes each feature as a column of a directory:
+
+    fixed     Fixed length numeric features, a `.npy` array of shape `(num_records,) + shape`.
+    ragged    Variable length numeric features, the concatenated values as a raw `.bin` file and
+              `num_records + 1` int64 record offsets into them as `.npy`.
+    bytes     String features, the concatenated bytes as a raw `.bin` file, `num_values + 1` int64
+              value offsets into them and, unless the feature is a scalar, record offsets into the
+              values.
+
+A `manifest.json` describing the columns is written last. `load_columns` opens the columns lazily
+as memory maps, so dataset-wide audits run as vectorized NumPy over the columns.
+
+Example:
+                        export_tfrecord_to_columns(tfrecord_files, parser, '/data/columns',
+                                                   selected_features=['image/height',
+                                                                      'image/width'])
+                        columns = load_columns('/data/columns')
+                        aspect_ratios = columns['image/width'] / columns['image/height']
+"""
+
+import json
+import os
+import re
+from array import array
+from collections.abc import Mapping
+
+from toolbox_az.general.lazy_import import LazyModule
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileReader
+
+np = LazyModule('numpy')
+tf = LazyModule('tensorflow')
+
+MANIFEST_FILE = 'manifest.json'
+
+FIXED_COLUMN = 'fixed'
+RAGGED_COLUMN = 'ragged'
+BYTES_COLUMN = 'bytes'
+
+
+def _column_file_prefix(index, feature_name):
+
+    return '{:03d}-{}'.format(index, re.sub(r'[^A-Za-z0-9_.-]', '_', feature_name))
+
+
+def _check_shape(feature_name, record_index, value_shape, column_shape):
+
+    if list(value_shape) != column_shape:
+        raise ValueError(
+            'Feature {!r} of record {} has shape {}, but its column has shape {} from the first '
+            'record. Only variable length features may change their shape between '
+            'records.'.format(feature_name, record_index, list(value_shape), column_shape))
+
+
+def _is_bytes_value(value):
+
+    return isinstance(value, bytes) or (isinstance(value, np.ndarray) and value.dtype.kind in 'OS')
+
+
+class _FixedColumnWriter(object):
+
+    def __init__(self, output_dir, file_prefix, num_records, value, feature_name):
+        value = np.asarray(value)
+        self.feature_name = feature_name
+        self.file = file_prefix + '.npy'
+        self.shape = list(value.shape)
+        self.array = np.lib.format.open_memmap(
+            os.path.join(output_dir, self.file), mode='w+', dtype=value.dtype,
+            shape=(num_records,) + value.shape)
+
+    def write(self, record_index, value):
+        _check_shape(self.feature_name, record_index, np.shape(value), self.shape)
+        self.array[record_index] = value
+
+    def close(self):
+        self.array.flush()
+        description = {'kind': FIXED_COLUMN, 'dtype': self.array.dtype.str, 'shape': self.shape,
+                       'file': self.file}
+        del self.array
+        return description
+
+
+class _RaggedColumnWriter(object):
+
+    def __init__(self, output_dir, file_prefix, num_records, value):
+        self.values_file = file_prefix + '.values.bin'
+        self.offsets_file = file_prefix + '.offsets.npy'
+        self.dtype = np.asarray(value).dtype
+        self.num_values = 0
+        self.values = open(os.path.join(output_dir, self.values_file), 'wb')
+        self.offsets = np.lib.format.open_memmap(
+            os.path.join(output_dir, self.offsets_file), mode='w+', dtype=np.int64,
+            shape=(num_records + 1,))
+        self.offsets[0] = 0
+
+    def write(self, record_index, value):
+        value = np.ascontiguousarray(value, dtype=self.dtype).reshape(-1)
+        self.values.write(value.tobytes())
+        self.num_values += value.size
+        self.offsets[record_index + 1] = self.num_values
+
+    def close(self):
+        self.values.close()
+        self.offsets.flush()
+        del self.offsets
+        return {'kind': RAGGED_COLUMN, 'dtype': self.dtype.str, 'values_file': self.values_file,
+                'offsets_file': self.offsets_file}
+
+
+class _BytesColumnWriter(object):
+
+    def __init__(self, output_dir, file_prefix, num_records, value, feature_name,
+                 variable_length):
+        self.feature_name = feature_name
+        self.output_dir = output_dir
+        self.values_file = file_prefix + '.values.bin'
+        self.value_offsets_file = file_prefix + '.value_offsets.npy'
+        self.num_bytes = 0
+        self.values = open(os.path.join(output_dir, self.values_file), 'wb')
+        self.value_offsets = array('q', [0])
+
+        self.shape = None if variable_length else list(np.shape(value))
+        self.offsets_file = None
+        self.offsets = None
+        if self.shape != []:
+            self.offsets_file = file_prefix + '.offsets.npy'
+            self.offsets = np.lib.format.open_memmap(
+                os.path.join(output_dir, self.offsets_file), mode='w+', dtype=np.int64,
+                shape=(num_records + 1,))
+            self.offsets[0] = 0
+
+    def write(self, record_index, value):
+        if self.shape is not None:
+            _check_shape(self.feature_name, record_index, np.shape(value), self.shape)
+
+        if isinstance(value, bytes):
+            value = [value]
+        else:
+            value = np.asarray(value, dtype=object).reshape(-1)
+
+        for single_value in value:
+            self.values.write(single_value)
+            self.num_bytes += len(single_value)
+            self.value_offsets.append(self.num_bytes)
+
+        if self.offsets is not None:
+            self.offsets[record_index + 1] = len(self.value_offsets) - 1
+
+    def close(self):
+        self.values.close()
+        np.save(os.path.join(self.output_dir, self.value_offsets_file),
+                np.frombuffer(self.value_offsets, dtype=np.int64))
+        if self.offsets is not None:
+            self.offsets.flush()
+            del self.offsets
+        return {'kind': BYTES_COLUMN, 'shape': self.shape, 'values_file': self.values_file,
+                'value_offsets_file': self.value_offsets_file, 'offsets_file': self.offsets_file}
+
+
+def _make_column_writer(output_dir, file_prefix, num_records, value, feature_name,
+                        feature_config):
+
+    # Features of post parsing processes have no parse config.
+    variable_length = feature_config is not None and isinstance(feature_config, tf.VarLenFeature)
+
+    if _is_bytes_value(value):
+        return _BytesColumnWriter(output_dir, file_prefix, num_records, value, feature_name,
+                                  variable_length)
+    if variable_length:
+        return _RaggedColumnWriter(output_dir, file_prefix, num_records, value)
+    return _FixedColumnWriter(output_dir, file_prefix, num_records, value, feature_name)
+
+
+def export_tfrecord_to_columns(tfrecord_files, parser, output_dir, selected_features=None,
+                               check_crc=False):
+    """
+    Parses features of all records of TFRecord files and writes them as columns.
+    :param tfrecord_files: A TFRecord file path or a list of paths, exported in order.
+    :param parser: An `ExampleParser` instance.
+    :param output_dir: Directory the columns and the manifest are written to.
+    :param selected_features: A feature name, a list of feature names or None for all features.
+    Features produced by post parsing processes are exported as fixed or bytes columns according
+    to their value in the first record, and must keep its shape in all other records.
+    :param check_crc: If True, verify the checksums of the records.
+    :return: The manifest dict.
+    :raises ValueError: If a fixed shape feature changes its shape between records. No manifest
+    is written in that case.
+    """
+    if isinstance(tfrecord_files, str):
+        tfrecord_files = [tfrecord_files]
+
+    # The column sizes are known in advance, so fixed length columns are written in place.
+    num_records = 0
+    for tfrecord_file in tfrecord_files:
+        with TFRecordFileReader(tfrecord_file) as reader:
+            num_records += sum(1 for _ in reader.iter_offsets())
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    # A single feature is exported as a one feature dict, not parsed to its bare value.
+    if isinstance(selected_features, str):
+        selected_features = [selected_features]
+
+    features_to_parse = parser.get_plan(selected_features, return_as_dict=True).features_to_parse
+    writers = None
+    record_index = 0
+    try:
+        for tfrecord_file in tfrecord_files:
+            with TFRecordFileReader(tfrecord_file, check_crc=check_crc) as reader:
+                for record in reader.iter_records():
+                    features = parser.parse_numpy(record, selected_features=selected_features,
+                                                  return_as_dict=True)
+                    if writers is None:
+                        writers = {
+                            feature_name: _make_column_writer(
+                                output_dir, _column_file_prefix(index, feature_name),
+                                num_records, value, feature_name,
+                                features_to_parse.get(feature_name))
+                            for index, (feature_name, value) in enumerate(
+                                sorted(features.items()))}
+
+                    for feature_name, value in features.items():
+                        writers[feature_name].write(record_index, value)
+                    record_index += 1
+    finally:
+        columns = {feature_name: writer.close() for feature_name, writer in
+                   (writers or {}).items()}
+
+    manifest = {
+        'num_records': num_records,
+        'tfrecord_files': [os.path.abspath(tfrecord_file) for tfrecord_file in tfrecord_files],
+        'columns': columns,
+    }
+
+    temp_path = '{}.tmp{}'.format(manifest_path, os.getpid())
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+    return manifest
+
+
+def _map_raw_file(path, dtype):
+
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class RaggedColumn(object):
+    """
+    A column of variable length numeric values, stored as concatenated `values` and
+    `num_records + 1` record `offsets`.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, record_index):
+        return self.values[self.offsets[record_index]:self.offsets[record_index + 1]]
+
+    @property
+    def lengths(self):
+        """
+        :return: The number of values of every record.
+        """
+        return np.diff(self.offsets)
+
+
+class BytesColumn(object):
+    """
+    A column of string values, stored as concatenated bytes `values`, `num_values + 1`
+    `value_offsets` into them, and for non-scalar features record `offsets` into the values.
+    """
+
+    def __init__(self, values, value_offsets, offsets=None, shape=None):
+        self.values = values
+        self.value_offsets = value_offsets
+        self.offsets = offsets
+        self.shape = shape
+
+    def __len__(self):
+        if self.offsets is None:
+            return len(self.value_offsets) - 1
+        return len(self.offsets) - 1
+
+    def value(self, value_index):
+        """
+        :return: The bytes of a single value.
+        """
+        start = self.value_offsets[value_index]
+        return self.values[start:self.value_offsets[value_index + 1]].tobytes()
+
+    def __getitem__(self, record_index):
+        if self.offsets is None:
+            return self.value(record_index)
+        return [self.value(value_index) for value_index in
+                range(self.offsets[record_index], self.offsets[record_index + 1])]
+
+    @property
+    def value_lengths(self):
+        """
+        :return: The byte length of every value.
+        """
+        return np.diff(self.value_offsets)
+
+    @property
+    def lengths(self):
+        """
+        :return: The number of values of every record.
+        """
+        if self.offsets is None:
+            return np.ones(len(self), dtype=np.int64)
+        return np.diff(self.offsets)
+
+
+class ColumnarDataset(Mapping):
+    """
+    A read-only mapping of feature name to column of an exported directory. Columns are memory
+    mapped on first access. Fixed columns are arrays, the others are `RaggedColumn` and
+    `BytesColumn` instances.
+    """
+
+    def __init__(self, columns_dir):
+        self.columns_dir = columns_dir
+        with open(os.path.join(columns_dir, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        self.num_records = self.manifest['num_records']
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.manifest['columns'])
+
+    def __iter__(self):
+        return iter(sorted(self.manifest['columns']))
+
+    def __getitem__(self, feature_name):
+        if feature_name not in self._columns:
+            self._columns[feature_name] = self._load_column(self.manifest['columns'][feature_name])
+        return self._columns[feature_name]
+
+    def _path(self, file_name):
+
+        return os.path.join(self.columns_dir, file_name)
+
+    def _load_column(self, description):
+
+        if description['kind'] == FIXED_COLUMN:
+            return np.load(self._path(description['file']), mmap_mode='r')
+
+        if description['kind'] == RAGGED_COLUMN:
+            return RaggedColumn(
+                _map_raw_file(self._path(description['values_file']), description['dtype']),
+                np.load(self._path(description['offsets_file']), mmap_mode='r'))
+
+        offsets = None
+        if description['offsets_file']:
+            offsets = np.load(self._path(description['offsets_file']), mmap_mode='r')
+        return BytesColumn(
+            _map_raw_file(self._path(description['values_file']), np.uint8),
+            np.load(self._path(description['value_offsets_file']), mmap_mode='r'),
+            offsets, description['shape'])
+
+
+def load_columns(columns_dir):
+    """
+    Opens a directory written by `export_tfrecord_to_columns`.
+    :param columns_dir: The export directory.
+    :return: A `ColumnarDataset`.
+    """
+    return ColumnarDataset(columns_dir)
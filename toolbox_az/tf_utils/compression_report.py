@@ -0,0 +1,178 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Measured comparison of TFRecord compression codecs.
+
+`compression_report` samples records of a shard and, for every codec and level, compresses the
+framed sample in memory as `TFRecordFileWriter` does and reads it back with
+`TFRecordStreamReader`. It reports the compression ratio and the encode and decode throughput in
+MB/s of uncompressed data, so a codec can be picked for a dataset from measured numbers.
+
+Example:
+                        report = compression_report('/data/train.tfrecord-00000-of-00100')
+                        print(format_compression_report(report))
+
+or from the command line:
+                        python -m toolbox_az.tf_utils.compression_report <tfrecord_file>
+"""
+
+import argparse
+import gzip
+import io
+import random
+import time
+import zlib
+
+from toolbox_az.tf_utils.tfrecord_io import (GZIP_COMPRESSION, NO_COMPRESSION, ZLIB_COMPRESSION,
+                                             TFRecordStreamReader, frame_record,
+                                             iterate_tfrecord)
+
+# (compression_type, compression_level) pairs compared by default.
+DEFAULT_CODECS = (
+    (NO_COMPRESSION, None),
+    (ZLIB_COMPRESSION, 1),
+    (ZLIB_COMPRESSION, 6),
+    (ZLIB_COMPRESSION, 9),
+    (GZIP_COMPRESSION, 1),
+    (GZIP_COMPRESSION, 6),
+    (GZIP_COMPRESSION, 9),
+)
+
+_MEGABYTE = 1e6
+
+
+def sample_records(tfrecord_file, num_records=1000, seed=0, compression_type=None):
+    """
+    Samples records of a shard uniformly with a single pass of reservoir sampling.
+    :param tfrecord_file: Path to a TFRecord file.
+    :param num_records: Number of records to sample, all records of smaller shards are returned.
+    :param seed: Seed of the sample.
+    :param compression_type: Compression type of the shard.
+    :return: A list of records as bytes, in file order.
+    """
+    rng = random.Random(seed)
+    sample = []
+    for record_index, record in enumerate(iterate_tfrecord(tfrecord_file,
+                                                           compression_type=compression_type)):
+        if len(sample) < num_records:
+            sample.append((record_index, bytes(record)))
+            continue
+
+        sample_index = rng.randrange(record_index + 1)
+        if sample_index < num_records:
+            sample[sample_index] = (record_index, bytes(record))
+
+    return [record for _, record in sorted(sample)]
+
+
+def _compress(framed_records, compression_type, compression_level):
+
+    if compression_type == GZIP_COMPRESSION:
+        return gzip.compress(framed_records, compresslevel=compression_level, mtime=0)
+    if compression_type == ZLIB_COMPRESSION:
+        return zlib.compress(framed_records, compression_level)
+    return framed_records
+
+
+def _best_time(function, repeats):
+
+    best_time = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed_time = time.perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return best_time, result
+
+
+def compression_report(tfrecord_file, num_records=1000, codecs=DEFAULT_CODECS, repeats=3,
+                       buffer_size=None, seed=0, compression_type=None):
+    """
+    Measures the compression ratio and throughput of codecs on a sample of a shard.
+    :param tfrecord_file: Path to a TFRecord file.
+    :param num_records: Number of sampled records.
+    :param codecs: A sequence of `(compression_type, compression_level)` pairs.
+    :param repeats: Every measurement is repeated this many times and the fastest is reported.
+    :param buffer_size: Read buffer size of the decoding stream reader, None for the default.
+    :param seed: Seed of the sample.
+    :param compression_type: Compression type of the sampled shard itself.
+    :return: A list with a dict per codec of `compression_type`, `compression_level`,
+    `num_records`, `uncompressed_bytes`, `compressed_bytes`, `ratio` (uncompressed to compressed
+    size), `encode_mb_per_s`, None without compression, and `decode_mb_per_s`.
+    """
+    records = sample_records(tfrecord_file, num_records=num_records, seed=seed,
+                             compression_type=compression_type)
+    framed_records = b''.join(frame_record(record) for record in records)
+    uncompressed_bytes = len(framed_records)
+
+    report = []
+    for codec_type, codec_level in codecs:
+        encode_time, compressed = _best_time(
+            lambda: _compress(framed_records, codec_type, codec_level), repeats)
+
+        # Decoding includes splitting the records, as when reading a shard.
+        decode_time, num_decoded = _best_time(
+            lambda: sum(1 for _ in TFRecordStreamReader(
+                io.BytesIO(compressed), compression_type=codec_type, buffer_size=buffer_size)),
+            repeats)
+        if num_decoded != len(records):
+            raise IOError('Decoded {} records instead of {} with {}.'.format(
+                num_decoded, len(records), codec_type or 'no compression'))
+
+        report.append({
+            'compression_type': codec_type,
+            'compression_level': codec_level,
+            'num_records': len(records),
+            'uncompressed_bytes': uncompressed_bytes,
+            'compressed_bytes': len(compressed),
+            'ratio': uncompressed_bytes / len(compressed) if compressed else 1.0,
+            'encode_mb_per_s': None if codec_type == NO_COMPRESSION else
+            uncompressed_bytes / _MEGABYTE / max(encode_time, 1e-9),
+            'decode_mb_per_s': uncompressed_bytes / _MEGABYTE / max(decode_time, 1e-9),
+        })
+
+    return report
+
+
+def format_compression_report(report):
+    """
+    :param report: A list returned by `compression_report`.
+    :return: The report as a text table.
+    """
+    lines = ['{:<8} {:>5} {:>14} {:>8} {:>12} {:>12}'.format(
+        'codec', 'level', 'bytes', 'ratio', 'encode MB/s', 'decode MB/s')]
+    for codec in report:
+        encode_speed = codec['encode_mb_per_s']
+        lines.append('{:<8} {:>5} {:>14} {:>8.3f} {:>12} {:>12.1f}'.format(
+            codec['compression_type'] or 'NONE',
+            '-' if codec['compression_level'] is None else codec['compression_level'],
+            codec['compressed_bytes'],
+            codec['ratio'],
+            '-' if encode_speed is None else '{:.1f}'.format(encode_speed),
+            codec['decode_mb_per_s'],
+        ))
+    return '\n'.join(lines)
+
+
+def main():
+
+    argument_parser = argparse.ArgumentParser(
+        description='Report compression ratio and throughput of TFRecord codecs on a shard.')
+    argument_parser.add_argument('tfrecord_file')
+    argument_parser.add_argument('--num_records', type=int, default=1000)
+    argument_parser.add_argument('--repeats', type=int, default=3)
+    argument_parser.add_argument('--buffer_size', type=int, default=None)
+    argument_parser.add_argument('--compression_type', default=None,
+                                 help='Compression type of the shard itself.')
+    args = argument_parser.parse_args()
+
+    print(format_compression_report(compression_report(
+        args.tfrecord_file,
+        num_records=args.num_records,
+        repeats=args.repeats,
+        buffer_size=args.buffer_size,
+        compression_type=args.compression_type,
+    )))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+One-pass statistics of TFRecord datasets.
+
+`dataset_stats` scans shards in parallel, one process pool task per shard, and merges the
+per-shard statistics. For every feature of an `ExampleFeatures` schema it reports how often the
+feature is present, the distribution of its number of values, min/max/mean of numeric values, the
+length distribution of string values and the most common short strings. Duplicates of a bytes
+feature, `image/encoded` by default, are counted with content digests, so memory grows by a 16
+byte digest and its counter entry per distinct value instead of by the values themselves.
+
+Example:
+                        stats = dataset_stats('/data/train.tfrecord-*', ExampleFeatures())
+                        print(stats['features']['image/height']['mean'])
+                        print(stats['duplicates']['num_duplicates'])
+"""
+
+import hashlib
+import heapq
+import multiprocessing
+import os
+import struct
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from toolbox_az.general.lazy_import import LazyModule
+from toolbox_az.tf_utils.example_wire import decode_example
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileReader, expand_tfrecord_files
+
+np = LazyModule('numpy')
+tf = LazyModule('tensorflow')
+
+BYTES_KIND = 'bytes_list'
+FLOAT_KIND = 'float_list'
+INT64_KIND = 'int64_list'
+
+DIGEST_SIZE = 16
+
+_LENGTH_STRUCT = struct.Struct('<Q')
+
+
+def _schema_kinds(example_features):
+    """
+    :return: A dict of the name of every parsed feature of `example_features` to the kind of its
+    values in Example protos.
+    """
+    dtype_to_kind = {tf.string: BYTES_KIND, tf.float32: FLOAT_KIND, tf.int64: INT64_KIND}
+    return {feature_name: dtype_to_kind[feature_config.dtype]
+            for feature_name, feature_config in example_features.features_map.items()
+            if not isinstance(feature_config, dict)}
+
+
+class _FeatureStats(object):
+    """
+    Mergeable statistics of a single feature.
+    """
+
+    def __init__(self, kind, max_top_k_length, max_distinct_values):
+        self.kind = kind
+        self.max_top_k_length = max_top_k_length
+        self.max_distinct_values = max_distinct_values
+
+        self.num_present = 0
+        self.num_kind_mismatches = 0
+        self.value_counts = Counter()
+
+        self.num_values = 0
+        self.min = None
+        self.max = None
+        self.total = 0
+
+        # Bytes features: value length buckets, keyed by the exclusive power of two upper bound,
+        # and counts of short values.
+        self.length_buckets = Counter()
+        self.top_values = Counter()
+        self.top_values_truncated = False
+
+    def update(self, feature_kind, values):
+        """
+        Adds the values of a feature of one record.
+        :param feature_kind: The kind of the feature in the record.
+        :param values: The feature values as returned by `example_wire.decode_example`.
+        """
+        if feature_kind != self.kind:
+            self.num_kind_mismatches += 1
+            return
+
+        self.num_present += 1
+        self.value_counts[len(values)] += 1
+        if len(values) == 0:
+            return
+
+        self.num_values += len(values)
+
+        if self.kind == BYTES_KIND:
+            lengths = [len(value) for value in values]
+            values_min, values_max, values_total = min(lengths), max(lengths), sum(lengths)
+            for length in lengths:
+                self.length_buckets[1 << length.bit_length()] += 1
+
+            if not self.top_values_truncated:
+                for value in values:
+                    if len(value) <= self.max_top_k_length:
+                        self.top_values[value.tobytes()] += 1
+                self._check_top_values()
+        else:
+            values_min, values_max = values.min().item(), values.max().item()
+            values_total = values.sum(
+                dtype=np.float64 if self.kind == FLOAT_KIND else np.int64).item()
+
+        self.min = values_min if self.min is None else min(self.min, values_min)
+        self.max = values_max if self.max is None else max(self.max, values_max)
+        self.total += values_total
+
+    def _check_top_values(self):
+
+        # Fields with too many distinct values are not categorical, stop counting them.
+        if len(self.top_values) > self.max_distinct_values:
+            self.top_values.clear()
+            self.top_values_truncated = True
+
+    def merge(self, other):
+        self.num_present += other.num_present
+        self.num_kind_mismatches += other.num_kind_mismatches
+        self.value_counts.update(other.value_counts)
+        self.num_values += other.num_values
+        self.total += other.total
+        for bound in ('min', 'max'):
+            other_value = getattr(other, bound)
+            if other_value is not None:
+                value = getattr(self, bound)
+                combine = min if bound == 'min' else max
+                setattr(self, bound, other_value if value is None else combine(value, other_value))
+
+        self.length_buckets.update(other.length_buckets)
+        self.top_values_truncated |= other.top_values_truncated
+        if self.top_values_truncated:
+            self.top_values.clear()
+        else:
+            self.top_values.update(other.top_values)
+            self._check_top_values()
+
+    def summary(self, num_records, top_k):
+        summary = {
+            'kind': self.kind,
+            'num_present': self.num_present,
+            'presence_rate': self.num_present / num_records if num_records else 0.0,
+            'num_kind_mismatches': self.num_kind_mismatches,
+            'value_counts': dict(sorted(self.value_counts.items())),
+            'num_values': self.num_values,
+        }
+
+        mean = self.total / self.num_values if self.num_values else None
+        if self.kind == BYTES_KIND:
+            summary['length'] = {
+                'min': self.min,
+                'max': self.max,
+                'mean': mean,
+                'histogram': dict(sorted(self.length_buckets.items())),
+            }
+            # Ties are ordered by value, so the result does not depend on the shard merge order.
+            summary['top_values'] = None if self.top_values_truncated else heapq.nsmallest(
+                top_k, self.top_values.items(), key=lambda item: (-item[1], item[0]))
+        else:
+            summary.update({'min': self.min, 'max': self.max, 'mean': mean})
+
+        return summary
+
+
+class _ShardStats(object):
+    """
+    Mergeable statistics of one or more shards.
+    """
+
+    def __init__(self, schema_kinds, duplicate_feature, max_top_k_length, max_distinct_values):
+        self.num_shards = 0
+        self.num_records = 0
+        self.num_bytes = 0
+        self.features = {feature_name: _FeatureStats(kind, max_top_k_length, max_distinct_values)
+                         for feature_name, kind in schema_kinds.items()}
+        self.duplicate_feature = duplicate_feature
+        self.digest_counts = Counter()
+        self._decoded_keys = set(schema_kinds) | ({duplicate_feature} if duplicate_feature
+                                                  else set())
+
+    def update(self, example_serialized):
+        self.num_records += 1
+        self.num_bytes += len(example_serialized)
+
+        # Only schema features are decoded, values are hashed straight from the record buffer.
+        raw_features = decode_example(example_serialized, self._decoded_keys)
+        for feature_name, (feature_kind, values) in raw_features.items():
+            if feature_name in self.features:
+                feature_stats = self.features[feature_name]
+                feature_stats.update(feature_kind or feature_stats.kind, values)
+
+        if self.duplicate_feature and self.duplicate_feature in raw_features:
+            digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+            feature_kind, values = raw_features[self.duplicate_feature]
+            if feature_kind == BYTES_KIND:
+                # Every value is prefixed by its length, so different splits of the same bytes
+                # into values have different digests.
+                for value in values:
+                    digest.update(_LENGTH_STRUCT.pack(len(value)))
+                    digest.update(value)
+            self.digest_counts[digest.digest()] += 1
+
+    def merge(self, other):
+        self.num_shards += other.num_shards
+        self.num_records += other.num_records
+        self.num_bytes += other.num_bytes
+        for feature_name, feature_stats in self.features.items():
+            feature_stats.merge(other.features[feature_name])
+        self.digest_counts.update(other.digest_counts)
+
+    def summary(self, top_k):
+        summary = {
+            'num_shards': self.num_shards,
+            'num_records': self.num_records,
+            'num_bytes': self.num_bytes,
+            'features': {feature_name: feature_stats.summary(self.num_records, top_k)
+                         for feature_name, feature_stats in sorted(self.features.items())},
+        }
+
+        if self.duplicate_feature:
+            num_hashed = sum(self.digest_counts.values())
+            summary['duplicates'] = {
+                'feature': self.duplicate_feature,
+                'num_hashed': num_hashed,
+                'num_unique': len(self.digest_counts),
+                'num_duplicates': num_hashed - len(self.digest_counts),
+                'num_duplicate_groups': sum(1 for count in self.digest_counts.values()
+                                            if count > 1),
+            }
+
+        return summary
+
+
+def _compute_shard_stats(tfrecord_file, schema_kinds, duplicate_feature, max_top_k_length,
+                         max_distinct_values, check_crc):
+
+    shard_stats = _ShardStats(schema_kinds, duplicate_feature, max_top_k_length,
+                              max_distinct_values)
+    shard_stats.num_shards = 1
+    with TFRecordFileReader(tfrecord_file, check_crc=check_crc) as reader:
+        for example_serialized in reader.iter_records():
+            shard_stats.update(example_serialized)
+    return shard_stats
+
+
+def dataset_stats(tfrecord_files, example_features, num_workers=None, top_k=10,
+                  max_top_k_length=64, max_distinct_values=10000,
+                  duplicate_feature='image/encoded', check_crc=False):
+    """
+    Computes statistics of the features of a dataset in a single pass over its shards.
+    :param tfrecord_files: A file path, a glob pattern or a list of them.
+    :param example_features: An `ExampleFeatures` instance, the features of its `features_map`
+    are reported.
+    :param num_workers: Number of worker processes, at most one per shard. Defaults to the number
+    of CPUs. 0 scans the shards in the calling process.
+    :param top_k: Number of most common values reported for string features.
+    :param max_top_k_length: String values longer than this are not counted for the most common
+    values.
+    :param max_distinct_values: Most common values are not reported for string features with more
+    distinct short values than this.
+    :param duplicate_feature: Name of a bytes feature whose duplicate values are counted, or None.
+    :param check_crc: If True, verify the checksums of the records.
+    :return: A dict with `num_shards`, `num_records`, `num_bytes`, `features`, a dict of feature
+    name to its statistics, and `duplicates` unless `duplicate_feature` is None.
+    """
+    tfrecord_files = expand_tfrecord_files(tfrecord_files)
+    schema_kinds = _schema_kinds(example_features)
+    shard_args = (schema_kinds, duplicate_feature, max_top_k_length, max_distinct_values,
+                  check_crc)
+
+    stats = _ShardStats(schema_kinds, duplicate_feature, max_top_k_length, max_distinct_values)
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(tfrecord_files))
+
+    if num_workers == 0:
+        for tfrecord_file in tfrecord_files:
+            stats.merge(_compute_shard_stats(tfrecord_file, *shard_args))
+        return stats.summary(top_k)
+
+    # Fork where available, so workers do not re-import the caller's main module.
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        futures = [executor.submit(_compute_shard_stats, tfrecord_file, *shard_args)
+                   for tfrecord_file in tfrecord_files]
+        for future in as_completed(futures):
+            stats.merge(future.result())
+
+    return stats.summary(top_k)
@@ -1,5 +1,6 @@
 # Copyright (c) 2017 Lightricks. All rights reserved.
 from toolbox_az.tf_utils.example_utils import ParseConfigFeatures
+from toolbox_az.tf_utils.image_processing import ImageDecoder
 
 
 class ExampleFeatures(object):
@@ -15,7 +16,18 @@ class ExampleFeatures(object):
      image_buffer: Tensor tf.string containing the contents of a JPEG file.
     """
 
-    def __init__(self):
+    def __init__(self, decode_images=False, resize=None, decoded_image_cache=None,
+                 num_threads=None):
+        """
+        :param decode_images: If True, add the 'image/decoded' and
+        'image/segmentation/class/decoded' features, decoded from the encoded image and mask by
+        their stored formats.
+        :param resize: Optional `(height, width)` decoded images and masks are resized to. Masks
+        are resized with nearest neighbor interpolation.
+        :param decoded_image_cache: Optional `DecodedImageCache` of decoded images and masks, keyed
+        by 'image/filename'. Used when parsing to NumPy.
+        :param num_threads: Number of threads decoding batches of NumPy images.
+        """
 
         self.features_map = {
             "image/encoded": ParseConfigFeatures.string_feature(default_value=''),
@@ -30,3 +42,22 @@ class ExampleFeatures(object):
         }
 
         self.post_parsing_process = {}
+
+        if decode_images:
+            self.features_map["image/decoded"] = {
+                "image/encoded": None, "image/format": None, "image/filename": None}
+            self.post_parsing_process["image/decoded"] = ImageDecoder(
+                "image/encoded", "image/format", "image/decoded", channels=3, resize=resize,
+                cache=decoded_image_cache, cache_key_feature="image/filename",
+                num_threads=num_threads)
+
+            self.features_map["image/segmentation/class/decoded"] = {
+                "image/segmentation/class/encoded": None,
+                "image/segmentation/class/format": None,
+                "image/filename": None,
+            }
+            self.post_parsing_process["image/segmentation/class/decoded"] = ImageDecoder(
+                "image/segmentation/class/encoded", "image/segmentation/class/format",
+                "image/segmentation/class/decoded", channels=1, resize=resize,
+                nearest_neighbor=True, cache=decoded_image_cache,
+                cache_key_feature="image/filename", num_threads=num_threads)
@@ -1,6 +1,14 @@
 # Copyright (c) 2017 Lightricks. All rights reserved.
-import numpy as np
-import tensorflow as tf
+import threading
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+from toolbox_az.general.lazy_import import LazyModule
+from toolbox_az.tf_utils.example_wire import decode_example
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter
+
+np = LazyModule('numpy')
+tf = LazyModule('tensorflow')
 
 
 class ParseConfigFeatures(object):
@@ -29,11 +37,38 @@ class ParseConfigFeatures(object):
         return ParseConfigFeatures._feature(tf.string, variable_len, array_shape, default_value)
 
 
+# An immutable, compiled selection of features.
+#   features_to_parse: A read-only mapping of feature name to parse config.
+#   post_parsing_features: Names of the post parsing processes to run, in selection order.
+#   layout: One of `SINGLE_LAYOUT`, `DICT_LAYOUT` or `LIST_LAYOUT`.
+#   output_features: Names of the output features, in selection order.
+ParsePlan = namedtuple('ParsePlan', ['features_to_parse', 'post_parsing_features', 'layout',
+                                     'output_features'])
+
+PlanCacheInfo = namedtuple('PlanCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+SINGLE_LAYOUT = 'single'
+DICT_LAYOUT = 'dict'
+LIST_LAYOUT = 'list'
+
+
 class ExampleParser(object):
 
-    def __init__(self, example_features):
+    def __init__(self, example_features, plan_cache_size=128):
+        """
+        :param example_features: A features description object with `features_map` and
+        `post_parsing_process` dicts.
+        :param plan_cache_size: Maximal number of compiled parse plans kept by the parser. Least
+        recently used plans are evicted first.
+        """
         self.example_features = example_features
 
+        self.plan_cache_size = plan_cache_size
+        self.plan_cache_hits = 0
+        self.plan_cache_misses = 0
+        self._plan_cache = OrderedDict()
+        self._plan_cache_lock = threading.Lock()
+
     def _process_features_to_parse(self, features_map, selected_features):
 
         features_to_parse = {}
@@ -51,37 +86,207 @@ class ExampleParser(object):
 
         return features_to_parse
 
-    def parse(self, example_serialized, selected_features=None, return_as_dict=False):
+    def _compile_plan(self, selected_features, layout):
 
         features_map = self.example_features.features_map
         post_parsing_process = self.example_features.post_parsing_process
 
-        single_feature = False
+        if selected_features is None:
+            selected_features = sorted(features_map.keys() | post_parsing_process.keys())
+
+        features_to_parse = self._process_features_to_parse(features_map, selected_features)
+
+        # Keep the selection order and drop duplicates, so post parsing processes run once.
+        unique_selected_features = tuple(OrderedDict.fromkeys(selected_features))
+
+        return ParsePlan(
+            features_to_parse=MappingProxyType(features_to_parse),
+            post_parsing_features=tuple(feature_name for feature_name in unique_selected_features
+                                        if feature_name in post_parsing_process),
+            layout=layout,
+            output_features=tuple(selected_features) if layout == LIST_LAYOUT
+            else unique_selected_features,
+        )
+
+    def get_plan(self, selected_features=None, return_as_dict=False):
+        """
+        Returns the compiled parse plan of a feature selection, compiling it on the first use.
+        :param selected_features: A feature name, a list of feature names or None for all.
+        :param return_as_dict: If True, the plan outputs a dict of feature name to value.
+        :return: A `ParsePlan`.
+        """
         if isinstance(selected_features, str):
+            layout = SINGLE_LAYOUT
+            plan_key = (layout, selected_features)
             selected_features = [selected_features]
-            single_feature = True
 
         elif selected_features is None:
-            selected_features = features_map.keys() | post_parsing_process.keys()
-            return_as_dict = True
+            layout = DICT_LAYOUT
+            plan_key = (layout, None)
 
-        features_to_parse = self._process_features_to_parse(features_map, selected_features)
+        elif return_as_dict:
+            layout = DICT_LAYOUT
+            selected_features = tuple(selected_features)
+            # Keyed on the order too, since the output dict follows the selection order.
+            plan_key = (layout, selected_features)
 
-        features = tf.parse_single_example(example_serialized, features=features_to_parse)
+        else:
+            layout = LIST_LAYOUT
+            selected_features = tuple(selected_features)
+            plan_key = (layout, selected_features)
+
+        with self._plan_cache_lock:
+            plan = self._plan_cache.get(plan_key)
+            if plan is not None:
+                self.plan_cache_hits += 1
+                self._plan_cache.move_to_end(plan_key)
+                return plan
+
+            self.plan_cache_misses += 1
+
+        plan = self._compile_plan(selected_features, layout)
+
+        with self._plan_cache_lock:
+            self._plan_cache[plan_key] = plan
+            while len(self._plan_cache) > self.plan_cache_size:
+                self._plan_cache.popitem(last=False)
+
+        return plan
+
+    def plan_cache_info(self):
+        """
+        :return: A `PlanCacheInfo` with the plan cache hit and miss counters and its size.
+        """
+        with self._plan_cache_lock:
+            return PlanCacheInfo(hits=self.plan_cache_hits, misses=self.plan_cache_misses,
+                                 maxsize=self.plan_cache_size, currsize=len(self._plan_cache))
+
+    def clear_plan_cache(self):
+        """
+        Drops all compiled plans and resets the counters. Call it after changing the features map
+        or the post parsing processes of `example_features`.
+        """
+        with self._plan_cache_lock:
+            self._plan_cache.clear()
+            self.plan_cache_hits = 0
+            self.plan_cache_misses = 0
+
+    def _post_process_and_select(self, features, plan):
 
-        post_parsing_features = set(selected_features) & post_parsing_process.keys()
-        for feature_name in post_parsing_features:
+        post_parsing_process = self.example_features.post_parsing_process
+        for feature_name in plan.post_parsing_features:
             post_parsing_process[feature_name](features)
 
-        if single_feature:
-            return features[selected_features[0]]
+        if plan.layout == SINGLE_LAYOUT:
+            return features[plan.output_features[0]]
 
-        elif return_as_dict:
+        elif plan.layout == DICT_LAYOUT:
             return {feature_name: features[feature_name] for feature_name in
-                    set(selected_features) & features.keys()}
+                    plan.output_features if feature_name in features}
 
         else:
-            return [features[feature_name] for feature_name in selected_features]
+            return [features[feature_name] for feature_name in plan.output_features]
+
+    def parse(self, example_serialized, selected_features=None, return_as_dict=False):
+
+        plan = self.get_plan(selected_features, return_as_dict)
+
+        features = tf.parse_single_example(example_serialized, features=plan.features_to_parse)
+
+        return self._post_process_and_select(features, plan)
+
+    def parse_batch(self, example_serialized_batch, selected_features=None, return_as_dict=False,
+                    varlen_as_dense=False):
+        """
+        Parses a batch of serialized Examples with a single vectorized `tf.parse_example` op.
+        Selection, post parsing processes and output layout follow `parse`, with every feature
+        gaining a leading batch dimension. Post parsing processes receive the batched features.
+        :param example_serialized_batch: A 1-D string Tensor of serialized Examples.
+        :param selected_features: A feature name, a list of feature names or None for all.
+        :param return_as_dict: If True, return a dict of feature name to tensor.
+        :param varlen_as_dense: If True, variable length features are converted to dense tensors
+        padded to the longest example in the batch with zeros (empty strings for string
+        features). Otherwise they are returned as `tf.SparseTensor`.
+        :return: A single tensor, a list of tensors or a dict, as in `parse`.
+        """
+
+        plan = self.get_plan(selected_features, return_as_dict)
+
+        features = tf.parse_example(example_serialized_batch, features=plan.features_to_parse)
+
+        if varlen_as_dense:
+            for feature_name, feature_config in plan.features_to_parse.items():
+                if isinstance(feature_config, tf.VarLenFeature):
+                    default_value = '' if feature_config.dtype == tf.string else 0
+                    features[feature_name] = tf.sparse_tensor_to_dense(
+                        features[feature_name], default_value=default_value)
+
+        return self._post_process_and_select(features, plan)
+
+    def parse_numpy(self, example_serialized, selected_features=None, return_as_dict=False):
+        """
+        Parses a serialized Example to NumPy values without building a TF graph. The output has
+        the same layout as evaluating the tensors returned by `parse`, except that variable
+        length features are returned as 1-D arrays instead of sparse tensor values. Post parsing
+        processes receive the dict of NumPy values. Only the features of the plan are decoded,
+        the others are skipped in the wire format.
+        :param example_serialized: A serialized Example as bytes or a memoryview.
+        :param selected_features: A feature name, a list of feature names or None for all.
+        :param return_as_dict: If True, return a dict of feature name to value.
+        :return: A single value, a list of values or a dict, as in `parse`.
+        """
+
+        plan = self.get_plan(selected_features, return_as_dict)
+
+        raw_features = decode_example(example_serialized, plan.features_to_parse)
+
+        features = {}
+        for feature_name, feature_config in plan.features_to_parse.items():
+            values = None
+            if feature_name in raw_features:
+                kind, values = raw_features[feature_name]
+                if kind == 'bytes_list':
+                    values = [value.tobytes() for value in values]
+
+            features[feature_name] = _feature_values_to_numpy(feature_name, values, feature_config)
+
+        return self._post_process_and_select(features, plan)
+
+
+def _feature_values_to_numpy(feature_name, values, feature_config):
+    """
+    Converts raw Example feature values to a NumPy value matching `feature_config`.
+    :param feature_name: The feature name, used for error messages.
+    :param values: A sequence of feature values or None if the feature is missing.
+    :param feature_config: A `tf.FixedLenFeature` or a `tf.VarLenFeature`.
+    :return: A 1-D array for variable length features, otherwise a value of the configured
+    shape. Scalars are returned as NumPy scalars or bytes.
+    """
+    dtype = feature_config.dtype.as_numpy_dtype
+
+    if isinstance(feature_config, tf.VarLenFeature):
+        return np.array(values if values is not None else [], dtype=dtype)
+
+    shape = list(feature_config.shape)
+    if values is None or len(values) == 0:
+        if feature_config.default_value is None:
+            raise ValueError('Feature {} is required but could not be found.'.format(feature_name))
+        default_value = feature_config.default_value
+        if isinstance(default_value, str):
+            default_value = default_value.encode('utf-8')
+        value = np.array(default_value, dtype=dtype)
+        if value.size == 1:
+            value = np.full(shape, value.reshape(()), dtype=dtype)
+    else:
+        value = np.array(values, dtype=dtype)
+
+    try:
+        value = value.reshape(shape)
+    except ValueError:
+        raise ValueError('Feature {} has {} values, expected shape {}.'.format(
+            feature_name, value.size, shape))
+
+    return value[()] if not shape else value
 
 
 class ExampleFeatures(object):
@@ -99,7 +304,13 @@ class ExampleFeatures(object):
     @staticmethod
     def bytes_feature(value):
 
-        bytes_list = ExampleFeatures._to_list(value)
+        # Single values are kept as is, NumPy bytes arrays would strip their trailing NUL bytes.
+        if isinstance(value, (str, bytes)):
+            bytes_list = [value]
+        elif isinstance(value, np.ndarray) and value.dtype == np.uint8:
+            bytes_list = [value.tobytes()]
+        else:
+            bytes_list = ExampleFeatures._to_list(value)
         bytes_list = [s.encode("utf-8") if isinstance(s, str) else s for s in bytes_list]
         return tf.train.Feature(bytes_list=tf.train.BytesList(value=bytes_list))
 
@@ -161,3 +372,23 @@ def build_example_from_data_dict(features_data):
       raise TypeError("Type {} is not supported yet!".format(type(data)))
 
   return example_producer.produce_example()
+
+
+def write_examples_to_tfrecord(examples, tfrecord_file, compression_type=None,
+                               compression_level=6):
+    """
+    Writes examples to a TFRecord file, optionally GZIP or ZLIB compressed.
+    :param examples: An iterable of `ExampleProducer` instances or serialized Examples.
+    :param tfrecord_file: Path of the file to write.
+    :param compression_type: One of `tfrecord_io.COMPRESSION_TYPES`, None for no compression.
+    :param compression_level: Compression level between 0 and 9.
+    :return: The number of written records.
+    """
+    with TFRecordFileWriter(tfrecord_file, compression_type=compression_type,
+                            compression_level=compression_level) as writer:
+        for example in examples:
+            if isinstance(example, ExampleProducer):
+                example = example.produce_example()
+            writer.write(example)
+
+    return writer.num_records
@@ -0,0 +1,427 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Direct protobuf wire format encoding of `tf.train.Example` records.
+
+The encoder writes the Example wire format straight from NumPy buffers: float lists are packed
+from `ndarray.tobytes()`, int64 lists are varint encoded with vectorized NumPy operations and
+bytes values are joined into the output without intermediate copies. No `tf.train.Feature`
+objects are built and TensorFlow is not imported.
+
+The relevant part of the Example schema is:
+
+    message Example { Features features = 1; }
+    message Features { map<string, Feature> feature = 1; }
+    message Feature {
+        oneof kind { BytesList bytes_list = 1; FloatList float_list = 2; Int64List int64_list = 3; }
+    }
+    message BytesList { repeated bytes value = 1; }
+    message FloatList { repeated float value = 1 [packed = true]; }
+    message Int64List { repeated int64 value = 1 [packed = true]; }
+
+Map entries are written sorted by the UTF-8 bytes of their keys, so equal features always encode
+to equal bytes. Protobuf serialization does not promise a map order, and implementations differ
+on keys that share a prefix, e.g. upb writes 'k10' before 'k1'. The output therefore parses to
+the same Example as protobuf serialization, but is not always byte for byte identical to it.
+
+The decoder scans the same wire format and decodes only selected features. Map entries of other
+features are skipped by their length prefix, so large unselected values such as encoded images
+are neither parsed nor copied.
+"""
+
+import struct
+
+from toolbox_az.general.lazy_import import LazyModule
+
+np = LazyModule('numpy')
+
+# Tags of length delimited fields, (field_number << 3) | 2.
+_TAG_FIELD_1 = b'\x0a'
+_TAG_FIELD_2 = b'\x12'
+_TAG_FIELD_3 = b'\x1a'
+
+_BYTES_LIST_TAG = _TAG_FIELD_1
+_FLOAT_LIST_TAG = _TAG_FIELD_2
+_INT64_LIST_TAG = _TAG_FIELD_3
+
+# Bit offsets of the 7 bit groups of a 64 bit varint.
+_VARINT_SHIFTS = list(range(0, 64, 7))
+
+_FLOAT_STRUCT = struct.Struct('<f')
+
+# Protobuf wire types.
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+# `Feature` field numbers to the names of the `kind` oneof.
+_FEATURE_KINDS = {1: 'bytes_list', 2: 'float_list', 3: 'int64_list'}
+
+# Packed varint lists shorter than this are decoded without NumPy.
+_VECTORIZED_VARINTS_MIN_LENGTH = 16
+
+
+def encode_varint(value):
+    """
+    Encodes a single integer as a protobuf varint. Negative values are encoded as their 64 bit
+    two's complement, as protobuf does for int64 fields.
+    :param value: An integer.
+    :return: The varint bytes.
+    """
+    value &= 0xffffffffffffffff
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_varints(values):
+    """
+    Encodes an array of int64 values as concatenated protobuf varints.
+    :param values: An array-like of integers.
+    :return: The packed varint bytes.
+    """
+    values = np.ascontiguousarray(values, dtype=np.int64).reshape(-1).view(np.uint64)
+    if not values.size:
+        return b''
+
+    # Split every value to its 7 bit groups, the number of groups written is the number of
+    # non-zero shifted values, but at least one.
+    shifted = values[:, np.newaxis] >> np.array(_VARINT_SHIFTS, dtype=np.uint64)
+    lengths = np.maximum(np.count_nonzero(shifted, axis=1), 1)
+
+    group_index = np.arange(len(_VARINT_SHIFTS))
+    groups = (shifted & 0x7f).astype(np.uint8)
+    groups[group_index < (lengths[:, np.newaxis] - 1)] |= 0x80
+
+    return groups[group_index < lengths[:, np.newaxis]].tobytes()
+
+
+def _length_delimited(tag, parts):
+    """
+    Prefixes `parts` with a field tag and their total length.
+    :param tag: The encoded field tag.
+    :param parts: A list of bytes-like chunks of the field payload.
+    :return: A list of chunks of the whole field.
+    """
+    length = 0
+    for part in parts:
+        length += len(part) if type(part) is bytes else memoryview(part).nbytes
+    return [tag, encode_varint(length)] + parts
+
+
+def _to_flat_array(value, dtype):
+
+    return np.ascontiguousarray(value, dtype=dtype).reshape(-1)
+
+
+def _to_bytes_values(value):
+
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return [value]
+
+    # A uint8 array holds a single raw bytes value, e.g. an encoded image.
+    if isinstance(value, np.ndarray) and value.dtype == np.uint8:
+        return [np.ascontiguousarray(value).reshape(-1)]
+
+    if not hasattr(value, '__iter__'):
+        return [value]
+
+    return list(np.asarray(value, dtype=object).reshape(-1))
+
+
+def encode_bytes_feature(value):
+    """
+    Encodes a `Feature` with a bytes list.
+    :param value: A str, a bytes-like object, a uint8 array holding one raw value, or an
+    iterable of str and bytes-like objects. Strings are encoded as UTF-8.
+    :return: A list of bytes-like chunks of the encoded Feature.
+    """
+    bytes_list = []
+    for item in _to_bytes_values(value):
+        if isinstance(item, str):
+            item = item.encode('utf-8')
+        bytes_list.extend(_length_delimited(_TAG_FIELD_1, [item]))
+
+    return _length_delimited(_BYTES_LIST_TAG, bytes_list)
+
+
+def encode_float_feature(value):
+    """
+    Encodes a `Feature` with a packed float list.
+    :param value: A number or an array-like of numbers, stored as float32.
+    :return: A list of bytes-like chunks of the encoded Feature.
+    """
+    # Scalars skip the array conversions, which dominate the cost of small features. The value
+    # is rounded to float32 first, so out of range values become inf as in the array path.
+    if isinstance(value, (float, int, np.floating, np.integer)):
+        packed = _FLOAT_STRUCT.pack(np.float32(value))
+    else:
+        packed = _to_flat_array(value, '<f4').tobytes()
+    float_list = _length_delimited(_TAG_FIELD_1, [packed]) if packed else []
+
+    return _length_delimited(_FLOAT_LIST_TAG, float_list)
+
+
+def encode_int64_feature(value):
+    """
+    Encodes a `Feature` with a packed int64 list.
+    :param value: An integer or an array-like of integers.
+    :return: A list of bytes-like chunks of the encoded Feature.
+    """
+    if isinstance(value, (int, np.integer)):
+        packed = encode_varint(int(value))
+    else:
+        packed = encode_varints(_to_flat_array(value, np.int64))
+    int64_list = _length_delimited(_TAG_FIELD_1, [packed]) if packed else []
+
+    return _length_delimited(_INT64_LIST_TAG, int64_list)
+
+
+def encode_example(encoded_features):
+    """
+    Encodes an `Example` from already encoded features.
+    :param encoded_features: A dict of feature name to the chunks returned by one of the
+    `encode_*_feature` functions.
+    :return: The serialized Example as bytes.
+    """
+    features = []
+    sorted_features = sorted((feature_name.encode('utf-8'), feature_chunks)
+                             for feature_name, feature_chunks in encoded_features.items())
+    for feature_name, feature_chunks in sorted_features:
+        map_entry = _length_delimited(_TAG_FIELD_1, [feature_name]) + \
+            _length_delimited(_TAG_FIELD_2, feature_chunks)
+        features.extend(_length_delimited(_TAG_FIELD_1, map_entry))
+
+    return b''.join(_length_delimited(_TAG_FIELD_1, features))
+
+
+def _encode_data(data):
+
+    if isinstance(data, (str, bytes)) or \
+            (isinstance(data, np.ndarray) and data.dtype == np.uint8):
+        return encode_bytes_feature(data)
+
+    elif isinstance(data, (np.int64, int)) or \
+            (isinstance(data, np.ndarray) and data.dtype == np.int64):
+        return encode_int64_feature(data)
+
+    elif isinstance(data, (np.float32, float)) or \
+            (isinstance(data, np.ndarray) and data.dtype == np.float32):
+        return encode_float_feature(data)
+
+    raise TypeError("Type {} is not supported yet!".format(type(data)))
+
+
+def encode_example_from_data_dict(features_data):
+    """
+    A fast equivalent of `example_utils.build_example_from_data_dict`. The output parses to the
+    same Example, with the features map in byte-sorted key order. Feature types are chosen the
+    same way: str, bytes and uint8 arrays are bytes features, int64 data are int64 features and
+    float32 data are float features. A uint8 array is stored as a single raw bytes value.
+    :param features_data: A dict of feature name to data.
+    :return: The serialized Example as bytes.
+    """
+    return encode_example({feature_name: _encode_data(data)
+                           for feature_name, data in features_data.items()})
+
+
+def _read_varint(buffer, position):
+    """
+    Reads a varint from `buffer` at `position`.
+    :return: A tuple of the unsigned value and the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = buffer[position]
+        except IndexError:
+            raise ValueError('Truncated varint in serialized Example.')
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _to_int64(value):
+
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _iterate_fields(buffer, start, end):
+    """
+    Iterates over the fields of a message in `buffer[start:end]` without decoding their values.
+    :return: A generator of `(field_number, wire_type, value_start, value_end)`. For varint fields
+    the value range holds the varint bytes.
+    """
+    position = start
+    while position < end:
+        tag, position = _read_varint(buffer, position)
+        wire_type = tag & 7
+        value_start = position
+
+        if wire_type == _WIRE_LENGTH_DELIMITED:
+            length, value_start = _read_varint(buffer, position)
+            position = value_start + length
+        elif wire_type == _WIRE_VARINT:
+            _, position = _read_varint(buffer, position)
+        elif wire_type == _WIRE_FIXED64:
+            position += 8
+        elif wire_type == _WIRE_FIXED32:
+            position += 4
+        else:
+            raise ValueError('Unsupported wire type {} in serialized Example.'.format(wire_type))
+
+        if position > end:
+            raise ValueError('Truncated field in serialized Example.')
+        yield tag >> 3, wire_type, value_start, position
+
+
+def decode_varints(data):
+    """
+    Decodes concatenated protobuf varints, the inverse of `encode_varints`.
+    :param data: A bytes-like object.
+    :return: An int64 array of the values.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not data.size:
+        return np.zeros(0, dtype=np.int64)
+
+    # Every varint ends with the first byte below 0x80.
+    ends = np.flatnonzero(data < 0x80)
+    if not ends.size or ends[-1] != data.size - 1:
+        raise ValueError('Truncated varint in serialized Example.')
+
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    group_index = np.arange(data.size) - np.repeat(starts, lengths)
+    groups = (data & 0x7f).astype(np.uint64) << (7 * group_index).astype(np.uint64)
+
+    # The shifted groups of a varint do not overlap, so their sum is their bitwise or.
+    return np.add.reduceat(groups, starts).view(np.int64)
+
+
+def _decode_bytes_list(buffer, start, end):
+
+    return [buffer[value_start:value_end]
+            for field_number, wire_type, value_start, value_end in
+            _iterate_fields(buffer, start, end)
+            if field_number == 1 and wire_type == _WIRE_LENGTH_DELIMITED]
+
+
+def _decode_float_list(buffer, start, end):
+
+    chunks = []
+    for field_number, wire_type, value_start, value_end in _iterate_fields(buffer, start, end):
+        if field_number != 1:
+            continue
+        # A packed list or a single unpacked value.
+        if wire_type in (_WIRE_LENGTH_DELIMITED, _WIRE_FIXED32):
+            chunks.append(np.frombuffer(buffer[value_start:value_end], dtype='<f4'))
+
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype='<f4')
+
+
+def _decode_int64_list(buffer, start, end):
+
+    chunks = []
+    for field_number, wire_type, value_start, value_end in _iterate_fields(buffer, start, end):
+        if field_number != 1:
+            continue
+        if wire_type == _WIRE_LENGTH_DELIMITED:
+            if value_end - value_start < _VECTORIZED_VARINTS_MIN_LENGTH:
+                values = []
+                position = value_start
+                while position < value_end:
+                    value, position = _read_varint(buffer, position)
+                    values.append(_to_int64(value))
+                chunks.append(np.array(values, dtype=np.int64))
+            else:
+                chunks.append(decode_varints(buffer[value_start:value_end]))
+        elif wire_type == _WIRE_VARINT:
+            chunks.append(np.array([_to_int64(_read_varint(buffer, value_start)[0])],
+                                   dtype=np.int64))
+
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+
+_LIST_DECODERS = {
+    'bytes_list': _decode_bytes_list,
+    'float_list': _decode_float_list,
+    'int64_list': _decode_int64_list,
+}
+
+
+def _decode_feature(buffer, start, end):
+    """
+    :return: A tuple of the kind of a `Feature` and its decoded values.
+    """
+    kind = None
+    list_range = None
+    for field_number, wire_type, value_start, value_end in _iterate_fields(buffer, start, end):
+        if field_number in _FEATURE_KINDS and wire_type == _WIRE_LENGTH_DELIMITED:
+            # The last member of a oneof wins.
+            kind = _FEATURE_KINDS[field_number]
+            list_range = (value_start, value_end)
+
+    if kind is None:
+        return None, []
+    return kind, _LIST_DECODERS[kind](buffer, *list_range)
+
+
+def decode_example(example_serialized, selected_keys=None):
+    """
+    Decodes the selected features of a serialized `Example`. Map entries of other features are
+    skipped without decoding or copying their values. Packed and unpacked lists are accepted.
+    :param example_serialized: A serialized Example as a bytes-like object.
+    :param selected_keys: An iterable of feature names to decode, or None for all features.
+    :return: A dict of feature name to a tuple of the kind of the feature, one of 'bytes_list',
+    'float_list' and 'int64_list' or None for an empty feature, and its values. Bytes values are
+    memoryviews of `example_serialized`, float values a float32 array that may view it, and int64
+    values an int64 array. Features that are missing from the record are left out.
+    """
+    buffer = memoryview(example_serialized).cast('B')
+    if selected_keys is not None:
+        selected_keys = {key.encode('utf-8') if isinstance(key, str) else bytes(key)
+                         for key in selected_keys}
+
+    features = {}
+    for field_number, wire_type, start, end in _iterate_fields(buffer, 0, len(buffer)):
+        if field_number != 1 or wire_type != _WIRE_LENGTH_DELIMITED:
+            continue
+
+        # Every `Features.feature` field is a map entry with the key in field 1 and the value in
+        # field 2.
+        for entry_number, entry_type, entry_start, entry_end in \
+                _iterate_fields(buffer, start, end):
+            if entry_number != 1 or entry_type != _WIRE_LENGTH_DELIMITED:
+                continue
+
+            key = None
+            value_range = None
+            for number, value_type, value_start, value_end in \
+                    _iterate_fields(buffer, entry_start, entry_end):
+                if value_type != _WIRE_LENGTH_DELIMITED:
+                    continue
+                if number == 1:
+                    key = buffer[value_start:value_end].tobytes()
+                    if selected_keys is not None and key not in selected_keys:
+                        break
+                elif number == 2:
+                    value_range = (value_start, value_end)
+            else:
+                if key is None:
+                    key = b''
+                if selected_keys is None or key in selected_keys:
+                    features[key.decode('utf-8')] = _decode_feature(buffer, *value_range) \
+                        if value_range else (None, [])
+
+    return features
@@ -0,0 +1,346 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Image decoding post parsing processes.
+
+`ImageDecoder` is a post parsing process that decodes an encoded image feature using the format
+stored next to it, and optionally resizes it. It accepts the outputs of every `ExampleParser`
+parse method:
+
+    parse          A string tensor, decoded with `tf.image.decode_jpeg` or `decode_png`.
+    parse_batch    A 1-D string tensor, decoded in parallel with `tf.map_fn`. Images of different
+                   sizes can only be batched when `resize` is given.
+    parse_numpy    Bytes, decoded with PIL. Lists and arrays of bytes are decoded in parallel on
+                   a thread pool. Decoded images can be kept in a `DecodedImageCache`.
+
+PIL is imported on first NumPy decode and is only needed for it.
+
+Example:
+                        decoder = ImageDecoder('image/encoded', 'image/format', 'image/decoded',
+                                               resize=(512, 512),
+                                               cache=DecodedImageCache(2 ** 30, '/tmp/cache'))
+                        example_features.features_map['image/decoded'] = {
+                            'image/encoded': None, 'image/format': None, 'image/filename': None}
+                        example_features.post_parsing_process['image/decoded'] = decoder
+"""
+
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from toolbox_az.general.lazy_import import LazyModule
+
+np = LazyModule('numpy')
+tf = LazyModule('tensorflow')
+
+PNG_FORMATS = (b'png', b'PNG')
+
+
+class DecodedImageCache(object):
+    """
+    A thread safe LRU cache of decoded images bounded by bytes. Images evicted from memory are
+    spilled to a directory, if given, and loaded back from it on access. Cached images are
+    read-only arrays.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=None):
+        """
+        :param max_bytes: Maximal number of bytes of images kept in memory.
+        :param spill_dir: Optional directory images evicted from memory are written to.
+        :param max_spill_bytes: Maximal number of bytes of spilled images, None for no limit.
+        Least recently spilled images are deleted first.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+
+        self.num_bytes = 0
+        self.num_spilled_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._images = OrderedDict()
+        self._spilled = OrderedDict()
+        self._lock = threading.Lock()
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._images.keys() | self._spilled.keys())
+
+    def _spill_path(self, key):
+
+        return os.path.join(self.spill_dir,
+                            hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, key):
+        """
+        :return: The cached image of `key`, or None.
+        """
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return self._images[key]
+
+            spilled = key in self._spilled
+            if not spilled:
+                self.misses += 1
+                return None
+
+        try:
+            image = np.load(self._spill_path(key))
+        except (IOError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        self.put(key, image)
+        return image
+
+    def put(self, key, image):
+        """
+        Caches `image` under `key`. Images larger than `max_bytes` are not cached in memory.
+        """
+        image.flags.writeable = False
+
+        spilled_images = []
+        with self._lock:
+            if key in self._images:
+                return
+
+            if image.nbytes <= self.max_bytes:
+                self._images[key] = image
+                self.num_bytes += image.nbytes
+
+            while self.num_bytes > self.max_bytes:
+                evicted_key, evicted_image = self._images.popitem(last=False)
+                self.num_bytes -= evicted_image.nbytes
+                if self.spill_dir and evicted_key not in self._spilled:
+                    spilled_images.append((evicted_key, evicted_image))
+
+            if image.nbytes > self.max_bytes and self.spill_dir and key not in self._spilled:
+                spilled_images.append((key, image))
+
+        for spilled_key, spilled_image in spilled_images:
+            self._spill(spilled_key, spilled_image)
+
+    def _spill(self, key, image):
+
+        path = self._spill_path(key)
+        temp_path = '{}.tmp{}-{}'.format(path, os.getpid(), threading.get_ident())
+        np.save(temp_path, image)
+        os.replace(temp_path + '.npy', path)
+
+        removed_paths = []
+        with self._lock:
+            self._spilled[key] = image.nbytes
+            self.num_spilled_bytes += image.nbytes
+            if self.max_spill_bytes is not None:
+                while self.num_spilled_bytes > self.max_spill_bytes:
+                    removed_key, removed_bytes = self._spilled.popitem(last=False)
+                    self.num_spilled_bytes -= removed_bytes
+                    removed_paths.append(self._spill_path(removed_key))
+
+        for removed_path in removed_paths:
+            try:
+                os.remove(removed_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Drops all cached images, including spilled ones.
+        """
+        with self._lock:
+            spilled_keys = list(self._spilled)
+            self._images.clear()
+            self._spilled.clear()
+            self.num_bytes = 0
+            self.num_spilled_bytes = 0
+
+        for key in spilled_keys:
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+
+
+class ImageDecoder(object):
+    """
+    A post parsing process decoding `features[encoded_feature]` into `features[output_feature]`,
+    as a uint8 array or tensor of shape `[height, width, channels]`, with a leading batch
+    dimension for batches.
+    """
+
+    def __init__(self, encoded_feature, format_feature, output_feature, channels=3, resize=None,
+                 nearest_neighbor=False, cache=None, cache_key_feature=None, num_threads=None,
+                 parallel_iterations=10):
+        """
+        :param encoded_feature: Name of the encoded image feature.
+        :param format_feature: Name of the image format feature, 'png' images are decoded as
+        PNG and all others as JPEG.
+        :param output_feature: Name of the feature the decoded image is set to.
+        :param channels: Number of channels of the decoded image.
+        :param resize: Optional `(height, width)` to resize decoded images to.
+        :param nearest_neighbor: If True, resize with nearest neighbor interpolation, e.g. for
+        segmentation masks, otherwise bilinearly.
+        :param cache: Optional `DecodedImageCache`, used by NumPy decoding. Images are cached by
+        the value of `cache_key_feature` together with `encoded_feature` and the decode options,
+        so decoders of other features or options can share the cache.
+        :param cache_key_feature: Name of the feature identifying images in the cache, e.g.
+        'image/filename'. Required with `cache`.
+        :param num_threads: Number of threads decoding batches of NumPy images. Defaults to the
+        number of CPUs.
+        :param parallel_iterations: Number of images of a tensor batch decoded in parallel.
+        """
+        if cache is not None and cache_key_feature is None:
+            raise ValueError('cache_key_feature is required to cache decoded images.')
+
+        self.encoded_feature = encoded_feature
+        self.format_feature = format_feature
+        self.output_feature = output_feature
+        self.channels = channels
+        self.resize = tuple(resize) if resize else None
+        self.nearest_neighbor = nearest_neighbor
+        self.cache = cache
+        self.cache_key_feature = cache_key_feature
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.parallel_iterations = parallel_iterations
+
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def __call__(self, features):
+        encoded = features[self.encoded_feature]
+        image_format = features[self.format_feature]
+        cache_keys = features.get(self.cache_key_feature) if self.cache is not None else None
+
+        if isinstance(encoded, bytes):
+            features[self.output_feature] = self.decode_numpy(encoded, image_format, cache_keys)
+        elif isinstance(encoded, (list, tuple, np.ndarray)):
+            features[self.output_feature] = self.decode_numpy_batch(encoded, image_format,
+                                                                    cache_keys)
+        elif encoded.shape.ndims == 0:
+            features[self.output_feature] = self.decode_tensor(encoded, image_format)
+        else:
+            features[self.output_feature] = tf.map_fn(
+                lambda encoded_and_format: self.decode_tensor(*encoded_and_format),
+                (encoded, image_format),
+                dtype=tf.uint8,
+                parallel_iterations=self.parallel_iterations,
+            )
+
+    def decode_tensor(self, encoded, image_format):
+        """
+        Decodes a single image in the graph.
+        :param encoded: A scalar string tensor of the encoded image.
+        :param image_format: A scalar string tensor of the image format.
+        :return: A uint8 tensor of the decoded image. Empty encoded images are decoded as an
+        empty image, or as zeros of the resized shape.
+        """
+        is_png = tf.reduce_any(tf.equal(image_format, [PNG_FORMATS[0].decode(),
+                                                       PNG_FORMATS[1].decode()]))
+
+        def decode():
+            image = tf.cond(
+                is_png,
+                lambda: tf.image.decode_png(encoded, channels=self.channels),
+                lambda: tf.image.decode_jpeg(encoded, channels=self.channels),
+            )
+            if self.resize is None:
+                return image
+
+            if self.nearest_neighbor:
+                return tf.image.resize_images(
+                    image, self.resize, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+            resized = tf.image.resize_images(image, self.resize)
+            return tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8)
+
+        empty_shape = list(self.resize or (0, 0)) + [self.channels]
+        image = tf.cond(tf.equal(tf.strings.length(encoded), 0),
+                        lambda: tf.zeros(empty_shape, dtype=tf.uint8),
+                        decode)
+        image.set_shape(list(self.resize or (None, None)) + [self.channels])
+        return image
+
+    def _decode_with_pil(self, encoded, image_format):
+
+        from PIL import Image
+
+        if not encoded:
+            return np.zeros(list(self.resize or (0, 0)) + [self.channels], dtype=np.uint8)
+
+        image = Image.open(io.BytesIO(encoded))
+
+        # JPEG images are decoded at a reduced scale when shrunk.
+        if self.resize is not None and image_format not in PNG_FORMATS:
+            image.draft('RGB' if self.channels == 3 else 'L', self.resize[::-1])
+
+        # Palette images with a single channel, e.g. class masks, keep their palette indices.
+        if self.channels == 1 and image.mode != 'P':
+            image = image.convert('L')
+        elif self.channels == 3:
+            image = image.convert('RGB')
+        elif self.channels == 4:
+            image = image.convert('RGBA')
+
+        if self.resize is not None:
+            resample = Image.NEAREST if self.nearest_neighbor else Image.BILINEAR
+            image = image.resize(self.resize[::-1], resample=resample)
+
+        return np.asarray(image).reshape(image.size[1], image.size[0], self.channels)
+
+    def decode_numpy(self, encoded, image_format, cache_key=None):
+        """
+        Decodes a single image with PIL, through the cache if configured.
+        :param encoded: The encoded image bytes.
+        :param image_format: The image format as bytes.
+        :param cache_key: The cache key of the image, e.g. its file name. Images without a key or
+        with an empty one, e.g. of records without a file name, are not cached.
+        :return: A uint8 array of the decoded image.
+        """
+        # Records without the key feature are parsed with an empty default, which all share.
+        if self.cache is not None and cache_key not in (None, b'', ''):
+            key = (cache_key, self.encoded_feature, self.channels, self.resize,
+                   self.nearest_neighbor)
+            image = self.cache.get(key)
+            if image is None:
+                image = self._decode_with_pil(encoded, image_format)
+                self.cache.put(key, image)
+            return image
+
+        return self._decode_with_pil(encoded, image_format)
+
+    def decode_numpy_batch(self, encoded_batch, image_formats, cache_keys=None):
+        """
+        Decodes a batch of images on a thread pool.
+        :param encoded_batch: A sequence of encoded image bytes.
+        :param image_formats: A sequence of image formats, or a single format for all images.
+        :param cache_keys: An optional sequence of cache keys.
+        :return: A uint8 array of the images if they have the same shape, otherwise a list.
+        """
+        encoded_batch = list(encoded_batch)
+        if isinstance(image_formats, bytes):
+            image_formats = [image_formats] * len(encoded_batch)
+        if cache_keys is None:
+            cache_keys = [None] * len(encoded_batch)
+
+        # Threads do not survive a fork, so a forked process creates its own pool.
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+                self._executor_pid = os.getpid()
+
+        images = list(self._executor.map(self.decode_numpy, encoded_batch, image_formats,
+                                         cache_keys))
+
+        if images and all(image.shape == images[0].shape for image in images):
+            return np.stack(images)
+        return images
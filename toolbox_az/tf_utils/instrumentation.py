@@ -0,0 +1,224 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Throughput and latency instrumentation of the TFRecord read/parse path.
+
+`run_queue_runner_session`, `process_features_from_tfrecord` and `inspect_tfrecord` accept an
+optional `callback` implementing `PipelineCallback`. When no callback is given the instrumented
+code only checks for None. `PipelineStats` is a callback that keeps throughput counters and
+latency histograms, and can periodically log its summary or append it to a JSON lines file.
+
+Example:
+                        stats = PipelineStats(report_interval=30, json_file='/tmp/stats.jsonl')
+                        inspect_tfrecord(path, 'image/filename', parser, callback=stats)
+                        print(stats.summary())
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+
+
+class PipelineCallback(object):
+    """
+    Interface of instrumentation callbacks. All methods are no-ops, override the needed ones.
+    Methods may be called from several threads.
+    """
+
+    def on_records(self, num_records, num_bytes):
+        """
+        Called when records were read. `num_bytes` is 0 when the size is unknown, e.g. for
+        records read inside a TF graph.
+        """
+
+    def on_session_run(self, seconds):
+        """
+        Called with the duration of a `session.run` call.
+        """
+
+    def on_parse(self, seconds):
+        """
+        Called with the duration of parsing a record outside of a TF graph.
+        """
+
+    def on_consume(self, seconds):
+        """
+        Called with the duration of a call to the consumer function.
+        """
+
+    def on_queue_depth(self, depth):
+        """
+        Called with the number of evaluated steps waiting for or in consumption.
+        """
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of durations with logarithmic buckets, from 1 microsecond up, 4 per octave.
+    """
+
+    BUCKETS_PER_OCTAVE = 4
+    MIN_SECONDS = 1e-6
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = 0
+        if seconds > self.MIN_SECONDS:
+            bucket = int(math.log2(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_OCTAVE) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def _bucket_upper_bound(self, bucket):
+
+        return self.MIN_SECONDS * 2 ** (bucket / self.BUCKETS_PER_OCTAVE)
+
+    def percentile(self, percent):
+        """
+        :return: An upper bound of the `percent` percentile, within one bucket, or 0 if empty.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._bucket_upper_bound(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class PipelineStats(PipelineCallback):
+    """
+    Collects records/sec, bytes/sec, latency histograms of session runs, parsing and consumer
+    calls, and the queue depth of pending steps.
+    """
+
+    def __init__(self, report_interval=None, log_level=logging.INFO, json_file=None):
+        """
+        :param report_interval: If given, report the summary every `report_interval` seconds,
+        checked whenever a callback method is called.
+        :param log_level: Logging level of periodic reports, None to not log them.
+        :param json_file: Optional path of a JSON lines file periodic reports are appended to.
+        """
+        self.report_interval = report_interval
+        self.log_level = log_level
+        self.json_file = json_file
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.monotonic()
+            self._last_report_time = self.start_time
+            self.num_records = 0
+            self.num_bytes = 0
+            self.session_run_latency = LatencyHistogram()
+            self.parse_latency = LatencyHistogram()
+            self.consume_latency = LatencyHistogram()
+            self.max_queue_depth = 0
+            self._queue_depth_total = 0
+            self._queue_depth_count = 0
+
+    def on_records(self, num_records, num_bytes):
+        with self._lock:
+            self.num_records += num_records
+            self.num_bytes += num_bytes
+        self._maybe_report()
+
+    def on_session_run(self, seconds):
+        with self._lock:
+            self.session_run_latency.add(seconds)
+        self._maybe_report()
+
+    def on_parse(self, seconds):
+        with self._lock:
+            self.parse_latency.add(seconds)
+        self._maybe_report()
+
+    def on_consume(self, seconds):
+        with self._lock:
+            self.consume_latency.add(seconds)
+        self._maybe_report()
+
+    def on_queue_depth(self, depth):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self._queue_depth_total += depth
+            self._queue_depth_count += 1
+        self._maybe_report()
+
+    def summary(self):
+        """
+        :return: A JSON serializable dict of the statistics collected since the last reset.
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            mean_queue_depth = self._queue_depth_total / self._queue_depth_count \
+                if self._queue_depth_count else 0.0
+            return {
+                'elapsed_seconds': elapsed,
+                'num_records': self.num_records,
+                'num_bytes': self.num_bytes,
+                'records_per_second': self.num_records / elapsed,
+                'bytes_per_second': self.num_bytes / elapsed,
+                'session_run_latency': self.session_run_latency.to_dict(),
+                'parse_latency': self.parse_latency.to_dict(),
+                'consume_latency': self.consume_latency.to_dict(),
+                'mean_queue_depth': mean_queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+    def report(self):
+        """
+        Logs the summary and appends it to `json_file`, as configured.
+        :return: The summary dict.
+        """
+        summary = self.summary()
+
+        if self.log_level is not None:
+            logging.log(self.log_level, 'Pipeline stats: %s', json.dumps(summary, sort_keys=True))
+
+        if self.json_file:
+            with open(self.json_file, 'a') as json_stream:
+                json_stream.write(json.dumps(summary, sort_keys=True) + '\n')
+
+        return summary
+
+    def _maybe_report(self):
+
+        if self.report_interval is None:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_report_time < self.report_interval:
+                return
+            self._last_report_time = now
+
+        self.report()
@@ -0,0 +1,230 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+A seeded, resumable record iterator over TFRecord shards.
+
+`ShuffledRecordIterator` reads shards through memory maps in a seeded order and shuffles records
+with a buffer, like `tf.data.Dataset.shuffle`: every record read is added to the buffer and a
+uniformly chosen buffered record is returned. A single shard therefore gets record level
+shuffling, unlike the file level shuffling of `string_input_producer`.
+
+The buffer holds record offsets, not records, so its state is small. `get_state` returns the
+position of the iterator: the epoch, the shard order, the current shard and offset, the buffered
+offsets and the random state. `set_state` resumes from it by seeking, the order of the remaining
+records is the same as without the interruption.
+
+Example:
+                        records = ShuffledRecordIterator('/data/train.tfrecord-*',
+                                                         shuffle_buffer_size=10000, seed=42)
+                        for record in records:
+                            train_step(parser.parse_numpy(record))
+                            if records.num_records % 10000 == 0:
+                                with open(state_path, 'wb') as state_file:
+                                    pickle.dump(records.get_state(), state_file)
+"""
+
+import os
+import random
+from collections import Counter
+
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileReader, expand_tfrecord_files
+
+
+class ShuffledRecordIterator(object):
+    """
+    Iterates over the serialized records of TFRecord shards in a reproducible shuffled order.
+    Records are returned as bytes.
+    """
+
+    STATE_VERSION = 1
+
+    def __init__(self, tfrecord_files, shuffle_buffer_size=None, seed=None, num_epochs=1,
+                 check_crc=False):
+        """
+        :param tfrecord_files: A file path, a glob pattern or a list of them.
+        :param shuffle_buffer_size: If given, shuffle the shard order of every epoch and the
+        records with a buffer of this many records. Otherwise records are read in order.
+        :param seed: Seed of the order. Defaults to a random seed, stored in `seed`.
+        :param num_epochs: Number of passes over the shards, None to repeat forever.
+        :param check_crc: If True, verify the checksums of the records.
+        """
+        self.tfrecord_files = expand_tfrecord_files(tfrecord_files)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = random.randrange(2 ** 63) if seed is None else seed
+        self.num_epochs = num_epochs
+        self.check_crc = check_crc
+
+        # Number of records returned so far, over all epochs.
+        self.num_records = 0
+
+        self._rng = random.Random(self.seed)
+        self._epoch = 0
+        self._epoch_num_records = 0
+        self._shard_order = None
+        self._shard_position = 0
+        self._offset = 0
+        self._buffer = []
+
+        self._readers = {}
+        self._buffered_counts = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        """
+        Closes the open shards. Iteration reopens them as needed.
+        """
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def _reader(self, file_index):
+
+        if file_index not in self._readers:
+            self._readers[file_index] = TFRecordFileReader(self.tfrecord_files[file_index],
+                                                           check_crc=self.check_crc)
+        return self._readers[file_index]
+
+    def _current_file_index(self):
+
+        if self._shard_order is None or self._shard_position >= len(self._shard_order):
+            return None
+        return self._shard_order[self._shard_position]
+
+    def _release_reader(self, file_index):
+
+        # Shards are kept open while they are read or have buffered records.
+        if self._buffered_counts[file_index] == 0 and file_index != self._current_file_index():
+            del self._buffered_counts[file_index]
+            reader = self._readers.pop(file_index, None)
+            if reader is not None:
+                reader.close()
+
+    def _start_epoch(self):
+
+        self._shard_order = list(range(len(self.tfrecord_files)))
+        if self.shuffle_buffer_size is not None:
+            self._rng.shuffle(self._shard_order)
+        self._shard_position = 0
+        self._offset = 0
+        self._epoch_num_records = 0
+
+    def _pop_record(self):
+
+        # A uniformly chosen buffered record is swapped to the end, so removing it is O(1).
+        if len(self._buffer) > 1:
+            index = self._rng.randrange(len(self._buffer))
+            self._buffer[index], self._buffer[-1] = self._buffer[-1], self._buffer[index]
+
+        file_index, offset = self._buffer.pop()
+        record, _ = self._reader(file_index).read_at(offset)
+        record = record.tobytes()
+
+        self._buffered_counts[file_index] -= 1
+        self._release_reader(file_index)
+        self.num_records += 1
+        return record
+
+    def __next__(self):
+        buffer_size = max(self.shuffle_buffer_size or 1, 1)
+
+        while True:
+            epoch_read = self._shard_order is not None and \
+                self._shard_position >= len(self._shard_order)
+
+            # The buffer is filled before returning records, and drained at the end of an epoch.
+            if self._buffer and (len(self._buffer) >= buffer_size or epoch_read):
+                return self._pop_record()
+
+            if epoch_read:
+                self._shard_order = None
+                self._epoch += 1
+                # Stop rather than loop forever over shards without records.
+                if self._epoch_num_records == 0:
+                    raise StopIteration
+
+            if self._shard_order is None:
+                if self.num_epochs is not None and self._epoch >= self.num_epochs:
+                    raise StopIteration
+                self._start_epoch()
+                continue
+
+            file_index = self._shard_order[self._shard_position]
+            reader = self._reader(file_index)
+            if self._offset >= reader.size:
+                self._shard_position += 1
+                self._offset = 0
+                self._release_reader(file_index)
+                continue
+
+            # Only the record header is read here, the record is read when it is returned.
+            next_offset = reader.next_offset(self._offset)
+            self._buffer.append((file_index, self._offset))
+            self._buffered_counts[file_index] += 1
+            self._offset = next_offset
+            self._epoch_num_records += 1
+
+    def get_state(self):
+        """
+        :return: A picklable dict of the position of the iterator, restored by `set_state`. Its
+        size grows with the shuffle buffer and the number of shards, not with the dataset.
+        """
+        return {
+            'version': self.STATE_VERSION,
+            'tfrecord_files': [os.path.basename(tfrecord_file) for tfrecord_file in
+                               self.tfrecord_files],
+            'file_sizes': [os.path.getsize(tfrecord_file) for tfrecord_file in
+                           self.tfrecord_files],
+            'shuffle_buffer_size': self.shuffle_buffer_size,
+            'seed': self.seed,
+            'num_records': self.num_records,
+            'epoch': self._epoch,
+            'epoch_num_records': self._epoch_num_records,
+            'shard_order': None if self._shard_order is None else list(self._shard_order),
+            'shard_position': self._shard_position,
+            'offset': self._offset,
+            'buffer': list(self._buffer),
+            'rng_state': self._rng.getstate(),
+        }
+
+    def set_state(self, state):
+        """
+        Moves the iterator to a position returned by `get_state`. Only the current shard offset
+        and the buffered records are sought, no records are read again.
+        :param state: A dict returned by `get_state` of an iterator over the same shards, which
+        may have moved to another directory, and with the same `shuffle_buffer_size`.
+        """
+        if state['version'] != self.STATE_VERSION:
+            raise ValueError('Unsupported iterator state version {}.'.format(state['version']))
+
+        file_names = [os.path.basename(tfrecord_file) for tfrecord_file in self.tfrecord_files]
+        if state['tfrecord_files'] != file_names:
+            raise ValueError('The iterator state is of different TFRecord files.')
+        file_sizes = [os.path.getsize(tfrecord_file) for tfrecord_file in self.tfrecord_files]
+        if state['file_sizes'] != file_sizes:
+            raise ValueError('TFRecord files changed since the iterator state was saved.')
+        if state['shuffle_buffer_size'] != self.shuffle_buffer_size:
+            raise ValueError('The iterator state has a shuffle buffer size of {}, not {}.'.format(
+                state['shuffle_buffer_size'], self.shuffle_buffer_size))
+
+        self.close()
+        self.seed = state['seed']
+        self.num_records = state['num_records']
+        self._epoch = state['epoch']
+        self._epoch_num_records = state['epoch_num_records']
+        self._shard_order = None if state['shard_order'] is None else list(state['shard_order'])
+        self._shard_position = state['shard_position']
+        self._offset = state['offset']
+        self._buffer = [tuple(entry) for entry in state['buffer']]
+        self._rng.setstate(state['rng_state'])
+        self._buffered_counts = Counter(file_index for file_index, _ in self._buffer)
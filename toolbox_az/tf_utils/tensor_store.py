@@ -0,0 +1,167 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+A flat, memory-mappable file format for checkpoint tensors.
+
+Layout of a store file:
+
+    8 bytes  magic, b'TBXTSTR1'
+    uint64   length of the header, little-endian
+    bytes    JSON header: {"alignment": A, "tensors": [{"name", "dtype", "shape", "offset",
+             "nbytes"}, ...]}
+    padding  up to a multiple of A
+    bytes    tensor data, every tensor starting at a multiple of A. Offsets in the header are
+             relative to the start of the data section.
+
+Loading maps the file once and returns NumPy arrays that view the map, so nothing is deserialized
+or copied and processes loading the same store share its pages. Loading does not import
+TensorFlow.
+
+Example:
+                        export_ckpt_to_tensor_store(ckpt_file, '/data/model.tstore')
+                        weights = load_tensor_store('/data/model.tstore')
+"""
+
+import json
+import os
+import struct
+
+from toolbox_az.general.lazy_import import LazyModule
+
+np = LazyModule('numpy')
+
+MAGIC = b'TBXTSTR1'
+DEFAULT_ALIGNMENT = 64
+
+_HEADER_LENGTH_STRUCT = struct.Struct('<Q')
+_PREAMBLE_SIZE = len(MAGIC) + _HEADER_LENGTH_STRUCT.size
+
+
+def _align(value, alignment):
+
+    return (value + alignment - 1) // alignment * alignment
+
+
+def export_ckpt_to_tensor_store(ckpt_file, store_file, name_filter=None,
+                                alignment=DEFAULT_ALIGNMENT):
+    """
+    Writes the numeric variables of a checkpoint to a tensor store file. Tensors are read and
+    written one at a time, so memory use stays near the size of the largest tensor.
+    :param ckpt_file: A checkpoint path or a reader returned by
+    `pywrap_tensorflow.NewCheckpointReader`.
+    :param store_file: Path of the store file to write. It is replaced atomically.
+    :param name_filter: Restricts the exported variables, see
+    `checkpoint_utils.compile_name_filter`.
+    :param alignment: Alignment in bytes of every tensor in the file.
+    :return: A list of the names of variables that were skipped because their dtype cannot be
+    memory-mapped, e.g. string variables.
+    """
+    from toolbox_az.tf_utils.checkpoint_utils import LazyCheckpointTensors
+
+    tensors = LazyCheckpointTensors(ckpt_file, name_filter=name_filter, max_cached_bytes=0)
+
+    entries = []
+    skipped_names = []
+    data_size = 0
+    for name in tensors:
+        dtype = np.dtype(tensors.dtypes[name].as_numpy_dtype)
+        if dtype.kind not in 'biufc':
+            skipped_names.append(name)
+            continue
+
+        shape = [int(dim) for dim in tensors.shapes[name]]
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        data_size = _align(data_size, alignment)
+        entries.append({
+            'name': name,
+            'dtype': dtype.str,
+            'shape': shape,
+            'offset': data_size,
+            'nbytes': nbytes,
+        })
+        data_size += nbytes
+
+    header = json.dumps({'alignment': alignment, 'tensors': entries}).encode('utf-8')
+    data_start = _align(_PREAMBLE_SIZE + len(header), alignment)
+
+    temp_file = '{}.tmp{}'.format(store_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as store:
+            store.write(MAGIC)
+            store.write(_HEADER_LENGTH_STRUCT.pack(len(header)))
+            store.write(header)
+
+            for entry in entries:
+                # Empty tensors have no bytes, and a view of them cannot be cast.
+                if not entry['nbytes']:
+                    continue
+                store.seek(data_start + entry['offset'])
+                value = np.ascontiguousarray(tensors[entry['name']], dtype=entry['dtype'])
+                # Written from the array buffer, without a `tobytes` copy of large tensors.
+                store.write(memoryview(value).cast('B'))
+
+            # Pad the file to its full size, the last tensors may be empty.
+            store.truncate(data_start + data_size)
+
+        os.replace(temp_file, store_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    return skipped_names
+
+
+def read_tensor_store_header(store_file):
+    """
+    Reads the header of a tensor store file.
+    :param store_file: Path of a tensor store file.
+    :return: A tuple of the header dict and the file offset of the data section.
+    """
+    with open(store_file, 'rb') as store:
+        preamble = store.read(_PREAMBLE_SIZE)
+        if len(preamble) != _PREAMBLE_SIZE or preamble[:len(MAGIC)] != MAGIC:
+            raise IOError('{} is not a tensor store file.'.format(store_file))
+
+        header_length, = _HEADER_LENGTH_STRUCT.unpack(preamble[len(MAGIC):])
+        header = json.loads(store.read(header_length).decode('utf-8'))
+
+    data_start = _align(_PREAMBLE_SIZE + header_length, header['alignment'])
+    return header, data_start
+
+
+def load_tensor_store(store_file, name_filter=None):
+    """
+    Maps a tensor store file and returns its tensors as read-only arrays viewing the map.
+    :param store_file: Path of a tensor store file.
+    :param name_filter: Restricts the loaded variables, see
+    `checkpoint_utils.compile_name_filter`.
+    :return: A dict of variable name to read-only `np.memmap` backed array.
+    """
+    header, data_start = read_tensor_store_header(store_file)
+
+    if name_filter is None:
+        entries = header['tensors']
+    else:
+        from toolbox_az.tf_utils.checkpoint_utils import compile_name_filter
+        accept_name = compile_name_filter(name_filter)
+        entries = [entry for entry in header['tensors'] if accept_name(entry['name'])]
+
+    if os.path.getsize(store_file) <= data_start:
+        store_map = None
+    else:
+        store_map = np.memmap(store_file, dtype=np.uint8, mode='r')
+
+    tensors = {}
+    for entry in entries:
+        dtype = np.dtype(entry['dtype'])
+        if entry['nbytes'] == 0:
+            tensors[entry['name']] = np.empty(entry['shape'], dtype=dtype)
+        else:
+            tensors[entry['name']] = np.ndarray(
+                shape=entry['shape'],
+                dtype=dtype,
+                buffer=store_map,
+                offset=data_start + entry['offset'],
+            )
+
+    return tensors
@@ -1,9 +1,145 @@
 # Copyright (c) 2017 Lightricks. All rights reserved.
-import tensorflow as tf
-from tensorflow.python import pywrap_tensorflow
+import glob
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from toolbox_az.general.lazy_import import LazyModule
+from toolbox_az.tf_utils.checkpoint_utils import LazyCheckpointTensors
+from toolbox_az.tf_utils.record_iterator import ShuffledRecordIterator
+from toolbox_az.tf_utils.tfrecord_index import TFRecordIndex
+from toolbox_az.tf_utils.tfrecord_io import expand_tfrecord_files, iterate_tfrecord
 
-def run_queue_runner_session(tensors_to_evaluate, process_values_function, num_steps=None):
+tf = LazyModule('tensorflow')
+
+
+def _unbatch_values(batched_values):
+
+    if isinstance(batched_values, dict):
+        num_steps = len(next(iter(batched_values.values()))) if batched_values else 0
+        return [{name: values[step] for name, values in batched_values.items()}
+                for step in range(num_steps)]
+
+    elif isinstance(batched_values, (list, tuple)):
+        return [type(batched_values)(values[step] for values in batched_values)
+                for step in range(len(batched_values[0]))]
+
+    return list(batched_values)
+
+
+def _batch_size(values):
+    """
+    :param values: Evaluated fetches batched along their first dimension: an array, a sparse
+    tensor value, or a dict, list or tuple of them.
+    :return: The size of the first dimension of the first fetched value, 1 for scalars.
+    """
+    while isinstance(values, (dict, list, tuple)) and not hasattr(values, 'dense_shape'):
+        if not values:
+            return 0
+        values = next(iter(values.values())) if isinstance(values, dict) else values[0]
+
+    shape = values.dense_shape if hasattr(values, 'dense_shape') else getattr(values, 'shape', ())
+    return int(shape[0]) if len(shape) else 1
+
+
+class _StepConsumers(object):
+    """
+    Consumes evaluated steps on a thread pool. At most `max_pending_steps` steps wait for or are
+    in consumption, `submit` blocks until one of them is done. Once a step fails, `on_error` is
+    called with the exception, which is also kept as `error`, and the remaining steps are dropped.
+    """
+
+    def __init__(self, process_values, num_threads, max_pending_steps, on_error, callback=None):
+        self.process_values = process_values
+        self.on_error = on_error
+        self.callback = callback
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.pending_steps = threading.BoundedSemaphore(max_pending_steps)
+        self.failed = threading.Event()
+        self.error = None
+
+        # Number of pending steps, tracked only for the callback.
+        self.num_pending = 0
+        self.num_pending_lock = threading.Lock()
+
+    def _update_num_pending(self, delta):
+
+        with self.num_pending_lock:
+            self.num_pending += delta
+            self.callback.on_queue_depth(self.num_pending)
+
+    def _consume(self, tensors_values):
+
+        try:
+            if not self.failed.is_set():
+                self.process_values(tensors_values)
+        except Exception as e:
+            if not self.failed.is_set():
+                self.error = e
+                self.failed.set()
+            self.on_error(e)
+        finally:
+            self.pending_steps.release()
+            if self.callback is not None:
+                self._update_num_pending(-1)
+
+    def submit(self, tensors_values):
+        """
+        Queues the values of a step for consumption, waiting while too many steps are pending.
+        """
+        self.pending_steps.acquire()
+        if self.callback is not None:
+            self._update_num_pending(1)
+        self.executor.submit(self._consume, tensors_values)
+
+    def shutdown(self):
+        """
+        Waits for the pending steps to be consumed.
+        """
+        self.executor.shutdown(wait=True)
+
+
+def run_queue_runner_session(tensors_to_evaluate, process_values_function, num_steps=None,
+                             num_consumer_threads=0, ordered=True, max_pending_steps=None,
+                             steps_per_run=1, callback=None, batched_records=False):
+    """
+    Evaluates `tensors_to_evaluate` repeatedly in a session with running queue runners and passes
+    the values of every step to `process_values_function`, until the input is exhausted or
+    `num_steps` steps were done.
+
+    With `num_consumer_threads`, the consumer runs on a thread pool fed by a bounded queue, so the
+    next `session.run` overlaps consumption of earlier steps. An exception raised by the consumer
+    stops the coordinator and is re-raised once the session loop ends.
+    :param tensors_to_evaluate: Fetches of a step. With `steps_per_run` > 1, fetches holding up
+    to `steps_per_run` steps batched along their first dimension, e.g. returned by
+    `process_features_from_tfrecord` with `records_per_read`.
+    :param process_values_function: A function of the evaluated values of a step.
+    :param num_steps: Maximal number of steps, None to run until the input is exhausted.
+    :param num_consumer_threads: Number of consumer threads, 0 consumes in the session loop.
+    More than one thread requires `ordered` to be False.
+    :param ordered: If True, steps are consumed one at a time in step order, by at most one
+    consumer thread. Otherwise up to `num_consumer_threads` steps are consumed concurrently.
+    :param max_pending_steps: Maximal number of evaluated steps waiting for or in consumption.
+    Defaults to twice the number of consumer threads.
+    :param steps_per_run: Maximal number of steps evaluated by each `session.run` call. The
+    evaluated batches are split to the values of single steps before they are consumed.
+    :param callback: Optional `instrumentation.PipelineCallback` notified of evaluated records,
+    of `session.run` and consumer latencies, and of the number of pending steps. Records are read
+    inside the graph, so their size is unknown and is reported as 0 bytes.
+    :param batched_records: If True, the values of every step hold a batch of records along their
+    first dimension, e.g. fetches of `tf.train.batch` or of `process_features_from_tfrecord`
+    with `records_per_read` and `steps_per_run` of 1, and the batch size is reported to
+    `callback` as the number of records. Otherwise every step is a single record.
+    :raises ValueError: If `ordered` is True and `num_consumer_threads` is more than one.
+    """
+    if ordered and num_consumer_threads > 1:
+        raise ValueError('Ordered consumption uses a single consumer thread, got {} consumer '
+                         'threads. Pass ordered=False to consume steps concurrently.'.format(
+                             num_consumer_threads))
 
     # Create a session for reading the data
     session = tf.Session()
@@ -11,39 +147,203 @@ def run_queue_runner_session(tensors_to_evaluate, process_values_function, num_s
     # Start input enqueue threads.
     coordinator = tf.train.Coordinator()
     threads = None
+
+    def process_values(tensors_values):
+        if callback is None:
+            process_values_function(tensors_values)
+        else:
+            start_time = time.perf_counter()
+            process_values_function(tensors_values)
+            callback.on_consume(time.perf_counter() - start_time)
+
+    consumers = None
+    if num_consumer_threads:
+        consumers = _StepConsumers(process_values, num_consumer_threads,
+                                   max_pending_steps or 2 * num_consumer_threads,
+                                   on_error=coordinator.request_stop, callback=callback)
+
     try:
         # Initialize variables.
         session.run([tf.local_variables_initializer(), tf.global_variables_initializer()])
 
         threads = tf.train.start_queue_runners(sess=session, coord=coordinator)
 
+        # A callable avoids re-validating the fetches on every step.
+        run_step = session.make_callable(tensors_to_evaluate)
+
         iter = 0
         while not coordinator.should_stop() and (num_steps is None or iter < num_steps):
-            tensors_values = session.run(tensors_to_evaluate)
-            process_values_function(tensors_values)
-            iter += 1
+            if callback is None:
+                run_values = run_step()
+            else:
+                start_time = time.perf_counter()
+                run_values = run_step()
+                callback.on_session_run(time.perf_counter() - start_time)
+
+            steps_values = _unbatch_values(run_values) if steps_per_run > 1 else [run_values]
+            if callback is not None:
+                num_records = sum(_batch_size(tensors_values) for tensors_values in
+                                  steps_values) if batched_records else len(steps_values)
+                callback.on_records(num_records, 0)
+
+            for tensors_values in steps_values:
+                if num_steps is not None and iter >= num_steps:
+                    break
+
+                if consumers is None:
+                    process_values(tensors_values)
+                else:
+                    consumers.submit(tensors_values)
+                iter += 1
 
     except Exception as e:
         coordinator.request_stop(e)
 
     finally:
+        # Let the consumers finish the evaluated steps.
+        if consumers is not None:
+            consumers.shutdown()
         # When done, ask the threads to stop.
         coordinator.request_stop()
         # Wait for threads to finish.
         coordinator.join(threads)
 
+    # A consumer that failed after the coordinator stopped, e.g. on the last steps of the input,
+    # is not reported by the coordinator.
+    if consumers is not None and consumers.error is not None:
+        raise consumers.error
+
+
+def _iterate_epochs(iterate_epoch, num_epochs):
+    """
+    Chains `num_epochs` passes of `iterate_epoch()`, None to repeat forever. Repeating stops at an
+    epoch without records, as in `ShuffledRecordIterator`, so an empty input does not loop.
+    """
+    epochs = itertools.count() if num_epochs is None else range(num_epochs)
+    for _ in epochs:
+        epoch_num_records = 0
+        for record in iterate_epoch():
+            epoch_num_records += 1
+            yield record
+
+        if epoch_num_records == 0:
+            return
+
+
+def _iterate_features_from_tfrecord(tfrecord_file, parser, selected_features, return_as_dict,
+                                    num_epochs, check_crc, callback, shuffle_buffer_size=None,
+                                    seed=None, compression_type=None, buffer_size=None):
+
+    if shuffle_buffer_size:
+        serialized_examples = ShuffledRecordIterator(
+            tfrecord_file,
+            shuffle_buffer_size=shuffle_buffer_size,
+            seed=seed,
+            num_epochs=num_epochs,
+            check_crc=check_crc,
+        )
+    else:
+        serialized_examples = _iterate_epochs(
+            lambda: iterate_tfrecord(tfrecord_file, check_crc=check_crc,
+                                     compression_type=compression_type, buffer_size=buffer_size),
+            num_epochs)
+
+    for serialized_example in serialized_examples:
+        if callback is None:
+            yield parser.parse_numpy(
+                serialized_example,
+                selected_features=selected_features,
+                return_as_dict=return_as_dict,
+            )
+            continue
+
+        callback.on_records(1, len(serialized_example))
+        start_time = time.perf_counter()
+        parsed_features = parser.parse_numpy(
+            serialized_example,
+            selected_features=selected_features,
+            return_as_dict=return_as_dict,
+        )
+        callback.on_parse(time.perf_counter() - start_time)
+        yield parsed_features
+
 
 def process_features_from_tfrecord(tfrecord_file, parser, selected_features=None,
-                                   return_as_dict=False, shuffle=True, num_epochs=None):
+                                   return_as_dict=False, shuffle=True, num_epochs=None,
+                                   session_free=False, check_crc=False, records_per_read=1,
+                                   callback=None, shuffle_buffer_size=None, seed=None,
+                                   compression_type=None, buffer_size=None):
+
+    # Without `shuffle_buffer_size` shuffling is done at file granularity, so it has no effect on
+    # a single file. With it, records are shuffled with a buffer of that many records.
+    shuffle_buffer_size = shuffle_buffer_size if shuffle else None
+
+    # Read the file through a memory map, or decompress it as a stream, and parse records to
+    # NumPy values, no graph is built. Use `ShuffledRecordIterator` directly to checkpoint and
+    # resume the iteration.
+    if session_free:
+        if shuffle_buffer_size and compression_type:
+            raise ValueError('Records of compressed files cannot be shuffled without a session.')
+        return _iterate_features_from_tfrecord(
+            tfrecord_file=tfrecord_file,
+            parser=parser,
+            selected_features=selected_features,
+            return_as_dict=return_as_dict,
+            num_epochs=num_epochs,
+            check_crc=check_crc,
+            callback=callback,
+            shuffle_buffer_size=shuffle_buffer_size,
+            seed=seed,
+            compression_type=compression_type,
+            buffer_size=buffer_size,
+        )
 
-    reader = tf.TFRecordReader()
+    options = None
+    if compression_type:
+        options = tf.python_io.TFRecordOptions(compression_type=compression_type,
+                                               input_buffer_size=buffer_size)
+    reader = tf.TFRecordReader(options=options)
     filename_queue = tf.train.string_input_producer(
         [tfrecord_file],
         shuffle=shuffle,
         num_epochs=num_epochs
     )
+
+    # Read and parse up to `records_per_read` records per step, variable length features are
+    # padded so every feature is batched along its first dimension.
+    if records_per_read > 1:
+        _, serialized_examples = reader.read_up_to(filename_queue, records_per_read)
+
+        if shuffle_buffer_size:
+            serialized_examples = tf.train.shuffle_batch(
+                [serialized_examples],
+                batch_size=records_per_read,
+                capacity=shuffle_buffer_size + 3 * records_per_read,
+                min_after_dequeue=shuffle_buffer_size,
+                seed=seed,
+                enqueue_many=True,
+                allow_smaller_final_batch=True,
+            )
+
+        return parser.parse_batch(
+            serialized_examples,
+            selected_features=selected_features,
+            return_as_dict=return_as_dict,
+            varlen_as_dense=True,
+        )
+
     _, serialized_example = reader.read(filename_queue)
 
+    if shuffle_buffer_size:
+        serialized_example = tf.train.shuffle_batch(
+            [serialized_example],
+            batch_size=1,
+            capacity=shuffle_buffer_size + 3,
+            min_after_dequeue=shuffle_buffer_size,
+            seed=seed,
+            allow_smaller_final_batch=True,
+        )[0]
+
     return parser.parse(
         serialized_example,
         selected_features=selected_features,
@@ -51,19 +351,113 @@ def process_features_from_tfrecord(tfrecord_file, parser, selected_features=None
     )
 
 
-def inspect_ckpt(ckpt_file, get_name_to_weight=True, get_name_to_shape=False):
+def make_tfrecord_dataset(tfrecord_files, parser, selected_features=None, return_as_dict=False,
+                          batch_size=None, drop_remainder=False, varlen_as_dense=False,
+                          shuffle_buffer_size=None, num_epochs=1, seed=None, cycle_length=None,
+                          num_parallel_calls=None, prefetch_buffer_size=None,
+                          compression_type=None, buffer_size=None):
+    """
+    Builds a `tf.data` input pipeline that reads TFRecord shards in parallel and parses them with
+    `parser`. This replaces the queue runner based `process_features_from_tfrecord`.
+
+    Shards are interleaved, records are optionally shuffled, parsed by parallel maps and
+    prefetched. With `batch_size`, records are batched before parsing and parsed with the
+    vectorized `ExampleParser.parse_batch`.
+    :param tfrecord_files: A file path or glob, or a list of paths and globs. Sidecar index files
+    matched by globs are left out.
+    :param parser: An `ExampleParser`.
+    :param selected_features: A feature name, a list of feature names or None for all.
+    :param return_as_dict: If True, elements are dicts of feature name to tensor.
+    :param batch_size: Optional batch size.
+    :param drop_remainder: If True, drop the last batch if it is smaller than `batch_size`.
+    :param varlen_as_dense: With `batch_size`, return variable length features padded dense.
+    :param shuffle_buffer_size: If given, shuffle shard order and records with a buffer of this
+    size. Otherwise shards are read in sorted order.
+    :param num_epochs: Number of passes over the data, None to repeat forever.
+    :param seed: Optional random seed for shuffling.
+    :param cycle_length: Number of shards read concurrently, defaults to the number of CPUs.
+    :param num_parallel_calls: Parallelism of reading and parsing, defaults to autotuning.
+    :param prefetch_buffer_size: Number of elements to prefetch, defaults to autotuning.
+    :param compression_type: Compression type of the shards, 'GZIP', 'ZLIB' or None.
+    :param buffer_size: Number of bytes read at a time from every shard, defaults to the
+    `TFRecordDataset` default.
+    :return: A `tf.data.Dataset` of parsed features, with the layout returned by `parse`.
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    if cycle_length is None:
+        cycle_length = os.cpu_count() or 1
+    if num_parallel_calls is None:
+        num_parallel_calls = autotune
+    if prefetch_buffer_size is None:
+        prefetch_buffer_size = autotune
+
+    # Patterns are expanded here rather than by `list_files`, so sidecar index files are skipped.
+    tfrecord_files = expand_tfrecord_files(tfrecord_files)
+    if not tfrecord_files:
+        raise IOError('No TFRecord files match the given patterns.')
+
+    shuffle = shuffle_buffer_size is not None
+    files = tf.data.Dataset.from_tensor_slices(tfrecord_files)
+    if shuffle:
+        files = files.shuffle(len(tfrecord_files), seed=seed)
+
+    dataset = files.interleave(
+        lambda tfrecord_file: tf.data.TFRecordDataset(
+            tfrecord_file, compression_type=compression_type, buffer_size=buffer_size),
+        cycle_length=cycle_length,
+        num_parallel_calls=num_parallel_calls,
+    )
+
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer_size, seed=seed)
+
+    dataset = dataset.repeat(num_epochs)
+
+    def to_structure(parsed_features):
+        # Datasets treat lists as tensors to stack, a list of features is returned as a tuple.
+        return tuple(parsed_features) if isinstance(parsed_features, list) else parsed_features
+
+    if batch_size:
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        dataset = dataset.map(
+            lambda serialized_examples: to_structure(parser.parse_batch(
+                serialized_examples,
+                selected_features=selected_features,
+                return_as_dict=return_as_dict,
+                varlen_as_dense=varlen_as_dense,
+            )),
+            num_parallel_calls=num_parallel_calls,
+        )
+
+    else:
+        dataset = dataset.map(
+            lambda serialized_example: to_structure(parser.parse(
+                serialized_example,
+                selected_features=selected_features,
+                return_as_dict=return_as_dict,
+            )),
+            num_parallel_calls=num_parallel_calls,
+        )
+
+    return dataset.prefetch(prefetch_buffer_size)
+
+
+def inspect_ckpt(ckpt_file, get_name_to_weight=True, get_name_to_shape=False, name_filter=None,
+                 max_cached_bytes=None, lazy=True):
 
     ret_val = []
 
-    reader = pywrap_tensorflow.NewCheckpointReader(ckpt_file)
-    var_to_shape_map = reader.get_variable_to_shape_map()
+    # Tensors are read only when they are accessed, see `LazyCheckpointTensors`. `ckpt_file` may
+    # also be an open checkpoint reader.
+    name_to_weight = LazyCheckpointTensors(
+        ckpt_file, name_filter=name_filter, max_cached_bytes=max_cached_bytes)
 
     if get_name_to_shape:
-        ret_val.append(var_to_shape_map)
+        ret_val.append(dict(name_to_weight.shapes))
 
     if get_name_to_weight:
-        name_to_weight = {tensor_name: reader.get_tensor(tensor_name)
-                          for tensor_name in var_to_shape_map}
+        if not lazy:
+            name_to_weight = dict(name_to_weight.items())
         ret_val.append(name_to_weight)
 
     if len(ret_val) == 1:
@@ -72,7 +466,188 @@ def inspect_ckpt(ckpt_file, get_name_to_weight=True, get_name_to_shape=False):
     return tuple(ret_val)
 
 
-def inspect_tfrecord(tfrecord_file, id_feature, parser, features=None, selected_ids=None):
+# Interval in seconds of checking for stop requests and failed workers while blocked on a queue.
+_INSPECT_POLL_SECONDS = 0.1
+
+# State of a multi-shard inspection worker process, set by `_init_inspect_worker`.
+_inspect_worker_state = {}
+
+
+def _init_inspect_worker(stop_event, results_queue, id_feature, parser, selected_features,
+                         selected_ids, check_crc, use_index, compression_type):
+
+    # Results not consumed after a stop request are dropped when the worker exits.
+    results_queue.cancel_join_thread()
+    _inspect_worker_state.update(
+        stop_event=stop_event,
+        results_queue=results_queue,
+        id_feature=id_feature,
+        parser=parser,
+        selected_features=selected_features,
+        selected_ids=set(selected_ids) if selected_ids else None,
+        check_crc=check_crc,
+        use_index=use_index,
+        compression_type=compression_type,
+    )
+
+
+def _put_unless_stopped(item):
+    """
+    Puts an item on the results queue, waiting for space unless a stop is requested.
+    :return: False if a stop was requested.
+    """
+    state = _inspect_worker_state
+    while not state['stop_event'].is_set():
+        try:
+            state['results_queue'].put(item, timeout=_INSPECT_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _inspect_shard(tfrecord_file):
+    """
+    Parses the records of a shard in a worker and puts `(False, (id, features))` items of the
+    selected records on the results queue, followed by `(True, tfrecord_file)`.
+    """
+    state = _inspect_worker_state
+    id_feature = state['id_feature']
+    parser = state['parser']
+    selected_ids = state['selected_ids']
+
+    if selected_ids and state['use_index']:
+        index = TFRecordIndex.load_or_build(tfrecord_file, id_feature=id_feature, parser=parser)
+        serialized_examples = (serialized_example for _, serialized_example in
+                               index.read_ids(selected_ids, check_crc=state['check_crc']))
+    else:
+        serialized_examples = iterate_tfrecord(tfrecord_file, check_crc=state['check_crc'],
+                                               compression_type=state['compression_type'])
+
+    for serialized_example in serialized_examples:
+        if state['stop_event'].is_set():
+            return
+
+        # Only the ID is parsed for records that are not selected.
+        if selected_ids:
+            example_id = parser.parse_numpy(serialized_example, selected_features=id_feature)
+            if example_id not in selected_ids:
+                continue
+
+        evaluated_features = parser.parse_numpy(
+            serialized_example,
+            selected_features=state['selected_features'],
+            return_as_dict=True,
+        )
+        if not _put_unless_stopped((False, (evaluated_features[id_feature], evaluated_features))):
+            return
+
+    _put_unless_stopped((True, tfrecord_file))
+
+
+def iter_inspect_tfrecords(tfrecord_files, id_feature, parser, features=None, selected_ids=None,
+                           num_workers=None, check_crc=False, use_index=False,
+                           max_queue_size=1024, compression_type=None):
+    """
+    Inspects TFRecord shards concurrently on a process pool and yields records as they arrive.
+    When `selected_ids` are given, the workers are stopped as soon as all of them were found.
+    :param tfrecord_files: A file path, a glob pattern or a list of them.
+    :param id_feature: Name of the feature identifying records.
+    :param parser: An `ExampleParser` instance.
+    :param features: A list of feature names to return in addition to `id_feature`, or None for
+    all features.
+    :param selected_ids: Optional IDs of the records to return. Each ID is returned once, from
+    the first record found with it.
+    :param num_workers: Number of worker processes, at most one per shard. Defaults to the number
+    of CPUs.
+    :param check_crc: If True, verify the checksums of the records.
+    :param use_index: If True and `selected_ids` are given, read the selected records through the
+    sidecar index of every shard, building it when needed.
+    :param max_queue_size: Maximal number of parsed records waiting to be yielded.
+    :param compression_type: Compression type of the shards, 'GZIP', 'ZLIB' or None. Compressed
+    shards have no index, `use_index` is ignored for them.
+    :return: A generator of `(id, features_dict)` pairs, in arrival order.
+    """
+    tfrecord_files = expand_tfrecord_files(tfrecord_files)
+    selected_features = [id_feature] + features if features else None
+    remaining_ids = set(selected_ids) if selected_ids else None
+
+    if not tfrecord_files or remaining_ids == set():
+        return
+
+    num_workers = min(num_workers or multiprocessing.cpu_count(), len(tfrecord_files))
+
+    # Fork, so the parser and the synchronization objects reach the workers without pickling.
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+    stop_event = context.Event()
+    results_queue = context.Queue(maxsize=max_queue_size)
+
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_inspect_worker,
+        initargs=(stop_event, results_queue, id_feature, parser, selected_features, selected_ids,
+                  check_crc, use_index and not compression_type, compression_type),
+    )
+    futures = {}
+    try:
+        futures = {tfrecord_file: executor.submit(_inspect_shard, tfrecord_file)
+                   for tfrecord_file in tfrecord_files}
+        num_done = 0
+        while num_done < len(futures):
+            try:
+                is_shard_done, item = results_queue.get(timeout=_INSPECT_POLL_SECONDS)
+            except queue.Empty:
+                # Raise errors of workers that failed before reporting their shard as done.
+                for future in futures.values():
+                    if future.done() and future.exception() is not None:
+                        future.result()
+                continue
+
+            if is_shard_done:
+                futures[item].result()
+                num_done += 1
+                continue
+
+            example_id, evaluated_features = item
+
+            if remaining_ids is None:
+                yield example_id, evaluated_features
+            elif example_id in remaining_ids:
+                remaining_ids.discard(example_id)
+                yield example_id, evaluated_features
+                if not remaining_ids:
+                    return
+    finally:
+        stop_event.set()
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def inspect_tfrecord(tfrecord_file, id_feature, parser, features=None, selected_ids=None,
+                     session_free=False, use_index=False, callback=None, num_workers=None,
+                     compression_type=None, check_crc=False):
+
+    # Several shards or a glob pattern are inspected on a process pool. The workers always read
+    # without a session, so `session_free` does not matter there. An existing file whose name
+    # contains glob characters is a single shard.
+    if not isinstance(tfrecord_file, str) or \
+            (glob.has_magic(tfrecord_file) and not os.path.exists(tfrecord_file)):
+        if callback is not None:
+            raise ValueError('A callback is not supported when inspecting several shards.')
+        return dict(iter_inspect_tfrecords(
+            tfrecord_file,
+            id_feature=id_feature,
+            parser=parser,
+            features=features,
+            selected_ids=selected_ids,
+            num_workers=num_workers,
+            check_crc=check_crc,
+            use_index=use_index,
+            compression_type=compression_type,
+        ))
 
     features_values = {}
 
@@ -83,18 +658,48 @@ def inspect_tfrecord(tfrecord_file, id_feature, parser, features=None, selected_
             features_values[evaluated_features[id_feature]] = evaluated_features
 
     selected_features = [id_feature] + features if features else None
+
+    # Seek straight to the selected records using the sidecar index of the file, building or
+    # refreshing it when needed. Compressed files cannot be sought and are read in full.
+    if selected_ids and use_index and not compression_type:
+        index = TFRecordIndex.load_or_build(tfrecord_file, id_feature=id_feature, parser=parser)
+        for _, serialized_example in index.read_ids(selected_ids, check_crc=check_crc):
+            if callback is not None:
+                callback.on_records(1, len(serialized_example))
+            save_tensors_to_dict(parser.parse_numpy(
+                serialized_example,
+                selected_features=selected_features,
+                return_as_dict=True,
+            ))
+        return features_values
+
     features_tensors = process_features_from_tfrecord(
         tfrecord_file=tfrecord_file,
         selected_features=selected_features,
         parser=parser,
         shuffle=False,
         return_as_dict=True,
-        num_epochs=1
+        num_epochs=1,
+        session_free=session_free,
+        check_crc=check_crc,
+        callback=callback,
+        compression_type=compression_type,
     )
 
-    run_queue_runner_session(
-        tensors_to_evaluate=features_tensors,
-        process_values_function=save_tensors_to_dict,
-    )
+    if session_free:
+        for evaluated_features in features_tensors:
+            if callback is None:
+                save_tensors_to_dict(evaluated_features)
+            else:
+                start_time = time.perf_counter()
+                save_tensors_to_dict(evaluated_features)
+                callback.on_consume(time.perf_counter() - start_time)
+
+    else:
+        run_queue_runner_session(
+            tensors_to_evaluate=features_tensors,
+            process_values_function=save_tensors_to_dict,
+            callback=callback,
+        )
 
     return features_values
@@ -0,0 +1,318 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Sidecar offset index for random access into TFRecord files.
+
+The index maps record ordinals to byte offsets and, optionally, the value of an ID feature to the
+offset of the record holding it. It is saved next to the TFRecord file (`<file>.idx` by default)
+together with the size and modification time of the file it was built from, and is rebuilt when
+either of them changes.
+
+The sidecar file is a NumPy `.npz` archive of plain arrays and is loaded with pickling disabled,
+so a crafted index file cannot run code. Bytes and str IDs are stored concatenated with their
+offsets, so trailing NUL bytes of IDs are kept.
+
+Example:
+                        index = TFRecordIndex.load_or_build(path, id_feature='image/filename',
+                                                            parser=parser)
+                        for image_id, record in index.read_ids([b'0001.jpg', b'0042.jpg']):
+                            values = parser.parse_numpy(record, return_as_dict=True)
+"""
+
+import logging
+import os
+import zipfile
+from array import array
+
+from toolbox_az.general.lazy_import import LazyModule
+from toolbox_az.tf_utils.tfrecord_io import INDEX_SUFFIX, TFRecordFileReader
+
+np = LazyModule('numpy')
+
+# Kinds of saved ID values.
+_BYTES_IDS = 'bytes'
+_STR_IDS = 'str'
+_INT_IDS = 'int'
+_FLOAT_IDS = 'float'
+
+
+def _to_id_key(value):
+    """
+    Converts a parsed ID value to a hashable key.
+    :param value: A parsed scalar feature value, e.g. bytes or a NumPy integer.
+    :return: The value as a plain Python object.
+    """
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _ids_kind(ids):
+    """
+    :return: The kind of saved ID values that can hold all of `ids`.
+    """
+    types = {type(record_id) for record_id in ids}
+    for kind, kind_types in ((_BYTES_IDS, {bytes}), (_STR_IDS, {str}), (_INT_IDS, {int}),
+                             (_FLOAT_IDS, {int, float})):
+        if types <= kind_types:
+            return kind
+
+    raise TypeError('Cannot save an index of IDs of types {}.'.format(
+        sorted(id_type.__name__ for id_type in types)))
+
+
+def _encode_ids(ids):
+    """
+    Converts ID keys to arrays that are saved without pickling.
+    :return: A tuple of the kind of the IDs, an array of their values and, for bytes and str IDs,
+    `len(ids) + 1` int64 offsets into the concatenated values.
+    """
+    kind = _ids_kind(ids)
+
+    if kind == _INT_IDS:
+        return kind, np.array(ids, dtype=np.int64), None
+    if kind == _FLOAT_IDS:
+        return kind, np.array(ids, dtype=np.float64), None
+
+    if kind == _STR_IDS:
+        ids = [record_id.encode('utf-8') for record_id in ids]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(record_id) for record_id in ids], out=offsets[1:])
+    return kind, np.frombuffer(b''.join(ids), dtype=np.uint8), offsets
+
+
+def _decode_ids(kind, values, offsets):
+    """
+    The inverse of `_encode_ids`.
+    :return: A list of ID keys.
+    """
+    if kind in (_INT_IDS, _FLOAT_IDS):
+        return values.tolist()
+
+    data = values.tobytes()
+    ids = [data[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    if kind == _STR_IDS:
+        ids = [record_id.decode('utf-8') for record_id in ids]
+    return ids
+
+
+class TFRecordIndex(object):
+    """
+    Record offsets of a single TFRecord file.
+    """
+
+    VERSION = 2
+
+    def __init__(self, tfrecord_file, offsets, file_size, file_mtime_ns, id_feature=None,
+                 id_to_offset=None):
+        """
+        :param tfrecord_file: Path to the indexed TFRecord file.
+        :param offsets: An `array('q')` of record offsets in file order.
+        :param file_size: Size of the file when the index was built.
+        :param file_mtime_ns: Modification time of the file in nanoseconds when the index was
+        built.
+        :param id_feature: Name of the indexed ID feature or None.
+        :param id_to_offset: A dict of ID value to record offset. If an ID appears more than once,
+        the last record wins, as in `inspect_tfrecord`.
+        """
+        self.tfrecord_file = tfrecord_file
+        self.offsets = offsets
+        self.file_size = file_size
+        self.file_mtime_ns = file_mtime_ns
+        self.id_feature = id_feature
+        self.id_to_offset = id_to_offset or {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def index_path(tfrecord_file):
+        return tfrecord_file + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, tfrecord_file, id_feature=None, parser=None, index_file=None, save=True):
+        """
+        Scans a TFRecord file and builds its index.
+        :param tfrecord_file: Path to a TFRecord file.
+        :param id_feature: Optional name of a scalar feature to index records by.
+        :param parser: An `ExampleParser` used to decode `id_feature`. Required with `id_feature`.
+        :param index_file: Path of the sidecar file. Defaults to `index_path(tfrecord_file)`.
+        :param save: If True, write the index to `index_file`.
+        :return: A `TFRecordIndex`.
+        """
+        if id_feature is not None and parser is None:
+            raise ValueError('A parser is required to index records by {}.'.format(id_feature))
+
+        stat = os.stat(tfrecord_file)
+        offsets = array('q')
+        id_to_offset = {}
+
+        with TFRecordFileReader(tfrecord_file) as reader:
+            # Without an ID feature only the record headers are read.
+            if id_feature is None:
+                offsets.extend(reader.iter_offsets())
+
+            else:
+                for offset, record in reader.iter_records(with_offsets=True):
+                    offsets.append(offset)
+                    record_id = parser.parse_numpy(record, selected_features=id_feature)
+                    id_to_offset[_to_id_key(record_id)] = offset
+
+        index = cls(
+            tfrecord_file=tfrecord_file,
+            offsets=offsets,
+            file_size=stat.st_size,
+            file_mtime_ns=stat.st_mtime_ns,
+            id_feature=id_feature,
+            id_to_offset=id_to_offset,
+        )
+
+        if save:
+            index.save(index_file)
+
+        return index
+
+    @classmethod
+    def load(cls, tfrecord_file, index_file=None):
+        """
+        Loads the sidecar index of a TFRecord file.
+        :param tfrecord_file: Path to a TFRecord file.
+        :param index_file: Path of the sidecar file. Defaults to `index_path(tfrecord_file)`.
+        :return: A `TFRecordIndex`, or None if there is no index or it is out of date.
+        """
+        index_file = index_file or cls.index_path(tfrecord_file)
+
+        # Index files of older versions, e.g. pickled ones, fail to load and are rebuilt.
+        try:
+            with np.load(index_file, allow_pickle=False) as index_data:
+                version, file_size, file_mtime_ns = index_data['header'].tolist()
+                if version != cls.VERSION:
+                    return None
+
+                offsets = array('q', index_data['offsets'].astype('<i8').tobytes())
+                id_feature = None
+                id_to_offset = {}
+                if index_data['id_feature'].size:
+                    id_feature = str(index_data['id_feature'][0])
+                    id_offsets = index_data['id_value_offsets'] \
+                        if 'id_value_offsets' in index_data else None
+                    ids = _decode_ids(str(index_data['id_kind'][0]), index_data['id_values'],
+                                      id_offsets)
+                    id_to_offset = dict(zip(ids, index_data['id_offsets'].tolist()))
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+        index = cls(
+            tfrecord_file=tfrecord_file,
+            offsets=offsets,
+            file_size=file_size,
+            file_mtime_ns=file_mtime_ns,
+            id_feature=id_feature,
+            id_to_offset=id_to_offset,
+        )
+
+        return None if index.is_stale() else index
+
+    @classmethod
+    def load_or_build(cls, tfrecord_file, id_feature=None, parser=None, index_file=None):
+        """
+        Loads the sidecar index of a TFRecord file, rebuilding it if it is missing, out of date or
+        was built for a different ID feature. If the rebuilt index cannot be saved, e.g. in a
+        read-only dataset directory, it is used from memory.
+        :param tfrecord_file: Path to a TFRecord file.
+        :param id_feature: Optional name of a scalar feature to index records by.
+        :param parser: An `ExampleParser` used to decode `id_feature`.
+        :param index_file: Path of the sidecar file. Defaults to `index_path(tfrecord_file)`.
+        :return: A `TFRecordIndex`.
+        """
+        index = cls.load(tfrecord_file, index_file=index_file)
+
+        if index is None or (id_feature is not None and index.id_feature != id_feature):
+            index = cls.build(tfrecord_file, id_feature=id_feature, parser=parser, save=False)
+            try:
+                index.save(index_file)
+            except OSError as error:
+                logging.warning('Could not save the index of %s, using it from memory: %s',
+                                tfrecord_file, error)
+
+        return index
+
+    def is_stale(self):
+        """
+        :return: True if the indexed file changed or was removed since the index was built.
+        """
+        try:
+            stat = os.stat(self.tfrecord_file)
+        except OSError:
+            return True
+
+        return stat.st_size != self.file_size or stat.st_mtime_ns != self.file_mtime_ns
+
+    def save(self, index_file=None):
+        """
+        Writes the index to its sidecar file. The file is replaced atomically so concurrent
+        readers never see a partial index.
+        :param index_file: Path of the sidecar file. Defaults to `index_path(tfrecord_file)`.
+        """
+        index_file = index_file or self.index_path(self.tfrecord_file)
+        index_data = {
+            'header': np.array([self.VERSION, self.file_size, self.file_mtime_ns],
+                               dtype=np.int64),
+            'offsets': np.frombuffer(array('q', self.offsets), dtype=np.int64),
+            'id_feature': np.array([] if self.id_feature is None else [self.id_feature],
+                                   dtype=str),
+        }
+        if self.id_feature is not None:
+            ids = list(self.id_to_offset)
+            id_kind, id_values, id_value_offsets = _encode_ids(ids)
+            index_data.update(
+                id_kind=np.array([id_kind]),
+                id_values=id_values,
+                id_offsets=np.array([self.id_to_offset[record_id] for record_id in ids],
+                                    dtype=np.int64),
+            )
+            if id_value_offsets is not None:
+                index_data['id_value_offsets'] = id_value_offsets
+
+        temp_file = '{}.tmp{}'.format(index_file, os.getpid())
+        try:
+            with open(temp_file, 'wb') as index_stream:
+                np.savez(index_stream, **index_data)
+            os.replace(temp_file, index_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def _read_offsets(self, keys_and_offsets, check_crc):
+
+        with TFRecordFileReader(self.tfrecord_file, check_crc=check_crc) as reader:
+            for key, offset in keys_and_offsets:
+                record, _ = reader.read_at(offset)
+                yield key, record
+
+    def read_records(self, ordinals, check_crc=False):
+        """
+        Reads records by their ordinal in the file.
+        :param ordinals: An iterable of record numbers. Negative numbers count from the end.
+        :param check_crc: If True, validate record checksums.
+        :return: A generator of `(ordinal, record)` tuples, records are memoryviews that must not
+        be used after the generator is exhausted.
+        """
+        return self._read_offsets(
+            ((ordinal, self.offsets[ordinal]) for ordinal in ordinals), check_crc)
+
+    def read_ids(self, ids, check_crc=False):
+        """
+        Reads records by the value of the indexed ID feature. IDs that are not in the file are
+        skipped.
+        :param ids: An iterable of ID values.
+        :param check_crc: If True, validate record checksums.
+        :return: A generator of `(id, record)` tuples, records are memoryviews that must not be
+        used after the generator is exhausted.
+        """
+        if self.id_feature is None:
+            raise ValueError('Index of {} was built without an ID feature.'.format(
+                self.tfrecord_file))
+
+        return self._read_offsets(
+            ((record_id, self.id_to_offset[record_id]) for record_id in ids
+             if record_id in self.id_to_offset),
+            check_crc)
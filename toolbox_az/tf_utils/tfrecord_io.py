@@ -0,0 +1,614 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Graph-free TFRecord access.
+
+A TFRecord file is a sequence of records, each framed as:
+
+    uint64 length
+    uint32 masked_crc32c(length)
+    byte   data[length]
+    uint32 masked_crc32c(data)
+
+all integers little-endian. The readers in this module walk that framing directly, on a
+memory-mapped file or on a decompressed stream for GZIP and ZLIB files, so no TensorFlow graph,
+session or queue runner is needed to iterate a file.
+"""
+
+import glob
+import gzip
+import mmap
+import os
+import struct
+import zlib
+
+from toolbox_az.general.lazy_import import LazyModule
+
+np = LazyModule('numpy')
+
+_LENGTH_STRUCT = struct.Struct('<Q')
+_CRC_STRUCT = struct.Struct('<I')
+_HEADER_SIZE = _LENGTH_STRUCT.size + _CRC_STRUCT.size
+_FOOTER_SIZE = _CRC_STRUCT.size
+
+_CRC_MASK_DELTA = 0xa282ead8
+
+# Compression types, named as in `tf.python_io.TFRecordCompressionType`.
+NO_COMPRESSION = ''
+ZLIB_COMPRESSION = 'ZLIB'
+GZIP_COMPRESSION = 'GZIP'
+COMPRESSION_TYPES = (NO_COMPRESSION, ZLIB_COMPRESSION, GZIP_COMPRESSION)
+
+# Default number of bytes read from a file at a time by `TFRecordStreamReader`.
+DEFAULT_READ_BUFFER_SIZE = 256 * 1024
+
+# Suffix of the sidecar index files of `tfrecord_index`.
+INDEX_SUFFIX = '.idx'
+
+
+def _make_crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _crc32c_update(crc, data):
+
+    table = _CRC32C_TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def _crc32c_python(data):
+
+    return _crc32c_update(0xffffffff, data) ^ 0xffffffff
+
+
+# Bounds of the lane length of the vectorized CRC32-C and the smallest input it is used for.
+_CRC32C_MIN_LANE_LENGTH = 32
+_CRC32C_MAX_LANE_LENGTH = 256
+_CRC32C_NUMPY_MIN_LENGTH = 2048
+
+# NumPy versions of the table and of the state bit positions, created on first use.
+_CRC32C_ARRAYS = {}
+
+# `_CRC32C_SHIFT_OPERATORS[lane_length][k]` holds the images of the 32 single bit CRC states
+# after feeding `lane_length * 2 ** k` zero bytes. Computed on demand.
+_CRC32C_SHIFT_OPERATORS = {}
+
+
+def _crc32c_array(name):
+
+    if not _CRC32C_ARRAYS:
+        _CRC32C_ARRAYS['table'] = np.array(_CRC32C_TABLE, dtype=np.uint32)
+        _CRC32C_ARRAYS['bits'] = np.arange(32, dtype=np.uint32)
+    return _CRC32C_ARRAYS[name]
+
+
+def _apply_crc32c_operator(operator, states):
+    """
+    Applies a linear operator over GF(2), given by the images of the single bit states, to an
+    array of CRC states.
+    """
+    bits = (states[:, np.newaxis] >> _crc32c_array('bits')) & 1
+    return np.bitwise_xor.reduce(np.where(bits == 1, operator, np.uint32(0)), axis=1)
+
+
+def _crc32c_shift_operator(lane_length, level):
+
+    operators = _CRC32C_SHIFT_OPERATORS.setdefault(lane_length, [])
+    if not operators:
+        # Feed a single zero byte to each single bit state, then square up to a lane.
+        operator = np.array([_crc32c_update(1 << bit, b'\x00') for bit in range(32)],
+                            dtype=np.uint32)
+        length = 1
+        while length < lane_length:
+            operator = _apply_crc32c_operator(operator, operator)
+            length *= 2
+        operators.append(operator)
+
+    while len(operators) <= level:
+        operators.append(_apply_crc32c_operator(operators[-1], operators[-1]))
+
+    return operators[level]
+
+
+def _crc32c_numpy(data):
+    """
+    Vectorized CRC32-C of large inputs. The input is split into lanes whose CRCs are computed in
+    parallel and then combined pairwise, using that the CRC is linear over GF(2).
+    """
+    # The initial state is applied by inverting the first 4 bytes, which shorter inputs lack.
+    if len(data) < 4:
+        return _crc32c_python(data)
+
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    # A power of two lane length close to the square root of the input length balances the
+    # number of vectorized steps and the number of lanes.
+    lane_length = 1 << (len(data).bit_length() // 2)
+    lane_length = min(max(lane_length, _CRC32C_MIN_LANE_LENGTH), _CRC32C_MAX_LANE_LENGTH)
+
+    # Leading zero bytes do not change a CRC that starts from a zero state, so the input is left
+    # padded to a power of two number of lanes. The initial 0xffffffff state is equivalent to
+    # inverting the first 4 bytes of the input.
+    num_lanes = 1 << max(0, (-(-len(data) // lane_length) - 1).bit_length())
+    padding = num_lanes * lane_length - len(data)
+    padded = np.zeros(num_lanes * lane_length, dtype=np.uint8)
+    padded[padding:] = data
+    padded[padding:padding + 4] ^= 0xff
+
+    lanes_bytes = np.ascontiguousarray(padded.reshape(num_lanes, lane_length).T)
+    table = _crc32c_array('table')
+    states = np.zeros(num_lanes, dtype=np.uint32)
+    for lane_bytes in lanes_bytes:
+        states = table[(states ^ lane_bytes) & 0xff] ^ (states >> 8)
+
+    level = 0
+    while len(states) > 1:
+        operator = _crc32c_shift_operator(lane_length, level)
+        states = _apply_crc32c_operator(operator, states[0::2]) ^ states[1::2]
+        level += 1
+
+    return int(states[0]) ^ 0xffffffff
+
+
+def _crc32c_fallback(data):
+
+    if len(data) >= _CRC32C_NUMPY_MIN_LENGTH:
+        return _crc32c_numpy(data)
+    return _crc32c_python(data)
+
+
+try:
+    # Optional native implementation, much faster than the NumPy based fallback.
+    from crc32c import crc32c
+except ImportError:
+    crc32c = _crc32c_fallback
+
+
+def masked_crc32c(data):
+    """
+    Computes the masked CRC32-C checksum TFRecord files store next to lengths and payloads.
+    :param data: A bytes-like object.
+    :return: The masked checksum as an unsigned 32 bit integer.
+    """
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + _CRC_MASK_DELTA) & 0xffffffff
+
+
+def frame_record(data):
+    """
+    Frames a serialized record as it is stored in a TFRecord file.
+    :param data: A bytes-like object.
+    :return: The framed record as bytes.
+    """
+    length_bytes = _LENGTH_STRUCT.pack(len(data))
+    return b''.join([
+        length_bytes,
+        _CRC_STRUCT.pack(masked_crc32c(length_bytes)),
+        data,
+        _CRC_STRUCT.pack(masked_crc32c(data)),
+    ])
+
+
+def _check_compression_type(compression_type):
+
+    compression_type = compression_type or NO_COMPRESSION
+    if compression_type not in COMPRESSION_TYPES:
+        raise ValueError('Unsupported compression type {!r}, use one of {}.'.format(
+            compression_type, COMPRESSION_TYPES))
+    return compression_type
+
+
+class _ZlibFile(object):
+    """
+    A minimal write-only file object producing a zlib stream, as read by TF's ZLIB records.
+    """
+
+    def __init__(self, file_object, compression_level):
+        self._file = file_object
+        self._compressor = zlib.compressobj(compression_level)
+
+    def write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def flush(self):
+        self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._file.flush()
+
+    def close(self):
+        self._file.write(self._compressor.flush(zlib.Z_FINISH))
+        self._file.close()
+
+
+class TFRecordFileWriter(object):
+    """
+    Writes a TFRecord file, optionally GZIP or ZLIB compressed, without TensorFlow.
+
+    Example:
+                        with TFRecordFileWriter(path, compression_type='GZIP') as writer:
+                            writer.write(example_producer.produce_example())
+    """
+
+    def __init__(self, tfrecord_file, compression_type=None, compression_level=6):
+        """
+        :param tfrecord_file: Path of the file to write.
+        :param compression_type: One of `COMPRESSION_TYPES`, None for no compression.
+        :param compression_level: Compression level between 0 and 9.
+        """
+        self.tfrecord_file = tfrecord_file
+        self.compression_type = _check_compression_type(compression_type)
+
+        # Number of records and of uncompressed bytes written so far.
+        self.num_records = 0
+        self.num_bytes = 0
+
+        file_object = open(tfrecord_file, 'wb')
+        self._raw_file = file_object
+        if self.compression_type == GZIP_COMPRESSION:
+            self._file = gzip.GzipFile(fileobj=file_object, mode='wb',
+                                       compresslevel=compression_level, mtime=0)
+            self._owned_file = file_object
+        elif self.compression_type == ZLIB_COMPRESSION:
+            self._file = _ZlibFile(file_object, compression_level)
+            self._owned_file = None
+        else:
+            self._file = file_object
+            self._owned_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, record):
+        """
+        Frames and writes a serialized record.
+        :param record: A bytes-like object.
+        """
+        self.write_framed(frame_record(record))
+
+    def write_framed(self, framed_records, num_records=1):
+        """
+        Writes records that were already framed with `frame_record`, e.g. by a worker process.
+        :param framed_records: Bytes of one or more framed records.
+        :param num_records: Number of records in `framed_records`.
+        """
+        self._file.write(framed_records)
+        self.num_records += num_records
+        self.num_bytes += len(framed_records)
+
+    def flush(self):
+        self._file.flush()
+
+    def sync(self):
+        """
+        Flushes the written records and forces them to disk with `os.fsync`.
+        """
+        self._file.flush()
+        self._raw_file.flush()
+        os.fsync(self._raw_file.fileno())
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if self._owned_file is not None:
+            self._owned_file.close()
+        self._file = None
+
+
+class TFRecordFileReader(object):
+    """
+    Reads records of an uncompressed TFRecord file through a read-only memory map.
+
+    Records are returned as `memoryview` slices of the map, so no payload is copied. The views
+    are valid as long as the reader is open; copy them (`bytes(record)`) to keep them longer.
+
+    Example:
+                        with TFRecordFileReader(path) as reader:
+                            for record in reader:
+                                example = tf.train.Example.FromString(record)
+    """
+
+    def __init__(self, tfrecord_file, check_crc=False):
+        """
+        :param tfrecord_file: Path to a TFRecord file.
+        :param check_crc: If True, validate the length and data checksums of every record that
+        is read and raise `IOError` on a mismatch.
+        """
+        self.tfrecord_file = tfrecord_file
+        self.check_crc = check_crc
+
+        self._file = open(tfrecord_file, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+        # Zero sized files cannot be mapped.
+        if self.size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def close(self):
+        """
+        Releases the memory map and the file. Record views handed out by the reader must not be
+        used afterwards.
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Record views are still referenced by the caller, the map is released once they
+                # are garbage collected.
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def _read_header(self, offset):
+        """
+        Reads and validates the record header at `offset`.
+        :param offset: Byte offset of a record header.
+        :return: The data length of the record.
+        """
+        if offset + _HEADER_SIZE > self.size:
+            raise IOError('Truncated record header at offset {} of {}'.format(
+                offset, self.tfrecord_file))
+
+        length_bytes = self._view[offset:offset + _LENGTH_STRUCT.size]
+        length, = _LENGTH_STRUCT.unpack(length_bytes)
+
+        if offset + _HEADER_SIZE + length + _FOOTER_SIZE > self.size:
+            raise IOError('Truncated record at offset {} of {}'.format(offset, self.tfrecord_file))
+
+        if self.check_crc:
+            length_crc, = _CRC_STRUCT.unpack_from(self._view, offset + _LENGTH_STRUCT.size)
+            if masked_crc32c(length_bytes) != length_crc:
+                raise IOError('Corrupted record length at offset {} of {}'.format(
+                    offset, self.tfrecord_file))
+
+        return length
+
+    def read_at(self, offset):
+        """
+        Reads the record that starts at byte `offset`.
+        :param offset: Byte offset of the record header, as returned by `iter_records`.
+        :return: A tuple of the record data as a memoryview and the offset of the next record.
+        """
+        length = self._read_header(offset)
+        data_start = offset + _HEADER_SIZE
+        data_end = data_start + length
+        record = self._view[data_start:data_end]
+
+        if self.check_crc:
+            data_crc, = _CRC_STRUCT.unpack_from(self._view, data_end)
+            if masked_crc32c(record) != data_crc:
+                raise IOError('Corrupted record data at offset {} of {}'.format(
+                    offset, self.tfrecord_file))
+
+        return record, data_end + _FOOTER_SIZE
+
+    def iter_records(self, start_offset=0, with_offsets=False):
+        """
+        Iterates over the records of the file.
+        :param start_offset: Byte offset of the first record to read.
+        :param with_offsets: If True, yield `(offset, record)` tuples instead of records.
+        :return: A generator of record memoryviews.
+        """
+        offset = start_offset
+        while offset < self.size:
+            record, next_offset = self.read_at(offset)
+            yield (offset, record) if with_offsets else record
+            offset = next_offset
+
+    def iter_offsets(self):
+        """
+        Iterates over the record offsets of the file reading only the record headers.
+        :return: A generator of record header offsets.
+        """
+        offset = 0
+        while offset < self.size:
+            next_offset = self.next_offset(offset)
+            yield offset
+            offset = next_offset
+
+    def next_offset(self, offset):
+        """
+        Reads only the header of the record at `offset`.
+        :param offset: Byte offset of a record header.
+        :return: The offset of the following record, equal to the file size for the last record.
+        """
+        return offset + _HEADER_SIZE + self._read_header(offset) + _FOOTER_SIZE
+
+
+class TFRecordStreamReader(object):
+    """
+    Reads the records of a TFRecord file sequentially, decompressing GZIP and ZLIB files on the
+    fly. Memory use is bounded by the buffer size and the largest record.
+
+    Example:
+                        with TFRecordStreamReader(path, compression_type='GZIP') as reader:
+                            for record in reader:
+                                example = tf.train.Example.FromString(record)
+    """
+
+    def __init__(self, tfrecord_file, compression_type=None,
+                 buffer_size=DEFAULT_READ_BUFFER_SIZE, check_crc=False):
+        """
+        :param tfrecord_file: Path to a TFRecord file, or a binary file object.
+        :param compression_type: One of `COMPRESSION_TYPES`, None for no compression.
+        :param buffer_size: Number of bytes read, and at most decompressed, at a time.
+        :param check_crc: If True, validate the length and data checksums of every record and
+        raise `IOError` on a mismatch.
+        """
+        self.tfrecord_file = tfrecord_file
+        self.compression_type = _check_compression_type(compression_type)
+        self.buffer_size = buffer_size or DEFAULT_READ_BUFFER_SIZE
+        self.check_crc = check_crc
+
+        if isinstance(tfrecord_file, str):
+            self._file = open(tfrecord_file, 'rb')
+            self._owned_file = self._file
+        else:
+            self._file = tfrecord_file
+            self._owned_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def close(self):
+        if self._owned_file is not None:
+            self._owned_file.close()
+            self._owned_file = None
+
+    def _make_decompressor(self):
+
+        if self.compression_type == GZIP_COMPRESSION:
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return zlib.decompressobj(zlib.MAX_WBITS)
+
+    def _iter_chunks(self):
+        """
+        :return: A generator of chunks of the uncompressed file content.
+        """
+        decompressor = None
+        if self.compression_type != NO_COMPRESSION:
+            decompressor = self._make_decompressor()
+
+        while True:
+            data = self._file.read(self.buffer_size)
+            if not data:
+                break
+            if decompressor is None:
+                yield data
+                continue
+
+            # Output is limited to the buffer size, so highly compressed data does not expand
+            # at once.
+            while data:
+                chunk = decompressor.decompress(data, self.buffer_size)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+                # Concatenated GZIP members are decompressed in turn.
+                if decompressor.eof and decompressor.unused_data:
+                    data = decompressor.unused_data
+                    decompressor = self._make_decompressor()
+
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+    def iter_records(self):
+        """
+        Iterates over the records of the file.
+        :return: A generator of records as bytes.
+        """
+        pending = bytearray()
+        for chunk in self._iter_chunks():
+            pending += chunk
+
+            start = 0
+            while len(pending) - start >= _HEADER_SIZE:
+                length, = _LENGTH_STRUCT.unpack_from(pending, start)
+                if self.check_crc:
+                    length_crc, = _CRC_STRUCT.unpack_from(pending, start + _LENGTH_STRUCT.size)
+                    if masked_crc32c(pending[start:start + _LENGTH_STRUCT.size]) != length_crc:
+                        raise IOError('Corrupted record length in {}'.format(self.tfrecord_file))
+
+                data_start = start + _HEADER_SIZE
+                data_end = data_start + length
+                if len(pending) < data_end + _FOOTER_SIZE:
+                    break
+
+                record = bytes(pending[data_start:data_end])
+                if self.check_crc:
+                    data_crc, = _CRC_STRUCT.unpack_from(pending, data_end)
+                    if masked_crc32c(record) != data_crc:
+                        raise IOError('Corrupted record data in {}'.format(self.tfrecord_file))
+
+                yield record
+                start = data_end + _FOOTER_SIZE
+
+            del pending[:start]
+
+        if pending:
+            raise IOError('Truncated record at the end of {}'.format(self.tfrecord_file))
+
+
+def iterate_tfrecord(tfrecord_file, check_crc=False, compression_type=None,
+                     buffer_size=DEFAULT_READ_BUFFER_SIZE):
+    """
+    Iterates over the serialized records of a TFRecord file without building a TF graph.
+
+    Uncompressed files are read through a memory map. The file is kept open while the generator
+    is alive, yielded memoryviews must not be used after the generator is exhausted or closed.
+    Compressed files are decompressed as a stream and records are yielded as bytes.
+    :param tfrecord_file: Path to a TFRecord file.
+    :param check_crc: If True, validate record checksums.
+    :param compression_type: One of `COMPRESSION_TYPES`, None for no compression.
+    :param buffer_size: Number of bytes decompressed at a time from compressed files.
+    :return: A generator of serialized records as memoryviews, or bytes for compressed files.
+    """
+    if _check_compression_type(compression_type) == NO_COMPRESSION:
+        reader = TFRecordFileReader(tfrecord_file, check_crc=check_crc)
+    else:
+        reader = TFRecordStreamReader(tfrecord_file, compression_type=compression_type,
+                                      buffer_size=buffer_size, check_crc=check_crc)
+
+    with reader:
+        for record in reader:
+            yield record
+
+
+def expand_tfrecord_files(tfrecord_files):
+    """
+    :param tfrecord_files: A file path, a glob pattern or a list of them.
+    :return: A sorted list of the matching file paths, without duplicates. Sidecar index files
+    matched by patterns are left out. An existing file is taken as is, even if its name contains
+    glob characters.
+    """
+    if isinstance(tfrecord_files, str):
+        tfrecord_files = [tfrecord_files]
+
+    expanded_files = set()
+    for pattern in tfrecord_files:
+        if os.path.exists(pattern) or not glob.has_magic(pattern):
+            if not os.path.exists(pattern):
+                raise IOError('TFRecord file {} does not exist.'.format(pattern))
+            expanded_files.add(pattern)
+            continue
+
+        expanded_files.update(path for path in glob.glob(pattern)
+                              if not path.endswith(INDEX_SUFFIX))
+
+    return sorted(expanded_files)
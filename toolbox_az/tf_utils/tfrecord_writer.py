@@ -0,0 +1,184 @@
+# Copyright (c) 2019 Lightricks. All rights reserved.
+"""
+Sharded, parallel TFRecord writing.
+
+Feature dicts are serialized on a process pool with the direct wire encoder of `example_wire` and
+written into shards named `<prefix>-00000-of-000NN`. Shards are either a fixed number, filled
+round robin, or rotated when they reach a record count or a byte size.
+
+Example:
+                        manifest = write_sharded_tfrecords(
+                            (build_features(item) for item in items),
+                            output_prefix='/data/train.tfrecord',
+                            max_records_per_shard=10000,
+                            compression_type='GZIP',
+                        )
+"""
+
+import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from toolbox_az.tf_utils.example_wire import encode_example_from_data_dict
+from toolbox_az.tf_utils.tfrecord_io import TFRecordFileWriter, frame_record
+
+
+def shard_name(output_prefix, shard_index, num_shards):
+    """
+    :return: The file name of shard `shard_index` out of `num_shards`.
+    """
+    return '{}-{:05d}-of-{:05d}'.format(output_prefix, shard_index, num_shards)
+
+
+def _serialize_chunk(features_dicts):
+    """
+    Serializes and frames a chunk of feature dicts.
+    :param features_dicts: A list of feature dicts as accepted by `build_example_from_data_dict`.
+    :return: A list of framed records.
+    """
+    return [frame_record(encode_example_from_data_dict(features_data))
+            for features_data in features_dicts]
+
+
+def _iterate_chunks(iterable, chunk_size):
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iterate_serialized_chunks(features_dicts, chunk_size, num_workers, max_in_flight_chunks):
+    """
+    Serializes chunks of feature dicts on a process pool, in input order, keeping at most
+    `max_in_flight_chunks` chunks submitted and not yet written.
+    """
+    chunks = _iterate_chunks(features_dicts, chunk_size)
+
+    if num_workers == 0:
+        for chunk in chunks:
+            yield _serialize_chunk(chunk)
+        return
+
+    # Fork where available, so workers do not re-import the caller's main module.
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_serialize_chunk, chunk))
+            if len(pending) >= max_in_flight_chunks:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_sharded_tfrecords(features_dicts, output_prefix, num_shards=None,
+                            max_records_per_shard=None, max_bytes_per_shard=None,
+                            compression_type=None, compression_level=6, num_workers=None,
+                            chunk_size=64, max_in_flight_chunks=None, manifest_file=None):
+    """
+    Serializes feature dicts on a process pool and writes them into TFRecord shards.
+    :param features_dicts: An iterable of feature dicts as accepted by
+    `build_example_from_data_dict`. It is consumed lazily.
+    :param output_prefix: Path prefix of the shards.
+    :param num_shards: Write exactly this number of shards, records are distributed round
+    robin. Cannot be combined with the `max_*_per_shard` parameters.
+    :param max_records_per_shard: Start a new shard after this number of records.
+    :param max_bytes_per_shard: Start a new shard once a shard holds this number of bytes. Bytes
+    are counted before compression.
+    :param compression_type: One of `tfrecord_io.COMPRESSION_TYPES`, None for no compression.
+    :param compression_level: Compression level between 0 and 9.
+    :param num_workers: Number of serializing processes, None for one per CPU and 0 to serialize
+    in the calling process.
+    :param chunk_size: Number of records serialized per worker task.
+    :param max_in_flight_chunks: Maximal number of chunks submitted to the pool and not yet
+    written, bounding memory to about `max_in_flight_chunks * chunk_size` records. Defaults to
+    twice the number of workers.
+    :param manifest_file: Optional path to write the manifest to as JSON.
+    :return: A manifest dict with a `shards` list of `{'path', 'num_records', 'num_bytes'}`
+    dicts, where `num_bytes` is the size of the shard on disk, and the total `num_records` and
+    `num_bytes`.
+    """
+    rotate = max_records_per_shard is not None or max_bytes_per_shard is not None
+    if num_shards is not None and rotate:
+        raise ValueError('num_shards cannot be combined with max_records_per_shard or '
+                         'max_bytes_per_shard.')
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    if max_in_flight_chunks is None:
+        max_in_flight_chunks = 2 * max(num_workers, 1)
+
+    def open_shard(path):
+        return TFRecordFileWriter(path, compression_type=compression_type,
+                                  compression_level=compression_level)
+
+    serialized_chunks = _iterate_serialized_chunks(
+        features_dicts, chunk_size, num_workers, max_in_flight_chunks)
+
+    if rotate:
+        # The number of shards is known only at the end, shards are renamed once it is.
+        writers = []
+        writer = None
+        try:
+            for framed_records in serialized_chunks:
+                for framed_record in framed_records:
+                    if writer is None or \
+                            (max_records_per_shard and
+                             writer.num_records >= max_records_per_shard) or \
+                            (max_bytes_per_shard and writer.num_bytes >= max_bytes_per_shard):
+                        if writer is not None:
+                            writer.close()
+                        writer = open_shard('{}-{:05d}.incomplete'.format(
+                            output_prefix, len(writers)))
+                        writers.append(writer)
+                    writer.write_framed(framed_record)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        paths = []
+        for shard_index, writer in enumerate(writers):
+            path = shard_name(output_prefix, shard_index, len(writers))
+            os.replace(writer.tfrecord_file, path)
+            paths.append(path)
+
+    else:
+        num_shards = num_shards or 1
+        paths = [shard_name(output_prefix, shard_index, num_shards)
+                 for shard_index in range(num_shards)]
+        writers = [open_shard(path) for path in paths]
+        try:
+            record_index = 0
+            for framed_records in serialized_chunks:
+                for framed_record in framed_records:
+                    writers[record_index % num_shards].write_framed(framed_record)
+                    record_index += 1
+        finally:
+            for writer in writers:
+                writer.close()
+
+    shards = [{'path': path, 'num_records': writer.num_records,
+               'num_bytes': os.path.getsize(path)}
+              for path, writer in zip(paths, writers)]
+    manifest = {
+        'shards': shards,
+        'num_records': sum(shard['num_records'] for shard in shards),
+        'num_bytes': sum(shard['num_bytes'] for shard in shards),
+        'compression_type': compression_type or '',
+    }
+
+    if manifest_file:
+        with open(manifest_file, 'w') as manifest_stream:
+            json.dump(manifest, manifest_stream, indent=2)
+
+    return manifest